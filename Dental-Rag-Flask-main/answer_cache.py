@@ -0,0 +1,184 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from structured_log import get_logger
+
+# Generated answers kept per loaded case (0 = off) and for how long, in seconds (0 = no expiry)
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600")) or None
+# Cosine similarity at which a reworded question reuses an answer (0 = exact matches only)
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0"))
+
+log = get_logger("answer_cache")
+
+# Word-sized pieces with their leading whitespace (the last one keeps any trailing whitespace)
+_REPLAY_PIECES = re.compile(r"\s*\S+(?:\s+$)?|\s+$")
+
+
+def normalize_question(question):
+    """Exact-match key: lower-cased, whitespace-collapsed, trailing punctuation dropped"""
+    return " ".join(str(question).lower().split()).rstrip(" ?!.")
+
+
+def context_fingerprint(*parts):
+    """Digest of everything besides the question that an answer depends on"""
+    encoded = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+def replay_chunks(answer):
+    """Split a cached answer into word chunks so it streams like a fresh generation"""
+    return _REPLAY_PIECES.findall(answer) or [answer]
+
+
+class AnswerLookup:
+    """One question's cache lookup; hand it back to ``AnswerCache.put`` to store the answer"""
+
+    __slots__ = ("context", "route", "question", "vector", "answer", "match")
+
+    def __init__(self, context, route, question, vector=None):
+        self.context = context
+        self.route = route
+        self.question = question
+        self.vector = vector
+        self.answer = None
+        self.match = None  # "exact" or "semantic" on a hit
+
+
+class AnswerCache:
+    """Bounded LRU (optionally TTL) cache of LLM answers.
+
+    Answers are keyed by a context fingerprint (loaded case, CDT matches,
+    patient history), the prompt route and the normalized question. With a
+    ``similarity`` threshold and an ``embed`` function (texts -> unit-length
+    vectors), a question with no exact match can reuse the answer of the
+    closest question asked about the same context on the same route.
+    """
+
+    def __init__(self, maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, similarity=ANSWER_CACHE_SIMILARITY,
+                 embed=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.similarity = similarity
+        self.embed = embed
+        self._entries = OrderedDict()  # (context, route, question) -> (answer, vector, stored_at)
+        self._buckets = {}             # (context, route) -> {question: None}, for semantic search
+        self._lock = threading.Lock()
+        self._routes = {}
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0
+
+    @property
+    def semantic(self):
+        return self.similarity > 0 and self.embed is not None
+
+    def _expired(self, stored_at, now):
+        return self.ttl is not None and now - stored_at > self.ttl
+
+    def _route(self, route):
+        return self._routes.setdefault(route, {"exact": 0, "semantic": 0, "misses": 0, "stored": 0})
+
+    def _remove(self, key):
+        del self._entries[key]
+        bucket = self._buckets.get(key[:2])
+        if bucket is not None:
+            bucket.pop(key[2], None)
+            if not bucket:
+                del self._buckets[key[:2]]
+
+    def _question_vector(self, question):
+        try:
+            return np.asarray(self.embed([question])[0], dtype=np.float32)
+        except Exception as e:
+            log.warning("⚠️ Answer cache: question embedding failed, exact matches only (%s)", e)
+            return None
+
+    def lookup(self, context, route, question):
+        """AnswerLookup for ``question``; its ``answer`` is set on a hit"""
+        lookup = AnswerLookup(context, route, normalize_question(question))
+        if not self.enabled:
+            return lookup
+        now = time.time()
+        key = (context, route, lookup.question)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[2], now):
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._route(route)["exact"] += 1
+                lookup.answer, lookup.match = entry[0], "exact"
+                return lookup
+            has_neighbours = bool(self._buckets.get((context, route)))
+
+        if self.semantic:
+            lookup.vector = self._question_vector(lookup.question)
+        if lookup.vector is not None and has_neighbours:
+            with self._lock:
+                best_key, best_score = None, self.similarity
+                for question in list(self._buckets.get((context, route), ())):
+                    other = (context, route, question)
+                    answer, vector, stored_at = self._entries[other]
+                    if self._expired(stored_at, now):
+                        self._remove(other)
+                        continue
+                    if vector is None:
+                        continue
+                    score = float(vector @ lookup.vector)
+                    if score >= best_score:
+                        best_key, best_score = other, score
+                if best_key is not None:
+                    self._entries.move_to_end(best_key)
+                    self._route(route)["semantic"] += 1
+                    lookup.answer, lookup.match = self._entries[best_key][0], "semantic"
+                    return lookup
+
+        with self._lock:
+            self._route(route)["misses"] += 1
+        return lookup
+
+    def put(self, lookup, answer):
+        """Store a finished answer for a missed lookup"""
+        if not self.enabled or not answer:
+            return
+        key = (lookup.context, lookup.route, lookup.question)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (answer, lookup.vector, time.time())
+            self._buckets.setdefault(key[:2], {})[key[2]] = None
+            self._route(lookup.route)["stored"] += 1
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def stats(self):
+        with self._lock:
+            routes = {}
+            for route, counts in self._routes.items():
+                hits = counts["exact"] + counts["semantic"]
+                lookups = hits + counts["misses"]
+                routes[route] = {**counts, "hit_rate": hits / lookups if lookups else 0.0}
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "similarity": self.similarity if self.semantic else None,
+                "evictions": self.evictions,
+                "routes": routes,
+            }
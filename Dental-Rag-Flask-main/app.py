@@ -1,22 +1,36 @@
 import os
 import json
 import time
-import random
-from flask import Flask, jsonify, request, Response
+import threading
+from flask import Blueprint, Flask, jsonify, request, Response
 from flask_cors import CORS
-import faiss
-import pickle
-from sentence_transformers import SentenceTransformer
-import ollama
 from claude_try import (
+    answer_cache,
+    audit_log,
+    context_jobs,
+    context_loader,
     extract_anomalies,
     json_to_full_text,
     format_finding_matches,
     enhanced_chat_with_medbot,
     enhanced_chat_with_medbot_stream,
-    handle_json_text_input,
-    transform_anomalies_for_llm
+    model_residency,
+    transform_anomalies_for_llm,
+    prepare_stream_request,
+    readiness,
+    reserve_stream_slot,
+    session_state,
+    start_context_job,
+    warm_up
 )
+import metrics
+from context_jobs import CONTEXT_JOB_JOIN_TIMEOUT, FAILED, ContextNotReady
+from llm_scheduler import QueueFullError, llm_scheduler
+from structured_log import (bind_request_id, current_request_id, get_logger, log_setup, new_request_id,
+                            redact_payload, sample_chunk, setup_logging)
+from prompt_budget import prompt_stats
+from session_store import begin_request
+from visit_diff import diff_visits, format_diff_table
 
 def simple_chat_stream(question, chat_history):
     """Simple streaming function without complex session management"""
@@ -29,49 +43,111 @@ def simple_chat_stream(question, chat_history):
     except Exception as e:
         yield f"Error: {str(e)}"
 
-# Initialize Flask app
-app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024
-app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
-app.config['PERMANENT_SESSION_LIFETIME'] = 300
-CORS(app, resources={r"/api/*": {"origins": "*"}})
+bp = Blueprint('rag', __name__)
+log = get_logger("api")
+
+@bp.before_app_request
+def bind_request():
+    """Correlation id for every log line of this request (the caller's X-Request-ID when sent)"""
+    new_request_id(request.headers.get('X-Request-ID'))
+    begin_request()
+
+@bp.after_app_request
+def echo_request_id(response):
+    response.headers['X-Request-ID'] = current_request_id()
+    return response
+
+def queue_full_response(e):
+    """429 with Retry-After for a generation the LLM scheduler turned away"""
+    response = jsonify({"error": str(e), "retry_after": e.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+def create_app(warm_up_on_start=None):
+    """Build the Flask app. Models load lazily; warm-up runs in the background unless disabled."""
+    setup_logging()
+    app = Flask(__name__)
+    app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024
+    app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+    app.config['PERMANENT_SESSION_LIFETIME'] = int(os.getenv("SESSION_TTL", "300"))
+    # Chat sessions expire after the same idle time
+    session_state.ttl = app.config['PERMANENT_SESSION_LIFETIME']
+    CORS(app, resources={r"/api/*": {"origins": "*"}})
+    app.register_blueprint(bp)
+
+    if warm_up_on_start is None:
+        warm_up_on_start = os.getenv("WARM_UP_ON_START", "1") != "0"
+    if warm_up_on_start:
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+    return app
+
+def request_json(silent=False):
+    """The request body parsed as JSON, timed as the json_parse stage"""
+    with metrics.span("json_parse"):
+        return request.get_json(silent=silent)
+
+def enhance_upload(json_content, confidence_threshold=0.50):
+    """(enhanced_json_content, transformed_anomalies): the upload with its grouped and suspected anomalies added"""
+    with metrics.span("transform_anomalies"):
+        transformed_anomalies = transform_anomalies_for_llm(json_content, confidence_threshold)
+    enhanced_json_content = json_content.copy()
+    if "anomalies_grouped" in transformed_anomalies:
+        enhanced_json_content["anomalies_grouped"] = transformed_anomalies["anomalies_grouped"]
+    if "suspected_anomalies" in transformed_anomalies:
+        enhanced_json_content["suspected_anomalies"] = transformed_anomalies["suspected_anomalies"]
+    return enhanced_json_content, transformed_anomalies
+
+def context_job_links(job):
+    return {
+        "job_id": job.job_id,
+        "status": job.state,
+        "poll": f"/api/context-jobs/{job.job_id}",
+        "events": f"/api/context-jobs/{job.job_id}/events"
+    }
+
+def context_not_ready_response(e):
+    """202 with the job links while the session's upload is still loading, 500 if it failed"""
+    return jsonify({"error": str(e), **context_job_links(e.job)}), 500 if e.job.state == FAILED else 202
+
+def job_chat_history(job):
+    """The chat entry handle_json_text_input would have returned for a finished job"""
+    if job.state == "done":
+        return [("System", job.result["message"])]
+    if job.state == "failed":
+        return [("Error", f"⚠️ {job.error}")]
+    return []
 
 # Global variables for RAG context
 current_json_context = None
 current_cdt_matches = None
 current_findings = None
 
-@app.route('/api/rag-chat', methods=['POST'])
+@bp.route('/api/rag-chat', methods=['POST'])
 def rag_chat():
     global current_json_context, current_cdt_matches, current_findings
 
     try:
-        data = request.get_json()
+        data = request_json()
         if not data:
             return jsonify({"error": "Request must include 'json' or 'query'."}), 400
 
         chat_history = []
 
-        # Step 1: If JSON is provided, load context
+        # Step 1: If JSON is provided, load context in the background (a repeat upload reuses its job)
         if "json" in data and data["json"]:
-            json_content = data["json"]
-            
-            # Transform anomalies with confidence filtering and grouping
-            confidence_threshold = data.get("confidence_threshold", 0.50)
-            transformed_anomalies = transform_anomalies_for_llm(json_content, confidence_threshold)
-            
-            # Create enhanced JSON content with grouped anomalies
-            enhanced_json_content = json_content.copy()
-            if "anomalies_grouped" in transformed_anomalies:
-                enhanced_json_content["anomalies_grouped"] = transformed_anomalies["anomalies_grouped"]
-            if "suspected_anomalies" in transformed_anomalies:
-                enhanced_json_content["suspected_anomalies"] = transformed_anomalies["suspected_anomalies"]
-            
-            chat_history,_ = handle_json_text_input(enhanced_json_content, chat_history, data["patient_name"])
-            print("Finished loading with grouped anomalies")
-            
+            enhanced_json_content, transformed_anomalies = enhance_upload(
+                data["json"], data.get("confidence_threshold", 0.50))
+            job, _ = start_context_job(enhanced_json_content, data["patient_name"])
+
             # If no query, return the last message from chat_history with anomaly info
             if not data.get("query") or not data["query"].strip():
+                # Still loading after the join timeout: hand back the job instead of holding the worker
+                if data.get("async") or not job.wait(CONTEXT_JOB_JOIN_TIMEOUT):
+                    return jsonify(context_job_links(job)), 202
+                chat_history = job_chat_history(job)
+                log.info("Finished loading with grouped anomalies")
                 response_data = {
                     "message": "✅ JSON context loaded with grouped anomalies.",
                     "context_loaded": True,
@@ -90,29 +166,33 @@ def rag_chat():
         # Step 2: If query is provided, generate answer
         if "query" in data and data["query"].strip():
             question = data["query"]
-            print("Starting query")
+            log.info("Starting query")
             _, updated_history = enhanced_chat_with_medbot(
             question=question,
             chat_history=chat_history,
             session_id=data["patient_name"],
             patient_history=data.get("patient_history", [])
             )
-            print("Finished query")
+            log.info("Finished query")
             return jsonify({"answer": updated_history[-1][1]}), 200
 
         return jsonify({"error": "No valid query provided."}), 400
 
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except ContextNotReady as e:
+        return context_not_ready_response(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/')
+@bp.route('/')
 def hello_world():
     return "<p>RAG Server - Ready</p>"
 
-@app.route('/api/xray-upload', methods=['POST'])
+@bp.route('/api/xray-upload', methods=['POST'])
 def xray_upload():
     try:
-        data = request.get_json()
+        data = request_json()
         if not data:
             return jsonify({"error": "Request must include JSON data."}), 400
 
@@ -129,18 +209,26 @@ def xray_upload():
         if annotationData.get('annotations'):
             annotations_found = len(annotationData['annotations'])
 
-        return jsonify({
+        response_data = {
             "status": "success",
             "message": f"X-ray annotations processed successfully for patient {patientId}, visit {visitId}",
             "annotationsFound": annotations_found,
             "patientId": patientId,
             "visitId": visitId
-        }), 200
+        }
+
+        # With the analysis attached, start building the chat context while the image is reviewed
+        if data.get("json"):
+            enhanced_json_content, _ = enhance_upload(data["json"], data.get("confidence_threshold", 0.50))
+            job, _ = start_context_job(enhanced_json_content, data.get("patient_name", patientId))
+            response_data["contextJob"] = context_job_links(job)
+
+        return jsonify(response_data), 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/anomalies', methods=['POST'])
+@bp.route('/api/anomalies', methods=['POST'])
 def get_anomalies():
     """Return processed anomalies with confidence filtering and grouping"""
     try:
@@ -170,139 +258,168 @@ def get_anomalies():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/rag-chat-stream', methods=['POST'])
+@bp.route('/api/visit-diff', methods=['POST'])
+def visit_diff():
+    """Per-tooth new/resolved/persisting/progressed findings across visits, without the LLM.
+
+    Takes "patient_history" (visits, newest first) or a "patient_name" whose
+    session already holds the history, and optional "visit_ids" to compare.
+    """
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({"error": "Request must include 'patient_history' or 'patient_name'."}), 400
+
+        visit_ids = data.get("visit_ids")
+        if data.get("patient_history"):
+            history = data["patient_history"]
+            if visit_ids:
+                history = [v for v in history if v.get('visit_id') in visit_ids]
+            if len(history) < 2:
+                return jsonify({"error": "Need at least 2 visits for comparison."}), 400
+            diff = diff_visits(history)
+        elif data.get("patient_name"):
+            diff = session_state.get_visit_comparison_data(data["patient_name"], visit_ids)
+            if isinstance(diff, str):
+                return jsonify({"error": diff}), 400
+        else:
+            return jsonify({"error": "Request must include 'patient_history' or 'patient_name'."}), 400
+
+        return jsonify({"status": "success", "diff": diff, "table": format_diff_table(diff)}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'X-Accel-Buffering': 'no',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type'
+}
+SSE_DONE = "event: done\ndata: [DONE]\n\n"
+SSE_HEARTBEAT = ": ping\n\n"
+HEARTBEAT_INTERVAL = 15
+
+def sse_data(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+def sse_error_chunk(e):
+    return sse_data({'content': f"⚠️ Error processing your question: {str(e)}", 'type': 'error'})
+
+def context_not_ready_event(e):
+    """SSE body for a question whose upload is still loading (the job links) or failed (an error)"""
+    if e.job.state == FAILED:
+        return sse_data({'content': f"⚠️ {e}", 'type': 'error', **context_job_links(e.job)}) + SSE_DONE
+    return sse_data({**context_job_links(e.job), 'type': 'context_job'}) + SSE_DONE
+
+def prepare_rag_stream(data):
+    """Load any JSON context for a /api/rag-chat-stream request.
+
+    Returns (stream_kwargs, None) when a question should be streamed, or
+    (None, body) with a complete SSE body to send as-is. Shared by the Flask
+    route and the ASGI streaming app (asgi.py).
+
+    The question is routed and queued with the LLM scheduler here, before any
+    response bytes go out, so a full queue raises QueueFullError (-> 429).
+    The caller owns stream_kwargs["ticket"] and must release it if the stream
+    never runs.
+    """
+    if not data:
+        return None, sse_data({'error': 'Request must include JSON data'})
+
+    chat_history = []
+
+    # Step 1: If JSON is provided, load context in the background; the question below joins the job
+    if "json" in data and data["json"]:
+        enhanced_json_content, _ = enhance_upload(data["json"], data.get("confidence_threshold", 0.50))
+        patient_name_for_context = data.get("patient_name", data.get("patient_id", "default_patient"))
+        job, _ = start_context_job(enhanced_json_content, patient_name_for_context)
+
+        # If no query, return context loaded message
+        if not data.get("query") or not data["query"].strip():
+            if data.get("async") or not job.wait(CONTEXT_JOB_JOIN_TIMEOUT):
+                return None, sse_data({**context_job_links(job), 'type': 'context_job'}) + SSE_DONE
+            # Same message rag_chat returns: the job's result, or its error
+            _, context_message = job_chat_history(job)[-1]
+            context_type = 'error' if job.state == FAILED else 'context'
+            return None, sse_data({'content': context_message, 'type': context_type}) + SSE_DONE
+
+    # Step 2: If query is provided, stream the answer
+    if "query" in data and data["query"].strip():
+        stream_kwargs = {
+            "question": data["query"],
+            "chat_history": chat_history,
+            "session_id": data.get("patient_name", data.get("patient_id", "default_patient")),
+            "patient_history": data.get("patient_history", [])
+        }
+        try:
+            stream_kwargs["plan"] = prepare_stream_request(**stream_kwargs)
+        except ContextNotReady as e:
+            return None, context_not_ready_event(e)
+        stream_kwargs["ticket"] = reserve_stream_slot(stream_kwargs["plan"])
+        return stream_kwargs, None
+
+    return None, sse_data({'error': 'No valid query provided'}) + SSE_DONE
+
+@bp.route('/api/rag-chat-stream', methods=['POST'])
 def rag_chat_stream():
     """Streaming endpoint for real-time LLM responses"""
     try:
         # Get request data inside the route function (not in generator)
-        data = request.get_json()
-        print(f"🔍 Received request data: {data}")
-        
-        if not data:
-            return Response(
-                f"data: {json.dumps({'error': 'Request must include JSON data'})}\n\n",
-                mimetype='text/event-stream',
-                headers={
-                    'Cache-Control': 'no-cache',
-                    'Connection': 'keep-alive',
-                    'X-Accel-Buffering': 'no',
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Headers': 'Content-Type'
-                }
-            )
+        data = request_json()
+        log.debug("🔍 Received request data: %s", redact_payload(data))
 
-        chat_history = []
+        stream_kwargs, body = prepare_rag_stream(data)
+        if stream_kwargs is None:
+            return Response(body, mimetype='text/event-stream', headers=SSE_HEADERS)
+        request_id = current_request_id()
 
-        # Step 1: If JSON is provided, load context
-        if "json" in data and data["json"]:
-            json_content = data["json"]
-            
-            # Transform anomalies with confidence filtering and grouping
-            confidence_threshold = data.get("confidence_threshold", 0.50)
-            transformed_anomalies = transform_anomalies_for_llm(json_content, confidence_threshold)
-            
-            # Create enhanced JSON content with grouped anomalies
-            enhanced_json_content = json_content.copy()
-            if "anomalies_grouped" in transformed_anomalies:
-                enhanced_json_content["anomalies_grouped"] = transformed_anomalies["anomalies_grouped"]
-            if "suspected_anomalies" in transformed_anomalies:
-                enhanced_json_content["suspected_anomalies"] = transformed_anomalies["suspected_anomalies"]
-            
-            patient_name_for_context = data.get("patient_name", data.get("patient_id", "default_patient"))
-            chat_history, _ = handle_json_text_input(enhanced_json_content, chat_history, patient_name_for_context)
-            
-            # If no query, return context loaded message
-            if not data.get("query") or not data["query"].strip():
-                context_message = "✅ JSON context loaded with grouped anomalies."
-                return Response(
-                    f"data: {json.dumps({'content': context_message, 'type': 'context'})}\n\nevent: done\ndata: [DONE]\n\n",
-                    mimetype='text/event-stream',
-                    headers={
-                        'Cache-Control': 'no-cache',
-                        'Connection': 'keep-alive',
-                        'X-Accel-Buffering': 'no',
-                        'Access-Control-Allow-Origin': '*',
-                        'Access-Control-Allow-Headers': 'Content-Type'
-                    }
-                )
+        def generate():
+            # The server iterates the body outside this view; keep its log lines on the request
+            bind_request_id(request_id)
+            try:
+                log.info("Starting streaming (%s)", stream_kwargs['plan']['route'])
+                chunk_count = 0
+                last_heartbeat = time.time()
+                
+                for chunk in enhanced_chat_with_medbot_stream(**stream_kwargs):
+                    if chunk:
+                        chunk_count += 1
+                        if sample_chunk():
+                            log.debug("Streaming chunk %d (%d chars)", chunk_count, len(chunk))
+                        # Send the chunk with consistent JSON format
+                        yield sse_data({'content': chunk, 'type': 'chunk'})
+                        
+                        # Send heartbeat if needed
+                        current_time = time.time()
+                        if current_time - last_heartbeat > HEARTBEAT_INTERVAL:
+                            yield SSE_HEARTBEAT
+                            last_heartbeat = current_time
+                
+                log.info("Streaming completed. Total chunks: %d", chunk_count)
+                
+                # Send completion event
+                yield SSE_DONE
+                
+            except Exception as e:
+                log.warning("⚠️ Error in streaming generator: %s", e)
+                yield sse_error_chunk(e)
+                yield SSE_DONE
 
-        # Step 2: If query is provided, stream the answer
-        if "query" in data and data["query"].strip():
-            question = data["query"]
-            patient_name = data.get("patient_name", data.get("patient_id", "default_patient"))
-            patient_history = data.get("patient_history", [])
-            
-            def generate():
-                try:
-                    print(f"Starting streaming for question: {question}")
-                    chunk_count = 0
-                    last_heartbeat = time.time()
-                    
-                    for chunk in enhanced_chat_with_medbot_stream(
-                        question=question,
-                        chat_history=chat_history,
-                        session_id=patient_name,
-                        patient_history=patient_history
-                    ):
-                        if chunk:
-                            chunk_count += 1
-                            print(f"Streaming chunk {chunk_count}: {chunk[:50]}...")
-                            # Send the chunk with consistent JSON format
-                            chunk_data = f"data: {json.dumps({'content': chunk, 'type': 'chunk'})}\n\n"
-                            yield chunk_data
-                            
-                            # Send heartbeat if needed
-                            current_time = time.time()
-                            if current_time - last_heartbeat > 15:
-                                yield ": ping\n\n"
-                                last_heartbeat = current_time
-                    
-                    print(f"Streaming completed. Total chunks: {chunk_count}")
-                    
-                    # Send completion event
-                    yield "event: done\ndata: [DONE]\n\n"
-                    
-                except Exception as e:
-                    print(f"Error in streaming generator: {e}")
-                    error_message = f"⚠️ Error processing your question: {str(e)}"
-                    yield f"data: {json.dumps({'content': error_message, 'type': 'error'})}\n\n"
-                    yield "event: done\ndata: [DONE]\n\n"
-
-            return Response(generate(), mimetype='text/event-stream', headers={
-                'Cache-Control': 'no-cache',
-                'Connection': 'keep-alive',
-                'X-Accel-Buffering': 'no',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            })
-        else:
-            return Response(
-                f"data: {json.dumps({'error': 'No valid query provided'})}\n\nevent: done\ndata: [DONE]\n\n",
-                mimetype='text/event-stream',
-                headers={
-                    'Cache-Control': 'no-cache',
-                    'Connection': 'keep-alive',
-                    'X-Accel-Buffering': 'no',
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Headers': 'Content-Type'
-                }
-            )
+        response = Response(generate(), mimetype='text/event-stream', headers=SSE_HEADERS)
+        # Frees the queue slot even if the client leaves before streaming starts
+        if stream_kwargs["ticket"] is not None:
+            response.call_on_close(stream_kwargs["ticket"].release)
+        return response
 
+    except QueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
-        print(f"Unhandled error in rag_chat_stream: {e}")
-        return Response(
-            f"data: {json.dumps({'error': str(e)})}\n\nevent: done\ndata: [DONE]\n\n",
-            mimetype='text/event-stream',
-            headers={
-                'Cache-Control': 'no-cache',
-                'Connection': 'keep-alive',
-                'X-Accel-Buffering': 'no',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            }
-        )
+        log.exception("Unhandled error in rag_chat_stream: %s", e)
+        return Response(sse_data({'error': str(e)}) + SSE_DONE, mimetype='text/event-stream', headers=SSE_HEADERS)
 
-@app.route('/api/test-stream', methods=['GET'])
+@bp.route('/api/test-stream', methods=['GET'])
 def test_stream():
     """Test endpoint to verify SSE streaming works"""
     def generate():
@@ -322,16 +439,95 @@ def test_stream():
         }
     )
 
-@app.route('/health')
+@bp.route('/api/context-jobs', methods=['POST'])
+def create_context_job():
+    """Start loading an upload's context in the background; poll or subscribe with the returned links"""
+    data = request_json(silent=True) or {}
+    if not data.get("json"):
+        return jsonify({"error": "Request must include 'json'."}), 400
+    session_id = data.get("patient_name", data.get("patient_id", "default_patient"))
+    enhanced_json_content, transformed_anomalies = enhance_upload(data["json"], data.get("confidence_threshold", 0.50))
+    job, started = start_context_job(enhanced_json_content, session_id)
+    return jsonify({
+        **context_job_links(job),
+        "reused": not started,
+        "anomaly_summary": {
+            "total_anomalies": transformed_anomalies.get("total_anomalies", 0),
+            "filtered_anomalies": transformed_anomalies.get("filtered_anomalies", 0),
+            "grouped_count": len(transformed_anomalies.get("anomalies_grouped", [])),
+            "suspected_count": len(transformed_anomalies.get("suspected_anomalies", []))
+        }
+    }), 202
+
+@bp.route('/api/context-jobs/<job_id>', methods=['GET'])
+def get_context_job(job_id):
+    job = context_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired context job"}), 404
+    return jsonify(job.snapshot()), 200
+
+@bp.route('/api/context-jobs/<job_id>/events', methods=['GET'])
+def context_job_events(job_id):
+    """SSE stream of a context job's progress events, ending when the job finishes"""
+    job = context_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired context job"}), 404
+
+    def generate():
+        seen = 0
+        while True:
+            events = job.events_since(seen, timeout=HEARTBEAT_INTERVAL)
+            if not events:
+                yield SSE_HEARTBEAT
+                continue
+            for event in events:
+                yield sse_data({**event, 'type': 'progress', 'job_id': job.job_id})
+            seen += len(events)
+            if job.finished and seen >= len(job.snapshot()["events"]):
+                break
+        yield SSE_DONE
+
+    return Response(generate(), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+@bp.route('/health')
 def health_check():
     return jsonify({
         "status": "healthy", 
         "service": "rag-functions",
         "streaming": "enabled",
+        "llm_queue": llm_scheduler.stats(),
+        "prompts": prompt_stats.stats(),
+        "answer_cache": answer_cache.stats(),
+        "audit_log": audit_log.stats(),
+        "logging": log_setup.stats(),
+        "context_loader": context_loader.stats(),
+        "context_jobs": context_jobs.stats(),
+        "models": model_residency.stats(),
+        "sessions": session_state.stats(),
         "timestamp": time.time()
     }), 200
 
-@app.route('/api/test-simple-stream', methods=['POST'])
+@bp.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint (stage latencies, prompt sizes, generation speed)"""
+    if not metrics.enabled:
+        return jsonify({"error": "prometheus-client is not installed"}), 501
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+@bp.route('/ready')
+def readiness_check():
+    """Readiness probe: 503 until the CDT index is loaded and the LLM is warm"""
+    state = readiness()
+    return jsonify({
+        "status": "ready" if state["ready"] else "starting",
+        "cdt_loaded": state["cdt_loaded"],
+        "llm_warm": state["llm_warm"],
+        "error": state["error"],
+        "timestamp": time.time()
+    }), 200 if state["ready"] else 503
+
+@bp.route('/api/test-simple-stream', methods=['POST'])
 def test_simple_stream():
     """Simple test streaming endpoint"""
     def generate():
@@ -343,13 +539,7 @@ def test_simple_stream():
         except Exception as e:
             yield f"data: {json.dumps({'error': str(e), 'type': 'error'})}\n\n"
     
-    return Response(generate(), mimetype='text/event-stream', headers={
-        'Cache-Control': 'no-cache',
-        'Connection': 'keep-alive',
-        'X-Accel-Buffering': 'no',
-        'Access-Control-Allow-Origin': '*',
-        'Access-Control-Allow-Headers': 'Content-Type'
-    })
+    return Response(generate(), mimetype='text/event-stream', headers=SSE_HEADERS)
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001)
+    create_app().run(host='0.0.0.0', port=5001)
@@ -0,0 +1,193 @@
+"""ASGI entry point with an asyncio streaming path for /api/rag-chat-stream.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5001
+    GUNICORN_WORKER_CLASS=uvicorn_worker.UvicornWorker gunicorn -c gunicorn.conf.py
+
+Each open stream is a coroutine instead of a worker thread, so idle streams
+waiting on Ollama cost almost nothing. A client disconnect cancels the
+generation task, which closes the upstream Ollama response and stops token
+generation. Tokens are pulled from Ollama only as fast as the client reads
+them (every send is awaited). All other routes are served by the Flask app
+through asgiref's WSGI adapter.
+"""
+import os
+import json
+import time
+import asyncio
+import contextlib
+import threading
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app import (
+    HEARTBEAT_INTERVAL,
+    SSE_DONE,
+    SSE_HEADERS,
+    SSE_HEARTBEAT,
+    create_app,
+    prepare_rag_stream,
+    sse_data,
+    sse_error_chunk
+)
+from claude_try import enhanced_chat_with_medbot_astream, get_cdt, warm_up
+import metrics
+from llm_scheduler import QueueFullError
+from session_store import begin_request
+from structured_log import get_logger, new_request_id, redact_payload, sample_chunk, setup_logging
+
+STREAM_PATH = "/api/rag-chat-stream"
+
+log = get_logger("api")
+
+_RESPONSE_HEADERS = [(b"content-type", b"text/event-stream; charset=utf-8")] + [
+    (name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in SSE_HEADERS.items()
+]
+
+
+async def _read_body(receive, limit):
+    """Request body bytes, or None if the client went away first"""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            raise ValueError("Request body too large")
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def _watch_disconnect(receive, task):
+    """Cancel ``task`` as soon as the client disconnects"""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            task.cancel()
+            return
+
+
+async def _send_text(send, text, more_body=True):
+    # Awaiting send is the backpressure: a slow reader holds up the next Ollama read
+    await send({"type": "http.response.body", "body": text.encode("utf-8"), "more_body": more_body})
+
+
+async def _pump(send, stream_kwargs):
+    """Relay LLM chunks to the client as SSE events"""
+    log.info("Starting async streaming (%s)", stream_kwargs['plan']['route'])
+    chunk_count = 0
+    last_heartbeat = time.time()
+    try:
+        # Closed here on cancel, so Ollama stops and the slot is freed before the caller moves on
+        async with contextlib.aclosing(enhanced_chat_with_medbot_astream(**stream_kwargs)) as chunks:
+            async for chunk in chunks:
+                if chunk:
+                    chunk_count += 1
+                    if sample_chunk():
+                        log.debug("Streaming chunk %d (%d chars)", chunk_count, len(chunk))
+                    await _send_text(send, sse_data({'content': chunk, 'type': 'chunk'}))
+
+                    current_time = time.time()
+                    if current_time - last_heartbeat > HEARTBEAT_INTERVAL:
+                        await _send_text(send, SSE_HEARTBEAT)
+                        last_heartbeat = current_time
+
+        log.info("Streaming completed. Total chunks: %d", chunk_count)
+        await _send_text(send, SSE_DONE, more_body=False)
+    except Exception as e:
+        log.warning("⚠️ Error in streaming generator: %s", e)
+        await _send_text(send, sse_error_chunk(e) + SSE_DONE, more_body=False)
+
+
+async def _send_queue_full(send, e):
+    body = json.dumps({"error": str(e), "retry_after": e.retry_after}).encode("utf-8")
+    await send({"type": "http.response.start", "status": 429, "headers": [
+        (b"content-type", b"application/json"),
+        (b"retry-after", str(e.retry_after).encode("latin-1")),
+        (b"access-control-allow-origin", b"*"),
+    ]})
+    await send({"type": "http.response.body", "body": body, "more_body": False})
+
+
+async def rag_chat_stream(scope, receive, send, max_body):
+    """Async twin of app.rag_chat_stream"""
+    # Tasks and to_thread calls below copy this context, so they log under the same id
+    request_id = new_request_id(dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1") or None)
+    begin_request()
+    headers = _RESPONSE_HEADERS + [(b"x-request-id", request_id.encode("latin-1"))]
+    try:
+        body = await _read_body(receive, max_body)
+        if body is None:
+            return
+        with metrics.span("json_parse"):
+            data = json.loads(body) if body else None
+        log.debug("🔍 Received request data: %s", redact_payload(data))
+        # Context loading embeds findings and touches SQLite, so keep it off the event loop
+        stream_kwargs, reply = await asyncio.to_thread(prepare_rag_stream, data)
+    except QueueFullError as e:
+        await _send_queue_full(send, e)
+        return
+    except Exception as e:
+        log.exception("Unhandled error in rag_chat_stream: %s", e)
+        stream_kwargs, reply = None, sse_data({'error': str(e)}) + SSE_DONE
+
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    if stream_kwargs is None:
+        await _send_text(send, reply, more_body=False)
+        return
+
+    task = asyncio.ensure_future(_pump(send, stream_kwargs))
+    watcher = asyncio.ensure_future(_watch_disconnect(receive, task))
+    try:
+        await task
+    except asyncio.CancelledError:
+        if not watcher.done():
+            raise
+        log.info("Client disconnected, LLM generation cancelled")
+    finally:
+        watcher.cancel()
+        # Normally released by the generator; covers a cancel before it started
+        if stream_kwargs["ticket"] is not None:
+            stream_kwargs["ticket"].release()
+
+
+class RagStreamApp:
+    """Serve the streaming route natively and hand everything else to Flask"""
+
+    def __init__(self, flask_app, warm_up_on_start=None):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.max_body = flask_app.config['MAX_CONTENT_LENGTH']
+        if warm_up_on_start is None:
+            warm_up_on_start = os.getenv("WARM_UP_ON_START", "1") != "0"
+        self.warm_up_on_start = warm_up_on_start
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == STREAM_PATH:
+            await rag_chat_stream(scope, receive, send, self.max_body)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # Runs once per worker process, after any fork
+                if self.warm_up_on_start:
+                    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+# Like wsgi.py: map the CDT catalog before a pre-forking server forks workers
+setup_logging()
+get_cdt()
+
+app = RagStreamApp(create_app(warm_up_on_start=False))
@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import socket
+import argparse
+import threading
+from datetime import datetime, timezone
+
+from structured_log import get_logger
+
+# Directory for the append-only record segments ("" turns recording off), how
+# many rows may wait for the writer, how long it lets rows gather before a
+# write, the most rows per write, and the size at which a segment is closed
+AUDIT_LOG_DIR = os.getenv("AUDIT_LOG_DIR", "audit_log")
+AUDIT_LOG_QUEUE_SIZE = int(os.getenv("AUDIT_LOG_QUEUE_SIZE", "10000"))
+AUDIT_LOG_FLUSH_SECONDS = float(os.getenv("AUDIT_LOG_FLUSH_SECONDS", "1.0"))
+AUDIT_LOG_BATCH_SIZE = int(os.getenv("AUDIT_LOG_BATCH_SIZE", "500"))
+AUDIT_LOG_SEGMENT_MB = float(os.getenv("AUDIT_LOG_SEGMENT_MB", "64"))
+
+SEGMENT_SUFFIX = ".jsonl"
+
+log = get_logger("audit_log")
+
+
+class _Flush:
+    """Queue marker: set once every row queued before it is written"""
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class AuditLog:
+    """Append-only record writer for treatment-plan rows.
+
+    ``record()`` only puts rows on a bounded queue, so a request never waits
+    for disk; when the queue is full the rows are dropped and counted. A
+    background thread writes them in batches as JSON lines to segment files
+    of its own (host, pid and start time in the name), so workers never share
+    a file and nothing is rewritten. Reports are built from the segments on
+    demand (``export_excel``).
+    """
+
+    def __init__(self, directory=AUDIT_LOG_DIR, queue_size=AUDIT_LOG_QUEUE_SIZE,
+                 flush_seconds=AUDIT_LOG_FLUSH_SECONDS, batch_size=AUDIT_LOG_BATCH_SIZE,
+                 segment_bytes=int(AUDIT_LOG_SEGMENT_MB * 1024 * 1024)):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self.batch_size = max(1, batch_size)
+        self.segment_bytes = segment_bytes
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._writer = None
+        self._writer_pid = None
+        self._segment = None
+        self._segments = 0
+        self._stats = {"recorded": 0, "written": 0, "dropped": 0, "batches": 0, "write_seconds": 0.0, "errors": 0}
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def _ensure_writer(self):
+        # The writer thread doesn't survive a fork, so each worker process starts its own
+        pid = os.getpid()
+        if self._writer is not None and self._writer_pid == pid and self._writer.is_alive():
+            return
+        with self._lock:
+            if self._writer is not None and self._writer_pid == pid and self._writer.is_alive():
+                return
+            if self._writer_pid != pid:
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                self._segment = None
+                if self._writer_pid is None:
+                    atexit.register(self.close)
+            self._writer_pid = pid
+            self._writer = threading.Thread(target=self._run, name="audit-log", daemon=True)
+            self._writer.start()
+
+    def record(self, rows, **fields):
+        """Queue ``rows`` (dicts) with ``fields`` and a timestamp added to each; never blocks"""
+        if not self.enabled or not rows:
+            return 0
+        self._ensure_writer()
+        logged_at = datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+        queued = 0
+        for row in rows:
+            try:
+                self._queue.put_nowait({**row, **fields, "logged_at": logged_at})
+                queued += 1
+            except queue.Full:
+                break
+        with self._lock:
+            self._stats["recorded"] += queued
+            self._stats["dropped"] += len(rows) - queued
+        if queued < len(rows):
+            log.warning("⚠️ Audit log queue full, dropped %d rows", len(rows) - queued)
+        return queued
+
+    def flush(self, timeout=None):
+        """Wait until every row queued so far is on disk; False on timeout"""
+        if not self.enabled or self._writer is None or self._writer_pid != os.getpid():
+            return True
+        marker = _Flush()
+        try:
+            self._queue.put(marker, timeout=timeout)
+        except queue.Full:
+            return False
+        return marker.done.wait(timeout)
+
+    def close(self, timeout=5):
+        """Write out what is queued and stop the writer"""
+        if self._writer is None or self._writer_pid != os.getpid() or not self._writer.is_alive():
+            return
+        self.flush(timeout)
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._writer.join(timeout)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, markers = [], []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_seconds
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, _Flush):
+                    markers.append(item)
+                else:
+                    batch.append(item)
+                if stop or markers or len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+            for marker in markers:
+                marker.done.set()
+
+    def _segment_path(self):
+        if self._segment is None or os.path.getsize(self._segment) >= self.segment_bytes:
+            os.makedirs(self.directory, exist_ok=True)
+            stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+            with self._lock:
+                self._segments += 1
+                self._segment = os.path.join(
+                    self.directory,
+                    f"audit-{stamp}-{socket.gethostname()}-{os.getpid()}-{self._segments:04d}{SEGMENT_SUFFIX}")
+        return self._segment
+
+    def _write(self, batch):
+        started = time.perf_counter()
+        try:
+            lines = "".join(json.dumps(row, ensure_ascii=False, default=str) + "\n" for row in batch)
+            with open(self._segment_path(), "a", encoding="utf-8") as f:
+                f.write(lines)
+        except Exception as e:
+            log.error("⚠️ Audit log write failed, %d rows lost: %s", len(batch), e)
+            with self._lock:
+                self._stats["errors"] += 1
+                self._stats["dropped"] += len(batch)
+            return
+        with self._lock:
+            self._stats["written"] += len(batch)
+            self._stats["batches"] += 1
+            self._stats["write_seconds"] += time.perf_counter() - started
+
+    def stats(self):
+        with self._lock:
+            return {
+                "directory": self.directory or None,
+                "queued": self._queue.qsize(),
+                "segment": os.path.basename(self._segment) if self._segment else None,
+                **self._stats,
+            }
+
+
+def segment_paths(directory):
+    """Segment files in ``directory``, oldest first (their names start with the UTC start time)"""
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if name.startswith("audit-") and name.endswith(SEGMENT_SUFFIX)]
+
+
+def read_records(directory, since=None):
+    """Every recorded row, oldest segment first; ``since`` is an ISO timestamp to start from.
+
+    A line cut short by a crash mid-write is skipped.
+    """
+    for path in segment_paths(directory):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if since is None or row.get("logged_at", "") >= since:
+                    yield row
+
+
+def export_excel(directory, filename, since=None):
+    """Write the recorded rows to an Excel workbook; returns the row count"""
+    import pandas as pd
+
+    df = pd.DataFrame(list(read_records(directory, since)))
+    df.to_excel(filename, index=False)
+    print(f"✅ Exported {len(df)} rows to {filename}")
+    return len(df)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the treatment-plan audit log")
+    parser.add_argument("command", choices=["export"])
+    parser.add_argument("--dir", default=AUDIT_LOG_DIR or "audit_log")
+    parser.add_argument("--out", default="medbot_output_claude.xlsx")
+    parser.add_argument("--since", help="ISO timestamp, e.g. 2026-01-01 or 2026-01-01T09:00:00")
+    args = parser.parse_args(argv)
+
+    export_excel(args.dir, args.out, args.since)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+"""Fixtures for the hot-path benchmarks: an offline embedder and cases built from real annotations.
+
+    python -m pytest benchmarks --benchmark-autosave
+    python -m pytest benchmarks --benchmark-compare --benchmark-compare-fail=mean:15%
+"""
+import os
+import re
+import sys
+import glob
+import json
+import hashlib
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import claude_try  # noqa: E402
+import ollama_embedder  # noqa: E402
+from answer_cache import AnswerCache  # noqa: E402
+from audit_log import AuditLog  # noqa: E402
+from context_jobs import ContextJobs  # noqa: E402
+from llm_scheduler import LLMScheduler  # noqa: E402
+from ollama_embedder import CDTEmbedder  # noqa: E402
+from session_store import SessionState  # noqa: E402
+
+ANNOTATION_DIR = os.getenv(
+    "BENCH_ANNOTATION_DIR", os.path.join(ROOT, os.pardir, "Dental-Backend", "AnnotatedFiles"))
+CDT_PATH = os.path.join(ROOT, "New_CDT.xlsx")
+
+# Annotation labels that are anatomy rather than findings, and those that are treatment already done
+ANATOMY_LABELS = {"bone", "dentin", "enamel", "pulp", "gingiva", "sinus", "lower jaw", "upper jaw",
+                  "mandibular canal", "primary teeth", "permanent teeth", ""}
+PROCEDURE_LABELS = {"filling", "root canal treatment", "root canal", "restorations", "restoration",
+                    "crown", "implant", "composite", "amalgam"}
+FOREIGN_OBJECT_LABELS = {"wire", "orthodontic brackets", "metal band"}
+_FILE_NAME = re.compile(r"^(?P<timestamp>[^_]+)_(?P<patient>[0-9a-f]{24})_")
+
+
+class HashingOllama:
+    """Offline stand-in for Ollama's /api/embed: feature-hashed bag of words, same text -> same vector"""
+
+    dim = 768
+
+    def embed(self, model=None, input=None, keep_alive=None):
+        vectors = np.zeros((len(input), self.dim), dtype=np.float32)
+        for row, text in enumerate(input):
+            for token in re.findall(r"\w+", text.lower()):
+                digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+                index = int.from_bytes(digest[:4], "little") % self.dim
+                vectors[row, index] += 1.0 if digest[4] & 1 else -1.0
+        return {"embeddings": vectors.tolist()}
+
+
+class InstantLLM:
+    """Answers at once, so chat benchmarks time routing and prompt assembly only"""
+
+    def invoke(self, prompt, **kwargs):
+        return "Response: benchmark"
+
+
+def _center(points):
+    xs = [p["x"] for p in points]
+    ys = [p["y"] for p in points]
+    return (sum(xs) / len(xs), sum(ys) / len(ys)) if points else None
+
+
+def annotation_to_case(annotation):
+    """The app's upload format ({"teeth": [...]} and "current_visit") from an AnnotatedFiles JSON.
+
+    Numbered labels mark teeth; every other label is placed on its associated
+    tooth, or the tooth whose outline center is nearest, and filed as an
+    anomaly, procedure or foreign object.
+    """
+    annotations = annotation.get("annotations", {})
+    if isinstance(annotations, dict):
+        annotations = annotations.get("annotations", [])
+    annotations = [a for a in annotations if isinstance(a, dict)] if isinstance(annotations, list) else []
+
+    teeth = {}
+    for a in annotations:
+        if str(a.get("label", "")).isdigit():
+            center = _center(a.get("bounding_box") or a.get("vertices") or [])
+            if center:
+                teeth[int(a["label"])] = center
+
+    sections = {"anomalies": {}, "procedures": {}, "foreign_objects": {}}
+    for a in annotations:
+        label = str(a.get("label", "")).strip()
+        kind = label.lower()
+        if kind.isdigit() or kind in ANATOMY_LABELS:
+            continue
+        section = ("procedures" if kind in PROCEDURE_LABELS
+                   else "foreign_objects" if kind in FOREIGN_OBJECT_LABELS else "anomalies")
+        tooth = a.get("associatedTooth")
+        if tooth is None and teeth:
+            center = _center(a.get("bounding_box") or a.get("vertices") or [])
+            if center:
+                tooth = min(teeth, key=lambda n: (teeth[n][0] - center[0]) ** 2 + (teeth[n][1] - center[1]) ** 2)
+        metadata = {"annotated_by": a.get("updated_by") or a.get("created_by") or "manual"}
+        if a.get("confidence") is not None:
+            metadata["confidence"] = float(a["confidence"])
+        sections[section].setdefault(tooth if tooth is not None else "unknown", []).append(
+            {"description": label, "metadata": metadata})
+
+    def teeth_list(section, key):
+        return [{"number": number, key: items} for number, items in sections[section].items()]
+
+    anomalies = teeth_list("anomalies", "anomalies")
+    return {
+        "teeth": anomalies,
+        "current_visit": {
+            "anomalies": {"teeth": anomalies},
+            "procedures": {"teeth": teeth_list("procedures", "procedures")},
+            "foreign_objects": {"teeth": teeth_list("foreign_objects", "foreign_objects")},
+        },
+    }
+
+
+def _load_annotations():
+    paths = sorted(glob.glob(os.path.join(ANNOTATION_DIR, "*.json")))
+    if not paths:
+        pytest.skip(f"no annotation JSONs in {ANNOTATION_DIR}")
+    cases = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            case = annotation_to_case(json.load(f))
+        match = _FILE_NAME.match(os.path.basename(path))
+        cases.append((match.groupdict() if match else {}, case))
+    return cases
+
+
+@pytest.fixture(scope="session")
+def annotation_cases():
+    """(file info, case) for every annotation JSON, in file-name order"""
+    return _load_annotations()
+
+
+@pytest.fixture(scope="session")
+def cases(annotation_cases):
+    """A typical upload (median finding count) and the largest one"""
+    by_size = sorted((c for _, c in annotation_cases if c["teeth"]),
+                     key=lambda c: sum(len(t["anomalies"]) for t in c["teeth"]))
+    return {"median": by_size[len(by_size) // 2], "largest": by_size[-1]}
+
+
+@pytest.fixture(scope="session")
+def patient_history(annotation_cases):
+    """Past visits of the patient with the most annotated X-rays, newest first"""
+    visits = {}
+    for info, case in annotation_cases:
+        if info:
+            visits.setdefault(info["patient"], []).append((info["timestamp"], case))
+    patient, timeline = max(visits.items(), key=lambda item: len(item[1]))
+    return [
+        {"timestamp": timestamp, "visit_id": f"{patient}-{i}",
+         "findings": claude_try.extract_anomalies(case), "cdt_matches": ""}
+        for i, (timestamp, case) in enumerate(sorted(timeline, key=lambda t: t[0], reverse=True))
+    ]
+
+
+@pytest.fixture(scope="session")
+def embedder(tmp_path_factory):
+    """A real CDTEmbedder over New_CDT.xlsx whose vectors come from HashingOllama"""
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(ollama_embedder, "get_client", lambda: HashingOllama())
+        bundle = tmp_path_factory.mktemp("cdt") / "cdt_catalog.bundle"
+        yield CDTEmbedder(CDT_PATH, bundle_path=str(bundle))
+
+
+@pytest.fixture(scope="session")
+def bench_models(embedder):
+    """claude_try wired to the offline embedder, an instant LLM and fresh in-memory state"""
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(claude_try, "_cdt", embedder)
+        mp.setattr(claude_try, "_cdt_match_cache", None)
+        mp.setattr(claude_try, "_llm", InstantLLM())
+        mp.setattr(claude_try, "llm_scheduler", LLMScheduler(max_in_flight=64, max_queue=100000))
+        mp.setattr(claude_try, "session_state", SessionState(ttl=None, max_sessions=None, memory_budget=None))
+        mp.setattr(claude_try, "answer_cache", AnswerCache(maxsize=0))
+        mp.setattr(claude_try, "audit_log", AuditLog(directory=""))
+        mp.setattr(claude_try, "context_jobs", ContextJobs())
+        yield claude_try
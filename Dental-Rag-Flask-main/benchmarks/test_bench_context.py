@@ -0,0 +1,59 @@
+import pytest
+
+import session_store
+from patient_context import PatientContextBuilder
+from session_store import SessionState
+
+
+@pytest.mark.parametrize("size", ["median", "largest"])
+def test_extract_anomalies(benchmark, bench_models, cases, size):
+    findings = benchmark(bench_models.extract_anomalies, cases[size])
+    assert findings
+
+
+@pytest.mark.parametrize("size", ["median", "largest"])
+def test_transform_anomalies_for_llm(benchmark, bench_models, cases, size):
+    result = benchmark(bench_models.transform_anomalies_for_llm, cases[size], 0.5)
+    assert result["total_anomalies"] > 0
+
+
+@pytest.mark.parametrize("size", ["median", "largest"])
+def test_json_to_full_text(benchmark, bench_models, cases, size):
+    text = benchmark(bench_models.json_to_full_text, cases[size])
+    assert "CURRENT VISIT ANOMALIES" in text
+
+
+@pytest.mark.parametrize("size", ["median", "largest"])
+def test_format_finding_matches(benchmark, bench_models, cases, size):
+    """Formatting with the upload's CDT matches already retrieved (the match cache is warm)"""
+    findings = bench_models.extract_anomalies(cases[size])
+    bench_models.format_finding_matches(findings)
+    text, records = benchmark(bench_models.format_finding_matches, findings)
+    assert len(records) == len(findings)
+
+
+@pytest.mark.parametrize("size", ["median", "largest"])
+def test_load_case_context(benchmark, bench_models, cases, size):
+    json_context, findings, _ = benchmark(bench_models.load_case_context, cases[size])
+    assert findings and json_context
+
+
+def test_get_patient_context_cached(benchmark, patient_history, monkeypatch):
+    monkeypatch.setattr(session_store, "patient_contexts", PatientContextBuilder())
+    state = SessionState(ttl=None, max_sessions=None, memory_budget=None)
+    state.set_current_patient("bench", "p-1", "Benchmark Patient", patient_history)
+    state.get_patient_context("bench", max_tokens=3000)
+    context = benchmark(state.get_patient_context, "bench", max_tokens=3000)
+    assert context.startswith("Patient: Benchmark Patient")
+
+
+def test_get_patient_context_new_history(benchmark, patient_history, monkeypatch):
+    """First render of a history (empty context cache every round)"""
+    state = SessionState(ttl=None, max_sessions=None, memory_budget=None)
+    state.set_current_patient("bench", "p-1", "Benchmark Patient", patient_history)
+
+    def fresh_cache():
+        monkeypatch.setattr(session_store, "patient_contexts", PatientContextBuilder())
+
+    benchmark.pedantic(state.get_patient_context, args=("bench",), kwargs={"max_tokens": 3000},
+                       setup=fresh_cache, rounds=50)
@@ -0,0 +1,38 @@
+import pytest
+
+# One question per prompt route
+QUESTIONS = {
+    "history": "Show the full history for this patient",
+    "comparison": "Compare visits and list changes since the first one",
+    "general": "What is a periapical lesion?",
+    "treatment_plan": "Create treatment plan with CDT codes",
+    "comprehensive": "Which teeth need attention first?",
+}
+
+
+@pytest.fixture(scope="module")
+def loaded_session(bench_models, cases, patient_history):
+    """A session with the largest upload loaded and the patient's visit history"""
+    bench_models.session_state.set_current_patient("bench", "p-1", "Benchmark Patient", patient_history)
+    bench_models.handle_json_text_input(cases["largest"], [], "bench")
+    # General questions only take the general route before an upload
+    bench_models.session_state.set_current_patient("bench-general", "p-1", "Benchmark Patient", patient_history)
+    return bench_models
+
+
+def _session(route):
+    return "bench-general" if route == "general" else "bench"
+
+
+@pytest.mark.parametrize("route", list(QUESTIONS))
+def test_prepare_stream_request(benchmark, loaded_session, route):
+    """Routing and prompt assembly for /api/rag-chat-stream"""
+    plan = benchmark(loaded_session.prepare_stream_request, QUESTIONS[route], [], _session(route))
+    assert plan["route"] == route and plan["prompt"]
+
+
+@pytest.mark.parametrize("route", list(QUESTIONS))
+def test_enhanced_chat_with_medbot(benchmark, loaded_session, route):
+    """Routing, prompt assembly and bookkeeping for /api/rag-chat (the LLM answers instantly)"""
+    _, history = benchmark(loaded_session.enhanced_chat_with_medbot, QUESTIONS[route], [], _session(route))
+    assert history[-1][0] == QUESTIONS[route]
@@ -0,0 +1,24 @@
+import pytest
+
+
+def _descriptions(case):
+    return [a["description"] for tooth in case["teeth"] for a in tooth["anomalies"]]
+
+
+def test_retrieve_best_match_cached_query(benchmark, embedder):
+    embedder.retrieve_best_match("Periapical lesion")
+    df, records = benchmark(embedder.retrieve_best_match, "Periapical lesion")
+    assert len(records) == 10 and list(df.columns)[:2] == ["Code", "Description"]
+
+
+def test_retrieve_best_match_new_query(benchmark, embedder):
+    """Each round embeds its query first (the offline embedder stands in for Ollama)"""
+    queries = iter(f"periapical lesion variant {i}" for i in range(10 ** 9))
+    benchmark(lambda: embedder.retrieve_best_match(next(queries)))
+
+
+@pytest.mark.parametrize("size", ["median", "largest"])
+def test_rank_batch_upload(benchmark, embedder, cases, size):
+    descriptions = list(dict.fromkeys(_descriptions(cases[size])))
+    results = benchmark(embedder.rank_batch, descriptions)
+    assert len(results) == len(descriptions)
@@ -0,0 +1,152 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import hashlib
+import argparse
+
+import numpy as np
+
+# Bundle layout (little-endian):
+#   magic (8 bytes) | format version (u32) | header length (u32) | header JSON
+#   | zero padding to VECTOR_ALIGN | float32 unit-length vectors, rows x dim
+BUNDLE_MAGIC = b"CDTBNDL\0"
+BUNDLE_FORMAT_VERSION = 1
+VECTOR_ALIGN = 64
+_PREAMBLE = struct.Struct("<8sII")
+
+# Bump when the way catalog vectors are produced changes so bundles get rebuilt
+EMBEDDING_CACHE_VERSION = 2
+
+
+class BundleError(Exception):
+    """Raised when a bundle file is missing, truncated or of an unknown format"""
+
+
+def catalog_key(cdt_path, model_name):
+    """Content hash of the CDT sheet plus the embedding model name"""
+    digest = hashlib.sha256()
+    with open(cdt_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    digest.update(f"\0{model_name}\0{EMBEDDING_CACHE_VERSION}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load_catalog(cdt_path):
+    """Parse New_CDT.xlsx into (codes, descriptions, keywords, texts). Build-time only."""
+    import pandas as pd
+
+    df = pd.read_excel(cdt_path)
+    df = df.rename(columns={
+        "Procedure Code": "Code",
+        "Description of Service": "Description",
+        "Keywords": "Keywords"
+    })
+    df = df.dropna(subset=['Code', 'Description']).reset_index(drop=True)
+    df['Keywords'] = df['Keywords'].fillna("").astype(str).str.lower().str.strip()
+
+    codes = df['Code'].astype(str).tolist()
+    descriptions = df['Description'].astype(str).tolist()
+    keywords = df['Keywords'].tolist()
+
+    # Format text better before embedding
+    texts = [
+        f"CDT Code: {code}\n"
+        f"Service: {description}\n"
+        f"Keywords: {keyword}"
+        for code, description, keyword in zip(df['Code'], df['Description'], keywords)
+    ]
+    return codes, descriptions, keywords, texts
+
+
+def write_bundle(path, key, model_name, codes, descriptions, keywords, texts, vectors):
+    """Write a bundle atomically; vectors must be unit-length rows in catalog order"""
+    vectors = np.ascontiguousarray(vectors, dtype='<f4')
+    if vectors.ndim != 2 or vectors.shape[0] != len(codes):
+        raise BundleError(f"Expected {len(codes)} vectors, got shape {vectors.shape}")
+
+    header = json.dumps({
+        "key": key,
+        "model": model_name,
+        "rows": int(vectors.shape[0]),
+        "dim": int(vectors.shape[1]),
+        "codes": codes,
+        "descriptions": descriptions,
+        "keywords": [keyword.split() for keyword in keywords],
+        "texts": texts,
+    }).encode("utf-8")
+
+    offset = _PREAMBLE.size + len(header)
+    padding = -offset % VECTOR_ALIGN
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_PREAMBLE.pack(BUNDLE_MAGIC, BUNDLE_FORMAT_VERSION, len(header)))
+        f.write(header)
+        f.write(b"\0" * padding)
+        f.write(vectors.tobytes())
+    os.replace(tmp_path, path)
+
+
+class CatalogBundle:
+    """Read-only view of a compiled CDT catalog.
+
+    The vector block is memory-mapped and exposed without copying, so every
+    worker process maps the same page-cache pages. Only JSON is parsed, never
+    pickle.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mmap) < _PREAMBLE.size:
+            raise BundleError(f"{path} is truncated")
+        magic, version, header_len = _PREAMBLE.unpack_from(self._mmap, 0)
+        if magic != BUNDLE_MAGIC:
+            raise BundleError(f"{path} is not a CDT catalog bundle")
+        if version != BUNDLE_FORMAT_VERSION:
+            raise BundleError(f"{path} has format version {version}, expected {BUNDLE_FORMAT_VERSION}")
+
+        header_end = _PREAMBLE.size + header_len
+        header = json.loads(self._mmap[_PREAMBLE.size:header_end].decode("utf-8"))
+        self.key = header["key"]
+        self.model_name = header["model"]
+        self.codes = header["codes"]
+        self.descriptions = header["descriptions"]
+        self.keyword_sets = [frozenset(tokens) for tokens in header["keywords"]]
+        self.texts = header["texts"]
+
+        rows, dim = header["rows"], header["dim"]
+        offset = header_end + (-header_end % VECTOR_ALIGN)
+        if len(self._mmap) < offset + rows * dim * 4:
+            raise BundleError(f"{path} is truncated")
+        self.vectors = np.frombuffer(self._mmap, dtype='<f4', count=rows * dim, offset=offset).reshape(rows, dim)
+
+    def __len__(self):
+        return len(self.codes)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile New_CDT.xlsx into a memory-mappable catalog bundle")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--cdt", default="New_CDT.xlsx")
+    parser.add_argument("--out", default="cdt_catalog.bundle")
+    parser.add_argument("--model", default="nomic-embed-text:latest")
+    args = parser.parse_args(argv)
+
+    from ollama_embedder import CDTEmbedder
+    from structured_log import setup_logging
+
+    setup_logging()
+
+    embedder = CDTEmbedder(args.cdt, model_name=args.model, bundle_path=args.out, rebuild=True)
+    print(f"✅ Wrote {args.out}: {len(embedder.codes)} codes, key {embedder.cache_key[:12]}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
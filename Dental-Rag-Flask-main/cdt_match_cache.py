@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import glob
+import sqlite3
+import argparse
+import threading
+
+
+def normalize_description(description):
+    """Cache key for an anomaly: lower-cased, whitespace-collapsed description"""
+    return " ".join(str(description).lower().split())
+
+
+def cache_namespace(embedder, k):
+    """Everything that changes retrieval output: catalog hash, model, weights and k"""
+    return f"{embedder.cache_key}|{embedder.cosine_weight}|{embedder.jaccard_weight}|{k}"
+
+
+class CDTMatchCache:
+    """SQLite-backed store of normalized anomaly description -> re-ranked CDT records.
+
+    Lookups only see rows written under this namespace, so a new New_CDT.xlsx,
+    embedding model or scoring weights invalidate the cache. Rows left by other
+    namespaces stay on disk (a worker still on the old catalog may be reading
+    them) until ``purge_other_namespaces`` runs, e.g. from ``warm``.
+    """
+
+    def __init__(self, path, namespace):
+        self.path = path
+        self.namespace = namespace
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS matches ("
+                " namespace TEXT NOT NULL,"
+                " description TEXT NOT NULL,"
+                " records TEXT NOT NULL,"
+                " PRIMARY KEY (namespace, description))"
+            )
+
+    def _conn(self):
+        # One connection per thread and per process (workers may fork after init)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get_many(self, descriptions):
+        """Return {description: records} for the descriptions already cached"""
+        descriptions = list(dict.fromkeys(descriptions))
+        found = {}
+        conn = self._conn()
+        # Stay well under SQLite's bound-parameter limit
+        for start in range(0, len(descriptions), 500):
+            chunk = descriptions[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT description, records FROM matches WHERE namespace = ? AND description IN ({placeholders})",
+                [self.namespace, *chunk],
+            ).fetchall()
+            for description, records in rows:
+                found[description] = json.loads(records)
+        with self._stats_lock:
+            self.hits += len(found)
+            self.misses += len(descriptions) - len(found)
+        return found
+
+    def put_many(self, matches):
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO matches (namespace, description, records) VALUES (?, ?, ?)",
+                [(self.namespace, description, json.dumps(records)) for description, records in matches.items()],
+            )
+
+    def purge_other_namespaces(self):
+        """Delete rows cached under any other namespace; returns how many were removed"""
+        conn = self._conn()
+        with conn:
+            return conn.execute("DELETE FROM matches WHERE namespace != ?", (self.namespace,)).rowcount
+
+    def stats(self):
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+
+def cached_best_matches(embedder, cache, descriptions, k=10):
+    """Re-ranked CDT records per normalized description, retrieving only cache misses.
+
+    Returns {normalized description: records}.
+    """
+    keys = list(dict.fromkeys(normalize_description(d) for d in descriptions))
+    matches = cache.get_many(keys) if cache is not None else {}
+    missing = [key for key in keys if key not in matches]
+    if missing:
+        fresh = dict(zip(missing, embedder.rank_batch(missing, k=k)))
+        if cache is not None:
+            cache.put_many(fresh)
+        matches.update(fresh)
+    return matches
+
+
+def annotation_labels(annotations_dir):
+    """Distinct finding labels in the CV annotation JSONs (tooth-number labels skipped)"""
+    labels = set()
+    for path in glob.glob(os.path.join(annotations_dir, "*.json")):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        annotations = data.get("annotations") if isinstance(data, dict) else None
+        if isinstance(annotations, dict):
+            annotations = annotations.get("annotations")
+        if not isinstance(annotations, list):
+            continue
+        for annotation in annotations:
+            label = annotation.get("label") if isinstance(annotation, dict) else None
+            if label and not str(label).strip().isdigit():
+                labels.add(normalize_description(label))
+    return sorted(labels)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-fill the CDT match cache from annotation labels")
+    parser.add_argument("command", choices=["warm"])
+    parser.add_argument("--annotations", default=os.path.join("..", "Dental-Backend", "AnnotatedFiles"))
+    parser.add_argument("--cdt", default="New_CDT.xlsx")
+    parser.add_argument("--cache", default=os.getenv("CDT_MATCH_CACHE_PATH", "cdt_match_cache.sqlite3"))
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    from ollama_embedder import CDTEmbedder
+    from structured_log import setup_logging
+
+    setup_logging()
+
+    labels = annotation_labels(args.annotations)
+    print(f"Found {len(labels)} distinct finding labels in {args.annotations}")
+
+    embedder = CDTEmbedder(args.cdt)
+    cache = CDTMatchCache(args.cache, cache_namespace(embedder, args.k))
+    purged = cache.purge_other_namespaces()
+    if purged:
+        print(f"Dropped {purged} matches cached for an older catalog, model or k")
+    cached_best_matches(embedder, cache, labels, k=args.k)
+    print(f"✅ CDT match cache warm: {len(labels)} labels ({cache.stats()['hits']} already cached) -> {args.cache}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
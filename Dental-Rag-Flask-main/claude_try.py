@@ -1,189 +1,162 @@
 import json
 import os
 import time
-import random
-import pandas as pd
-from ollama_embedder import CDTEmbedder
-from langchain_community.llms import Ollama
-from langchain_core.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from uuid import uuid4
+import threading
+from cdt_match_cache import CDTMatchCache, cache_namespace, cached_best_matches, normalize_description
+from context_jobs import CONTEXT_JOB_JOIN_TIMEOUT, DONE, ContextJobs, ContextNotReady
+from context_loader import ContextLoader
 from datetime import datetime
 from typing import Dict, List, Optional, Tuple, Union
-import ollama
-
-# Load LLaMA model via Ollama
-llm = Ollama(model="mistral:latest")
-print("✅ (Ollama) model loaded.")
+from answer_cache import AnswerCache, context_fingerprint, replay_chunks
+from audit_log import AuditLog
+from ollama_client import get_async_client, get_client
+from session_store import SessionState
+from session_backends import create_session_backend
+from visit_diff import format_diff_table
+from prompt_budget import PROMPT_MIN_CTX, fit_section, measure_prompt, report_prompt_eval
+from model_residency import ModelResidency
+from llm_scheduler import PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_STANDARD, QueueFullError, llm_scheduler
+import metrics
+from structured_log import get_logger, sample_chunk
+
+# Models are built lazily (see get_llm / get_cdt) so importing this module stays cheap
+LLM_MODEL = "mistral:latest"
+LLM_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+EMBED_MODEL = "nomic-embed-text:latest"
+EMBED_KEEP_ALIVE = os.getenv("OLLAMA_EMBED_KEEP_ALIVE", LLM_KEEP_ALIVE)
+# The ollama client reads OLLAMA_HOST itself; the LangChain wrapper needs it passed in
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+OLLAMA_BASE_URL = OLLAMA_HOST if "://" in OLLAMA_HOST else f"http://{OLLAMA_HOST}"
 
 # Typing speed configuration (characters per second)
 TYPING_SPEED = 30  # Adjust this: 20 = slow, 30 = medium, 50 = fast
 TYPING_DELAY = 1.0 / TYPING_SPEED  # Convert to delay per character
 
-# Load CDT Embedder
-cdt = CDTEmbedder("New_CDT.xlsx")
-
-# Simplified Session State (No SQL)
-class SessionState:
-    def __init__(self):
-        self.sessions = {}
-    
-    def get_session(self, session_id):
-        if session_id not in self.sessions:
-            self.sessions[session_id] = {
-                'threads': {
-                    'default': {
-                        'json_context': None,
-                        'cdt_matches': None,
-                        'findings': None,
-                        'chat_history': [],
-                        'name': 'Default Case',
-                        'json_text': "",
-                        'patient_id': None,
-                        'visit_id': None,
-                        'thread_type': 'scenario',
-                        'patient_history': []  # Store history in memory
-                    }
-                },
-                'current_thread': 'default',
-                'current_patient_id': None,
-                'patient_name': None,
-                'patient_history': []  # Store all patient history in memory
-            }
-        return self.sessions[session_id]
-    
-    def set_current_patient(self, session_id: str, patient_id: str, patient_name: str, patient_history: List[dict] = None):
-        """Set current patient for the session with optional history from MongoDB"""
-        session = self.get_session(session_id)
-        session['current_patient_id'] = patient_id
-        session['patient_name'] = patient_name
-        session['patient_history'] = patient_history or []
-        
-        current_thread = session['threads'][session['current_thread']]
-        current_thread['patient_id'] = patient_id
-        current_thread['visit_id'] = str(uuid4())
-        current_thread['name'] = f"📋 Visit: {patient_name} - Current Visit"
-        current_thread['patient_history'] = patient_history or []
-        
-        return len(session['patient_history'])
-    
-    def get_patient_context(self, session_id: str) -> str:
-        """Build patient context for AI from visit history"""
-        session = self.get_session(session_id)
-        if not session['current_patient_id']:
-            return ""
-        
-        history = session['patient_history']
-        if not history:
-            return f"New patient: {session['patient_name']} - No previous visits."
-        
-        context_parts = [f"Patient: {session['patient_name']} - {len(history)} previous visits"]
-        
-        for i, visit in enumerate(history):
-            visit_date = visit.get('timestamp', 'Unknown date')
-            context_parts.append(f"\n--- Visit {i+1} ({visit_date}) ---")
-            
-            if visit.get('findings'):
-                context_parts.append(f"Findings: {json.dumps(visit['findings'])}")
-            
-            if visit.get('cdt_matches'):
-                context_parts.append(f"CDT Matches: {visit['cdt_matches']}")
-        
-        return "\n".join(context_parts)
-    
-    def create_thread(self, session_id, thread_name, thread_type='scenario'):
-        """Create thread with explicit type: 'scenario' or 'visit'"""
-        session = self.get_session(session_id)
-        thread_id = f"thread_{len(session['threads'])}"
-        type_prefix = "🔬 Scenario: " if thread_type == 'scenario' else "📋 Visit: "
-        display_name = f"{type_prefix}{thread_name}"
-        
-        session['threads'][thread_id] = {
-            'json_context': None,
-            'cdt_matches': None,
-            'findings': None,
-            'chat_history': [],
-            'name': display_name,
-            'json_text': "",
-            'patient_id': session['current_patient_id'],
-            'visit_id': str(uuid4()) if thread_type == 'visit' else None,
-            'thread_type': thread_type,
-            'patient_history': session.get('patient_history', [])
-        }
-        session['current_thread'] = thread_id
-        return thread_id
-    
-    def get_visit_comparison_data(self, session_id, visit_ids=None):
-        """Get data for comparing multiple visits"""
-        session = self.get_session(session_id)
-        if not session['current_patient_id']:
-            return "No patient selected for comparison."
-        
-        history = session['patient_history']
-        if len(history) < 2:
-            return "Need at least 2 visits for comparison."
-        
-        if not visit_ids:
-            visits_to_compare = history[:3]  # Last 3 visits
-        else:
-            visits_to_compare = [v for v in history if v.get('visit_id') in visit_ids]
-        
-        comparison_data = {
-            'patient_name': session['patient_name'],
-            'visits': []
-        }
-        
-        for visit in visits_to_compare:
-            visit_date = visit.get('timestamp', 'Unknown date')
-            visit_data = {
-                'date': visit_date,
-                'visit_id': visit.get('visit_id', 'unknown'),
-                'findings': visit.get('findings', []),
-                'findings_count': len(visit.get('findings', [])),
-                'teeth_affected': list(set([f['tooth'] for f in visit.get('findings', [])])),
-                'cdt_matches': visit.get('cdt_matches', '')
-            }
-            comparison_data['visits'].append(visit_data)
-        
-        return comparison_data
-    
-    def switch_thread(self, session_id, thread_id):
-        session = self.get_session(session_id)
-        if thread_id in session['threads']:
-            session['current_thread'] = thread_id
-    
-    def get_current_thread(self, session_id):
-        session = self.get_session(session_id)
-        return session['threads'].get(session['current_thread'], None)
-    
-    def get_thread_list(self, session_id):
-        session = self.get_session(session_id)
-        return [{'id': tid, 'name': t['name']} for tid, t in session['threads'].items()]
-    
-    def clear_thread(self, session_id, thread_id):
-        session = self.get_session(session_id)
-        if thread_id in session['threads']:
-            del session['threads'][thread_id]
-            if session['current_thread'] == thread_id:
-                session['current_thread'] = 'default' if 'default' in session['threads'] else next(iter(session['threads'].keys()), None)
-    
-    def clear_session(self, session_id):
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+# Query embedding cache for CDT retrieval (TTL 0 = no expiry, empty path = memory only)
+QUERY_CACHE_SIZE = int(os.getenv("CDT_QUERY_CACHE_SIZE", "4096"))
+QUERY_CACHE_TTL = float(os.getenv("CDT_QUERY_CACHE_TTL", "0")) or None
+QUERY_CACHE_PATH = os.getenv("CDT_QUERY_CACHE_PATH") or None
+
+# Persistent finding -> CDT match cache (fill offline with: python cdt_match_cache.py warm)
+CDT_TOP_K = 10
+CDT_MATCH_CACHE_PATH = os.getenv("CDT_MATCH_CACHE_PATH", "cdt_match_cache.sqlite3")
+
+# Session limits; create_app sets the idle TTL from PERMANENT_SESSION_LIFETIME
+SESSION_TTL = float(os.getenv("SESSION_TTL", "300"))
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", "1000"))
+SESSION_MEMORY_BUDGET_MB = int(os.getenv("SESSION_MEMORY_BUDGET_MB", "256"))
+
+# Where sessions live: memory (per worker), sqlite (shared on one host) or redis (shared across hosts)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "sessions.sqlite3")
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL") or None
+
+_init_lock = threading.RLock()
+_llm = None
+_cdt = None
+_cdt_match_cache = None
+_readiness = {"cdt_loaded": False, "llm_warm": False, "error": None}
+
+# Chat and embedding models stay loaded in Ollama between requests; the chat
+# model is warmed with the smallest num_ctx requests use so the first one doesn't reload it
+model_residency = ModelResidency()
+model_residency.pin(LLM_MODEL, LLM_KEEP_ALIVE, options={"num_ctx": PROMPT_MIN_CTX})
+model_residency.pin(EMBED_MODEL, EMBED_KEEP_ALIVE, kind="embed")
+
+def get_llm():
+    """LangChain Ollama wrapper, built on first use"""
+    global _llm
+    if _llm is None:
+        with _init_lock:
+            if _llm is None:
+                from langchain_community.llms import Ollama
+                _llm = Ollama(model=LLM_MODEL, keep_alive=LLM_KEEP_ALIVE, base_url=OLLAMA_BASE_URL)
+                log.info("✅ (Ollama) model loaded.")
+    return _llm
+
+def get_cdt():
+    """CDT embedder (catalog bundle + query cache), built on first use"""
+    global _cdt, _cdt_match_cache
+    if _cdt is None:
+        with _init_lock:
+            if _cdt is None:
+                from ollama_embedder import CDTEmbedder
+                embedder = CDTEmbedder(
+                    "New_CDT.xlsx",
+                    model_name=EMBED_MODEL,
+                    keep_alive=EMBED_KEEP_ALIVE,
+                    query_cache_size=QUERY_CACHE_SIZE,
+                    query_cache_ttl=QUERY_CACHE_TTL,
+                    query_cache_path=QUERY_CACHE_PATH
+                )
+                _cdt_match_cache = CDTMatchCache(CDT_MATCH_CACHE_PATH, cache_namespace(embedder, CDT_TOP_K))
+                _cdt = embedder
+                _readiness["cdt_loaded"] = True
+    return _cdt
+
+def get_cdt_match_cache():
+    get_cdt()
+    return _cdt_match_cache
+
+def embed_questions(texts):
+    """Unit-length question vectors for the answer cache.
+
+    Embedded directly rather than through the CDT query cache, so free-form
+    questions never push finding labels out of it.
+    """
+    from ollama_embedder import QUERY_INSTRUCTION, normalize_rows
+    response = get_client().embed(model=EMBED_MODEL, input=[f"{QUERY_INSTRUCTION}{text}" for text in texts],
+                                  keep_alive=EMBED_KEEP_ALIVE)
+    return normalize_rows(response["embeddings"])
 
-session_state = SessionState()
+def warm_up():
+    """Load the CDT catalog, load the chat and embedding models into Ollama memory and keep them there"""
+    try:
+        get_cdt()
+        model_residency.prewarm()
+        _readiness["llm_warm"] = True
+        _readiness["error"] = None
+        log.info("✅ %s warm (keep_alive=%s)", LLM_MODEL, LLM_KEEP_ALIVE)
+        model_residency.start()
+    except Exception as e:
+        _readiness["error"] = str(e)
+        log.warning("⚠️ Warm-up failed: %s", e)
+    return readiness()
+
+def readiness():
+    """Ready once the CDT index is loaded and the chat model has answered a warm-up call"""
+    state = dict(_readiness)
+    state["ready"] = state["cdt_loaded"] and state["llm_warm"]
+    return state
+
+# Session state, bounded by idle time, count and estimated memory (a cache when the backend is shared)
+session_state = SessionState(
+    ttl=SESSION_TTL,
+    max_sessions=SESSION_MAX_COUNT,
+    memory_budget=SESSION_MEMORY_BUDGET_MB * 1024 * 1024,
+    backend=create_session_backend(
+        SESSION_BACKEND,
+        sqlite_path=SESSION_SQLITE_PATH,
+        redis_url=SESSION_REDIS_URL,
+        ttl=SESSION_TTL
+    )
+)
+
+# Parallel CDT retrieval for uploads
+context_loader = ContextLoader()
+
+# Uploads loading in the background; a session's next question waits for its pending load
+context_jobs = ContextJobs()
+
+# Answers to repeat questions about the same case; reworded questions match by embedding
+answer_cache = AnswerCache(embed=embed_questions)
+
+# Treatment-plan rows, appended to JSONL segments off the request thread (export with audit_log.py)
+audit_log = AuditLog()
+
+log = get_logger("chat")
 
 # Helper functions
-def save_results_to_excel(new_rows, filename="medbot_output_claude.xlsx"):
-    df_new = pd.DataFrame(new_rows)
-    if os.path.exists(filename):
-        df_existing = pd.read_excel(filename)
-        df_combined = pd.concat([df_existing, df_new], ignore_index=True)
-    else:
-        df_combined = df_new
-    df_combined.to_excel(filename, index=False)
-    print(f"✅ Appended output saved to {filename}")
-
 def extract_anomalies(data):
     """Extract ONLY anomalies that have metadata"""
     findings = []
@@ -369,7 +342,7 @@ def transform_anomalies_for_llm(data, confidence_threshold=0.50):
         return result
         
     except Exception as e:
-        print(f"Error in transform_anomalies_for_llm: {str(e)}")
+        log.exception("Error in transform_anomalies_for_llm: %s", e)
         return {
             "anomalies_grouped": [],
             "suspected_anomalies": [],
@@ -379,24 +352,31 @@ def transform_anomalies_for_llm(data, confidence_threshold=0.50):
             "error": str(e)
         }
 
-def format_finding_matches(findings):
-    """Format ONLY findings with metadata for treatment plan"""
+def format_finding_matches(findings, matches=None):
+    """Format ONLY findings with metadata for treatment plan.
+
+    ``matches`` takes CDT records already retrieved per normalized
+    description (see load_case_context); otherwise they are looked up here.
+    """
     formatted = []
     output_records = []
     if not findings:
         return "No anomalies with metadata found.", []
+    # Retrieval is keyed by description only; the tooth number is added back below
+    if matches is None:
+        matches = cached_best_matches(get_cdt(), get_cdt_match_cache(), [f['description'] for f in findings], k=CDT_TOP_K)
     for finding in findings:
         text = f"Tooth {finding['tooth']}: {finding['description']}"
-        top_codes, _ = cdt.retrieve_best_match(text)
+        top_codes = matches[normalize_description(finding['description'])]
         lines = [f"Finding: {text}"]
         lines.append(f"Metadata: {json.dumps(finding['metadata'], indent=2)}")
         lines.append("Relevant CDT Codes:")
-        if top_codes.empty:
+        if not top_codes:
             lines.append("No matching CDT code found.")
             cdt_codes_str = "No matching CDT code found."
         else:
             cdt_codes = []
-            for _, row in top_codes.iterrows():
+            for row in top_codes:
                 lines.append(f"- {row['Code']}: {row['Description']}")
                 cdt_codes.append(row['Code'])
             cdt_codes_str = ", ".join(cdt_codes)
@@ -560,89 +540,28 @@ def json_to_full_text(data):
     return "\n".join(parts) if parts else "No dental findings detected"
 
 ### SIMPLIFIED CHAT FUNCTION (NO SQL) ###
-def enhanced_chat_with_medbot(
-    question: str,
-    chat_history: List[Tuple[str, str]],
-    session_id: str,
-    current_thread_data: Optional[dict] = None,
-    current_patient_id: Optional[str] = None,
-    patient_name: Optional[str] = None,
-    patient_history: Optional[List[dict]] = None
-) -> Tuple[str, List[Tuple[str, str]]]:
-    """
-    Enhanced chat function that works with data passed directly from MongoDB
-    """
-    current_thread = session_state.get_current_thread(session_id)
-    if not current_thread:
-        return "", chat_history
-    
-    # Update thread data if provided
-    if current_thread_data:
-        current_thread.update(current_thread_data)
-    
-    # Update session patient info if provided
-    session = session_state.get_session(session_id)
-    if current_patient_id and patient_name:
-        session_state.set_current_patient(session_id, current_patient_id, patient_name, patient_history)
-
-    # Get patient context
-    patient_context = session_state.get_patient_context(session_id)
-
-    # ===== 1. CHECK IF USER EXPLICITLY REQUESTS PAST JSONS =====
-    history_keywords = ["full history", "all past data", "complete json history", "raw visit data"]
-    is_history_request = any(keyword in question.lower() for keyword in history_keywords)
-    
-    if is_history_request:
-        history = session.get('patient_history', [])
-        if not history:
-            response = "No past visit data available."
-            chat_history.append((question, response))
-            return "", chat_history
-        
-        prompt = f"""
+# Placeholders for the variable-size prompt sections, filled to fit the token budget
+PATIENT_CONTEXT_SLOT = "\x00patient_context\x00"
+VISIT_DATA_SLOT = "\x00visit_data\x00"
+
+# Prompt layout: the static instructions come first, then the patient and case
+# data, and the question last. Follow-up questions about the same case then
+# share one long token prefix that Ollama keeps in its KV cache instead of
+# evaluating again, and the blocking and streaming paths send identical prompts.
+HISTORY_INSTRUCTIONS = """
 You are DentalMed AI. The user requested FULL PAST JSON DATA for analysis.
 
-**PATIENT**: {session['patient_name']}
-**TOTAL VISITS**: {len(history)}
-
 **INSTRUCTIONS**:
 1. Provide a structured overview of ALL raw JSON visits
 2. Highlight key changes in anomalies/procedures
 3. Do NOT summarize - show exact data differences
-
-**FULL VISIT DATA**:
-{json.dumps(history, indent=2)}
-
-**Question**: {question}
-
-Response:
+4. Include visit dates and patient progression
+5. Format as organized sections per visit
 """
-        try:
-            response = llm.invoke(prompt)
-            chat_history.append((question, response))
-            return "", chat_history
-        except Exception as e:
-            error_response = f"⚠️ Error loading full history: {str(e)}"
-            chat_history.append((question, error_response))
-            return "", chat_history
 
-    # ===== 2. VISIT COMPARISON PROMPT =====
-    comparison_keywords = ["compare visits", "visit comparison", "changes since", "progression", "compare findings"]
-    is_comparison_request = any(keyword in question.lower() for keyword in comparison_keywords)
-    
-    if is_comparison_request:
-        comparison_data = session_state.get_visit_comparison_data(session_id)
-        if isinstance(comparison_data, str):
-            response = f"❌ {comparison_data}"
-            chat_history.append((question, response))
-            return "", chat_history
-        
-        prompt = f"""
+COMPARISON_INSTRUCTIONS = """
 You are DentalMed AI. Analyze and compare multiple visits for this patient.
 
-**PATIENT**: {comparison_data['patient_name']}
-**VISITS TO COMPARE**: {len(comparison_data['visits'])} visits
-
 **COMPARISON ANALYSIS REQUIRED**:
 1. **New Findings**: What appeared in recent visits that wasn't present before?
 2. **Resolved Issues**: What findings from earlier visits are no longer present?
@@ -650,9 +569,6 @@ You are DentalMed AI. Analyze and compare multiple visits for this patient.
 4. **Treatment Effectiveness**: Based on findings, how effective were previous treatments?
 5. **Risk Assessment**: What patterns suggest increased/decreased risk?
 
-**VISIT DATA**:
-{json.dumps(comparison_data, indent=2)}
-
 **FORMAT YOUR RESPONSE AS**:
 
 ## 📊 Visit Comparison Analysis
@@ -660,7 +576,7 @@ You are DentalMed AI. Analyze and compare multiple visits for this patient.
 ### 🆕 New Findings
 - [List new findings with dates they first appeared]
 
-### ✅ Resolved Issues  
+### ✅ Resolved Issues
 - [List findings that are no longer present]
 
 ### 📈 Condition Progression
@@ -671,37 +587,16 @@ You are DentalMed AI. Analyze and compare multiple visits for this patient.
 
 ### ⚠️ Clinical Recommendations
 - [Based on patterns, what should be monitored/treated]
-
-**Your Question**: {question}
-
-Response:
 """
-        try:
-            response = llm.invoke(prompt)
-            if "Response:" in response:
-                response = response.split("Response:")[-1].strip()
-        except Exception as e:
-            response = f"⚠️ Error generating comparison: {str(e)}"
-        chat_history.append((question, response))
-        return "", chat_history
 
-    # ===== 3. GENERAL DENTAL QUESTIONS (NO JSONs) =====
-    general_dental_keywords = ["what is", "how to", "explain", "difference between", "standard treatment"]
-    is_general_question = any(keyword in question.lower() for keyword in general_dental_keywords)
-    
-    if is_general_question and current_thread['json_context'] is None:
-        prompt = f"""
+GENERAL_INSTRUCTIONS = """
 You are DentalMed AI, an expert dental assistant with comprehensive knowledge of:
 - Dental procedures and terminology
 - CDT codes and their applications
 - Common dental conditions and treatments
 - Best practices in dentistry
 
-{patient_context if patient_context else ""}
-
-Please provide a professional response to this question:
-
-Question: {question}
+Please provide a professional response to the question at the end.
 
 Guidelines:
 1. Be accurate and cite sources if possible
@@ -709,26 +604,9 @@ Guidelines:
 3. Include relevant CDT codes when appropriate
 4. For treatment questions, mention alternatives
 5. Keep responses under 200 words unless complex
-
-Response:
 """
-        try:
-            response = llm.invoke(prompt)
-            chat_history.append((question, response))
-            return "", chat_history
-        except Exception as e:
-            error_response = f"⚠️ Error answering general question: {str(e)}"
-            chat_history.append((question, error_response))
-            return "", chat_history
 
-    # ===== 4. TREATMENT PLAN (CURRENT JSON ONLY) =====
-    is_treatment_plan_request = any(keyword in question.lower() for keyword in 
-                                  ["treatment plan", "create treatment", "treatment recommendation", 
-                                   "cdt codes", "treatment codes"])
-    
-    if is_treatment_plan_request:
-        current_case_context = current_thread['json_context']
-        prompt = f"""
+TREATMENT_PLAN_INSTRUCTIONS = """
 You are MedBot, a precise dental assistant AI. Create a treatment plan ONLY for teeth with anomaly metadata.
 
 **STRICT INSTRUCTIONS**:
@@ -742,9 +620,6 @@ You are MedBot, a precise dental assistant AI. Create a treatment plan ONLY for
 5. If no CDT code is found, write: "No matching CDT code found."
 6. Provide ONLY the most clinically appropriate codes, not all possibilities.
 
-**Teeth with Metadata**:
-{current_thread['cdt_matches'] if current_thread['cdt_matches'] else "No teeth with metadata found"}
-
 **Output Format**:
 | Tooth | Finding Description | Metadata | Recommended CDT Codes |
 |-------|---------------------|----------|-----------------------|
@@ -752,63 +627,13 @@ You are MedBot, a precise dental assistant AI. Create a treatment plan ONLY for
 
 **Formatting Requirements**:
 1. Keep each cell content SHORT and concise
-2. Break long descriptions into key points only  
+2. Break long descriptions into key points only
 3. Each row should fit on one line
 
 **REMEMBER**: You are making clinical decisions - choose the most appropriate treatment.
-
-**Current Dental Case ONLY**:
-{current_case_context}
-
-**Available CDT Codes for Anomalies with Metadata**:
-{current_thread['cdt_matches']}
-
-**Your Request**: {question}
-
-Answer:
 """
-        if current_thread['findings']:
-            _, output_records = format_finding_matches(current_thread['findings'])
-            if output_records:
-                save_results_to_excel(output_records)
 
-    # ===== 5. DEFAULT PATIENT-SPECIFIC PROMPT =====
-    else:
-        # Parse current visit data to separate anomalies from procedures
-        current_data = current_thread.get('json_context', '')
-        current_anomalies = []
-        current_procedures = []
-        
-        # Extract current visit anomalies and procedures from json_context
-        if current_data:
-            try:
-                import json
-                # Try to parse the json_context if it's JSON format
-                if current_data.strip().startswith('{'):
-                    parsed_data = json.loads(current_data)
-                    for tooth in parsed_data.get('teeth', []):
-                        tooth_num = tooth.get('number', 'Unknown')
-                        for anomaly in tooth.get('anomalies', []):
-                            current_anomalies.append(f"Tooth {tooth_num}: {anomaly.get('description', 'Unknown anomaly')}")
-                        for procedure in tooth.get('procedures', []):
-                            current_procedures.append(f"Tooth {tooth_num}: {procedure.get('description', 'Unknown procedure')}")
-                else:
-                    # If it's text format, extract anomalies and procedures
-                    lines = current_data.split('\n')
-                    for line in lines:
-                        if 'Anomalies:' in line:
-                            current_anomalies.append(line.strip())
-                        elif 'Procedures:' in line:
-                            current_procedures.append(line.strip())
-            except:
-                # Fallback: treat entire context as anomalies if parsing fails
-                current_anomalies = [current_data] if current_data else []
-        
-        # Format the data sections
-        current_anomalies_text = "\n".join(current_anomalies) if current_anomalies else "No current anomalies detected"
-        current_procedures_text = "\n".join(current_procedures) if current_procedures else "No current procedures listed"
-        
-        prompt = f"""
+COMPREHENSIVE_INSTRUCTIONS = """
 You are DentalMed AI, a knowledgeable dental assistant AI with comprehensive access to patient information.
 
 **COMPREHENSIVE DATA AWARENESS:**
@@ -819,17 +644,6 @@ You have access to multiple types of patient data. It is ESSENTIAL that you unde
 3. **CURRENT VISIT FOREIGN OBJECTS** = Orthodontic appliances, implants, etc. detected in current visit
 4. **PATIENT HISTORY** = Historical data from previous visits (past findings and treatments)
 
-**CURRENT VISIT DATA:**
-{current_thread['json_context']}
-
-**PATIENT HISTORY** (Previous visits and treatments):
-{patient_context}
-
-**Available CDT Treatment Codes**:
-{current_thread['cdt_matches']}
-
-**Question**: {question}
-
 **CRITICAL: COMPREHENSIVE ANOMALY REPORTING**
 Regardless of the question type, you MUST ALWAYS:
 1. **FIRST**: Report ALL detected anomalies from the current visit data
@@ -878,31 +692,145 @@ You are now comprehensively aware of ALL patient data. Respond intelligently to
 - Provide evidence-based recommendations
 - Maintain professional dental terminology
 - **NEVER filter or omit any detected anomalies**
+"""
+
+
+def _fill_patient_context(prompt, session_id):
+    return fit_section(prompt, PATIENT_CONTEXT_SLOT,
+                       lambda budget: session_state.get_patient_context(session_id, max_tokens=budget))
+
+
+def _fill_visit_data(prompt, session_id):
+    return fit_section(prompt, VISIT_DATA_SLOT,
+                       lambda budget: session_state.get_visit_data(session_id, max_tokens=budget))
+
+
+def _history_prompt(session, question):
+    """Raw visit JSON for the whole history (VISIT_DATA_SLOT still to fill)"""
+    return f"""{HISTORY_INSTRUCTIONS}
+**PATIENT**: {session['patient_name']}
+**TOTAL VISITS**: {len(session['patient_history'])}
+
+**ALL VISIT DATA**:
+{VISIT_DATA_SLOT}
+
+**Question**: {question}
 
 **Response**:
 """
-    
+
+
+def _comparison_prompt(comparison_data, question):
+    """Visit comparison prompt built on the precomputed per-tooth diff instead of raw visit JSON"""
+    return f"""{COMPARISON_INSTRUCTIONS}
+**PATIENT**: {comparison_data['patient_name']}
+**VISITS TO COMPARE**: {len(comparison_data['visits'])} visits
+
+**VISIT DIFF** (already computed from the visit records: status compares the first and latest visit, confidences are first → latest):
+{format_diff_table(comparison_data)}
+
+**Your Question**: {question}
+
+Response:
+"""
+
+
+def _general_prompt(question):
+    """General dental question with the patient context (PATIENT_CONTEXT_SLOT still to fill)"""
+    return f"""{GENERAL_INSTRUCTIONS}
+{PATIENT_CONTEXT_SLOT}
+
+Question: {question}
+
+Response:
+"""
+
+
+def _treatment_plan_prompt(thread, question):
+    """Treatment plan for the current case only"""
+    return f"""{TREATMENT_PLAN_INSTRUCTIONS}
+**Teeth with Metadata and their Available CDT Codes**:
+{thread['cdt_matches'] if thread['cdt_matches'] else "No teeth with metadata found"}
+
+**Current Dental Case ONLY**:
+{thread['json_context']}
+
+**Your Request**: {question}
+
+Answer:
+"""
+
+
+def _comprehensive_prompt(thread, question):
+    """Current case plus patient history (PATIENT_CONTEXT_SLOT still to fill).
+
+    The history comes before the current visit: it changes least often, so
+    it stays in the cached prefix across uploads for the same patient.
+    """
+    return f"""{COMPREHENSIVE_INSTRUCTIONS}
+**PATIENT HISTORY** (Previous visits and treatments):
+{PATIENT_CONTEXT_SLOT}
+
+**CURRENT VISIT DATA:**
+{thread['json_context']}
+
+**Available CDT Treatment Codes**:
+{thread['cdt_matches']}
+
+**Question**: {question}
+
+**Response**:
+"""
+
+
+def _await_context(session_id):
+    """Wait for an upload still loading on the session; raise ContextNotReady if it times out or fails"""
+    job = context_jobs.join(session_id, CONTEXT_JOB_JOIN_TIMEOUT)
+    if job is not None and job.state != DONE:
+        raise ContextNotReady(job)
+
+
+def _answer_context(session_id, thread):
+    """Fingerprint of what an answer depends on besides the question: the loaded case, its CDT matches and the patient history"""
+    session = session_state.get_session(session_id)
+    # Reading the history loads it (and its fingerprint) on a session reloaded from a shared backend
+    session['patient_history']
+    return context_fingerprint(LLM_MODEL, thread.get('json_context'), thread.get('cdt_matches'),
+                               session['current_patient_id'], session['patient_name'],
+                               session.history_fingerprints[0])
+
+
+def _invoke_llm(prompt, priority, route, lookup=None, started=None):
+    """Blocking generation that waits its turn in the shared LLM scheduler, with num_ctx sized to the prompt.
+
+    With an answer-cache ``lookup`` a cached answer is returned without
+    generating, and a fresh answer is stored for the next time. ``started``
+    (perf_counter when the question came in) times the prompt build.
+    """
+    if lookup is not None and lookup.answer is not None:
+        log.info("♻️ Cached answer (%s, %s match)", route, lookup.match)
+        metrics.count_generation(route, "cached")
+        return lookup.answer
+    prompt_tokens, num_ctx = measure_prompt(route, prompt)
+    metrics.observe_prompt(route, prompt_tokens, started)
     try:
-        response = llm.invoke(prompt)
-        if "Answer:" in response:
-            response = response.split("Answer:")[-1].strip()
-        elif "Response:" in response:
-            response = response.split("Response:")[-1].strip()
-        
-        chat_history.append((question, response))
-        current_thread['chat_history'] = chat_history
-            
-    except Exception as e:
-        error_response = f"⚠️ Error processing your question: {str(e)}"
-        print(str(e))
-        chat_history.append((question, error_response))
-        current_thread['chat_history'] = chat_history
-    
-    return "", chat_history
+        with llm_scheduler.reserve(priority) as ticket:
+            metrics.observe_queue_wait(route, ticket)
+            with metrics.span("generate", route):
+                response = get_llm().invoke(prompt, num_ctx=num_ctx)
+    except QueueFullError:
+        metrics.count_generation(route, "rejected")
+        raise
+    except Exception:
+        metrics.count_generation(route, "error")
+        raise
+    metrics.count_generation(route, "ok")
+    if lookup is not None:
+        answer_cache.put(lookup, response)
+    return response
 
 
-### STREAMING CHAT FUNCTION ###
-def enhanced_chat_with_medbot_stream(
+def enhanced_chat_with_medbot(
     question: str,
     chat_history: List[Tuple[str, str]],
     session_id: str,
@@ -910,300 +838,434 @@ def enhanced_chat_with_medbot_stream(
     current_patient_id: Optional[str] = None,
     patient_name: Optional[str] = None,
     patient_history: Optional[List[dict]] = None
-):
+) -> Tuple[str, List[Tuple[str, str]]]:
     """
-    Streaming version of enhanced_chat_with_medbot that yields text chunks
+    Enhanced chat function that works with data passed directly from MongoDB
     """
+    started = time.perf_counter()
+    # A question asked while its upload is still loading answers from that upload
+    _await_context(session_id)
     current_thread = session_state.get_current_thread(session_id)
     if not current_thread:
-        yield "Error: No session found"
-        return
-    
+        return "", chat_history
+
     # Update thread data if provided
     if current_thread_data:
-        current_thread.update(current_thread_data)
-    
+        with session_state.locked(session_id):
+            current_thread.update(current_thread_data)
+
     # Update session patient info if provided
     session = session_state.get_session(session_id)
     if current_patient_id and patient_name:
         session_state.set_current_patient(session_id, current_patient_id, patient_name, patient_history)
-
-    # Get patient context
-    patient_context = session_state.get_patient_context(session_id)
+    answer_context = _answer_context(session_id, current_thread)
 
     # ===== 1. CHECK IF USER EXPLICITLY REQUESTS PAST JSONS =====
     history_keywords = ["full history", "all past data", "complete json history", "raw visit data"]
     is_history_request = any(keyword in question.lower() for keyword in history_keywords)
-    
+
     if is_history_request:
         history = session.get('patient_history', [])
         if not history:
-            yield "No past visit data available."
-            return
-        
-        prompt = f"""
-You are DentalMed AI. The user requested FULL PAST JSON DATA for analysis.
-
-**PATIENT**: {session['patient_name']}
-**TOTAL VISITS**: {len(history)}
+            response = "No past visit data available."
+            session_state.append_chat(session_id, chat_history, (question, response))
+            return "", chat_history
 
-**INSTRUCTIONS**:
-1. Provide a structured overview of ALL raw JSON visits
-2. Highlight key changes in anomalies/procedures
-3. Do NOT summarize - show exact data differences
-4. Include visit dates and patient progression
-5. Format as organized sections per visit
+        prompt = _fill_visit_data(_history_prompt(session, question), session_id)
+        try:
+            response = _invoke_llm(prompt, PRIORITY_BULK, "history",
+                                   answer_cache.lookup(answer_context, "history", question), started)
+            session_state.append_chat(session_id, chat_history, (question, response))
+            return "", chat_history
+        except QueueFullError:
+            raise
+        except Exception as e:
+            error_response = f"⚠️ Error loading full history: {str(e)}"
+            session_state.append_chat(session_id, chat_history, (question, error_response))
+            return "", chat_history
 
-**ALL VISIT DATA**:
-{json.dumps(history, indent=2)}
+    # ===== 2. VISIT COMPARISON PROMPT =====
+    comparison_keywords = ["compare visits", "visit comparison", "changes since", "progression", "compare findings"]
+    is_comparison_request = any(keyword in question.lower() for keyword in comparison_keywords)
 
-**Question**: {question}
+    if is_comparison_request:
+        comparison_data = session_state.get_visit_comparison_data(session_id)
+        if isinstance(comparison_data, str):
+            response = f"❌ {comparison_data}"
+            session_state.append_chat(session_id, chat_history, (question, response))
+            return "", chat_history
 
-**Response**:
-"""
+        prompt = _comparison_prompt(comparison_data, question)
         try:
-            # Use direct Ollama client for streaming
-            stream = ollama.chat(
-                model='mistral:latest',
-                messages=[{'role': 'user', 'content': prompt}],
-                stream=True
-            )
-            
-            for chunk in stream:
-                if chunk.get('message', {}).get('content'):
-                    content = chunk['message']['content']
-                    # Yield content directly for real-time streaming
-                    yield content
-            return
+            response = _invoke_llm(prompt, PRIORITY_BULK, "comparison",
+                                   answer_cache.lookup(answer_context, "comparison", question), started)
+            if "Response:" in response:
+                response = response.split("Response:")[-1].strip()
+        except QueueFullError:
+            raise
         except Exception as e:
-            yield f"⚠️ Error processing history request: {str(e)}"
-            return
+            response = f"⚠️ Error generating comparison: {str(e)}"
+        session_state.append_chat(session_id, chat_history, (question, response))
+        return "", chat_history
 
-    # ===== 2. GENERAL DENTAL QUESTIONS (NO JSONs) =====
+    # ===== 3. GENERAL DENTAL QUESTIONS (NO JSONs) =====
     general_dental_keywords = ["what is", "how to", "explain", "difference between", "standard treatment"]
     is_general_question = any(keyword in question.lower() for keyword in general_dental_keywords)
-    
-    if is_general_question and current_thread['json_context'] is None:
-        prompt = f"""
-You are DentalMed AI, an expert dental assistant with comprehensive knowledge of:
-- Dental procedures and terminology
-- CDT codes and their applications
-- Common dental conditions and treatments
-- Best practices in dentistry
-
-{patient_context if patient_context else ""}
-
-Please provide a professional response to this question:
 
-Question: {question}
-
-Guidelines:
-1. Be accurate and cite sources if possible
-2. Use simple language for patient questions
-3. Include relevant CDT codes when appropriate
-4. For treatment questions, mention alternatives
-5. Keep responses under 200 words unless complex
-
-Response:
-"""
+    if is_general_question and current_thread['json_context'] is None:
+        prompt = _fill_patient_context(_general_prompt(question), session_id)
         try:
-            # Use direct Ollama client for streaming
-            stream = ollama.chat(
-                model='mistral:latest',
-                messages=[{'role': 'user', 'content': prompt}],
-                stream=True
-            )
-            
-            for chunk in stream:
-                if chunk.get('message', {}).get('content'):
-                    content = chunk['message']['content']
-                    # Yield content directly for real-time streaming
-                    yield content
-            return
+            response = _invoke_llm(prompt, PRIORITY_STANDARD, "general",
+                                   answer_cache.lookup(answer_context, "general", question), started)
+            session_state.append_chat(session_id, chat_history, (question, response))
+            return "", chat_history
+        except QueueFullError:
+            raise
         except Exception as e:
-            yield f"⚠️ Error answering general question: {str(e)}"
-            return
+            error_response = f"⚠️ Error answering general question: {str(e)}"
+            session_state.append_chat(session_id, chat_history, (question, error_response))
+            return "", chat_history
 
-    # ===== 3. TREATMENT PLAN (CURRENT JSON ONLY) =====
-    is_treatment_plan_request = any(keyword in question.lower() for keyword in 
-                                  ["treatment plan", "create treatment", "treatment recommendation", 
+    # ===== 4. TREATMENT PLAN (CURRENT JSON ONLY) =====
+    is_treatment_plan_request = any(keyword in question.lower() for keyword in
+                                  ["treatment plan", "create treatment", "treatment recommendation",
                                    "cdt codes", "treatment codes"])
-    
+
     if is_treatment_plan_request:
-        current_case_context = current_thread['json_context']
-        prompt = f"""
-You are MedBot, a precise dental assistant AI. Create a treatment plan ONLY for teeth with anomaly metadata.
+        route, priority = "treatment_plan", PRIORITY_BULK
+        prompt = _treatment_plan_prompt(current_thread, question)
+        if current_thread['findings']:
+            _, output_records = format_finding_matches(current_thread['findings'])
+            if output_records:
+                audit_log.record(output_records, session_id=session_id,
+                                 patient_id=session.get('current_patient_id'), case=current_thread['name'])
 
-**STRICT INSTRUCTIONS**:
-1. ONLY include teeth where anomalies have metadata (ignore others)
-2. For each finding, provide:
-   - Tooth number
-   - Exact description from metadata
-   - Recommended CDT code(s)
-3. Format as a clean table
-4. Never invent data - skip if no metadata exists
-5. If no CDT code is found, write: "No matching CDT code found."
-6. Provide ONLY the most clinically appropriate codes, not all possibilities.
+    # ===== 5. DEFAULT PATIENT-SPECIFIC PROMPT =====
+    else:
+        route, priority = "comprehensive", PRIORITY_STANDARD
+        prompt = _fill_patient_context(_comprehensive_prompt(current_thread, question), session_id)
 
-**Teeth with Metadata**:
-{current_thread['cdt_matches'] if current_thread['cdt_matches'] else "No teeth with metadata found"}
+    try:
+        response = _invoke_llm(prompt, priority, route, answer_cache.lookup(answer_context, route, question),
+                               started)
+        if "Answer:" in response:
+            response = response.split("Answer:")[-1].strip()
+        elif "Response:" in response:
+            response = response.split("Response:")[-1].strip()
 
-**Output Format**:
-| Tooth | Finding Description | Metadata | Recommended CDT Codes |
-|-------|---------------------|----------|-----------------------|
-| ...   | ...                 | ...      | ...                   |
+        session_state.append_chat(session_id, chat_history, (question, response), thread=current_thread)
 
-**Formatting Requirements**:
-1. Keep each cell content SHORT and concise
-2. Break long descriptions into key points only  
-3. Each row should fit on one line
+    except QueueFullError:
+        raise
+    except Exception as e:
+        error_response = f"⚠️ Error processing your question: {str(e)}"
+        log.warning("⚠️ Answer failed (%s): %s", route, e)
+        session_state.append_chat(session_id, chat_history, (question, error_response), thread=current_thread)
 
-**REMEMBER**: You are making clinical decisions - choose the most appropriate treatment.
+    return "", chat_history
 
-**Current Dental Case ONLY**:
-{current_case_context}
 
-**Available CDT Codes for Anomalies with Metadata**:
-{current_thread['cdt_matches']}
+### STREAMING CHAT FUNCTION ###
+def _stream_reply(message, route=None, lookup=None):
+    """Stream plan for a reply that needs no generation: a fixed message or a cached answer (``lookup``)"""
+    return {"route": route, "prompt": None, "message": message, "error_prefix": None,
+            "prompt_tokens": None, "num_ctx": None, "lookup": lookup}
+
+
+def _stream_generation(route, prompt, error_prefix, answer_context, question, started=None):
+    lookup = answer_cache.lookup(answer_context, route, question)
+    if lookup.answer is not None:
+        log.info("♻️ Cached answer (%s, %s match)", route, lookup.match)
+        metrics.count_generation(route, "cached")
+        return _stream_reply(lookup.answer, route, lookup)
+    prompt_tokens, num_ctx = measure_prompt(route, prompt)
+    metrics.observe_prompt(route, prompt_tokens, started)
+    return {"route": route, "prompt": prompt, "message": None, "error_prefix": error_prefix,
+            "prompt_tokens": prompt_tokens, "num_ctx": num_ctx, "lookup": lookup}
+
+
+def _reply_chunks(plan):
+    """Chunks for a plan with no generation; cached answers replay word by word like a live stream"""
+    if plan["lookup"] is not None:
+        return replay_chunks(plan["message"])
+    return [plan["message"]]
+
+
+# Long bulk prompts queue behind answers a user is watching stream in
+STREAM_ROUTE_PRIORITIES = {
+    "history": PRIORITY_BULK,
+    "comparison": PRIORITY_BULK,
+    "treatment_plan": PRIORITY_BULK,
+    "general": PRIORITY_INTERACTIVE,
+    "comprehensive": PRIORITY_INTERACTIVE,
+}
+
+
+def reserve_stream_slot(plan):
+    """Queue a stream plan with the LLM scheduler (QueueFullError when full).
+
+    Routes call this before the response starts so a full queue can still be
+    answered with 429. Returns None for plans that need no generation.
+    """
+    if plan["prompt"] is None:
+        return None
+    try:
+        return llm_scheduler.reserve(STREAM_ROUTE_PRIORITIES[plan["route"]])
+    except QueueFullError:
+        metrics.count_generation(plan["route"], "rejected")
+        raise
 
-**Your Request**: {question}
 
-Answer:
-"""
-        try:
-            # Use direct Ollama client for streaming
-            stream = ollama.chat(
-                model='mistral:latest',
-                messages=[{'role': 'user', 'content': prompt}],
-                stream=True
-            )
-            
-            for chunk in stream:
-                if chunk.get('message', {}).get('content'):
-                    content = chunk['message']['content']
-                    # Yield content directly for real-time streaming
-                    yield content
-            return
-        except Exception as e:
-            yield f"⚠️ Error creating treatment plan: {str(e)}"
-            return
+def prepare_stream_request(
+    question: str,
+    chat_history: List[Tuple[str, str]],
+    session_id: str,
+    current_thread_data: Optional[dict] = None,
+    current_patient_id: Optional[str] = None,
+    patient_name: Optional[str] = None,
+    patient_history: Optional[List[dict]] = None
+):
+    """
+    Route a streaming question and build its prompt without calling the LLM.
 
-    # ===== 4. COMPREHENSIVE ANALYSIS (CURRENT + HISTORY) =====
-    current_case_context = current_thread['json_context']
-    patient_history_context = session.get('patient_history', [])
-    
-    # Debug: Print what data is being sent to LLM
-    print(f"🔍 DEBUG: current_case_context type: {type(current_case_context)}")
-    print(f"🔍 DEBUG: current_case_context content: {current_case_context}")
-    print(f"🔍 DEBUG: patient_history_context length: {len(patient_history_context)}")
-    print(f"🔍 DEBUG: Question: {question}")
-    
-    prompt = f"""
-You are DentalMed AI, a knowledgeable dental assistant AI with comprehensive access to patient information.
+    Returns a dict with "route", "prompt" and "error_prefix" for questions that
+    need generation, or "message" (prompt None) for a fixed reply or a cached
+    answer ("lookup" set). Shared by the sync and async streaming paths.
+    """
+    started = time.perf_counter()
+    _await_context(session_id)
+    current_thread = session_state.get_current_thread(session_id)
+    if not current_thread:
+        return _stream_reply("Error: No session found")
 
-**COMPREHENSIVE DATA AWARENESS:**
-You have access to multiple types of patient data. It is ESSENTIAL that you understand and appropriately respond to questions about any of these data types:
+    # Update thread data if provided
+    if current_thread_data:
+        with session_state.locked(session_id):
+            current_thread.update(current_thread_data)
 
-1. **CURRENT VISIT ANOMALIES** = New findings from today's X-ray analysis (conditions requiring attention)
-2. **CURRENT VISIT PROCEDURES** = Procedures performed during current visit (treatments done today)
-3. **CURRENT VISIT FOREIGN OBJECTS** = Orthodontic appliances, implants, etc. detected in current visit
-4. **PATIENT HISTORY** = Historical data from previous visits (past findings and treatments)
+    # Update session patient info if provided
+    session = session_state.get_session(session_id)
+    if current_patient_id and patient_name:
+        session_state.set_current_patient(session_id, current_patient_id, patient_name, patient_history)
+    answer_context = _answer_context(session_id, current_thread)
 
-**CURRENT VISIT DATA:**
-{current_case_context}
+    # ===== 1. CHECK IF USER EXPLICITLY REQUESTS PAST JSONS =====
+    history_keywords = ["full history", "all past data", "complete json history", "raw visit data"]
+    is_history_request = any(keyword in question.lower() for keyword in history_keywords)
 
-**PATIENT HISTORY** (Previous visits and treatments):
-{patient_context}
+    if is_history_request:
+        history = session.get('patient_history', [])
+        if not history:
+            return _stream_reply("No past visit data available.")
+        return _stream_generation("history", _fill_visit_data(_history_prompt(session, question), session_id),
+                                  "Error processing history request", answer_context, question, started)
 
-**Available CDT Treatment Codes**:
-{current_thread['cdt_matches']}
+    # ===== 2. VISIT COMPARISON (PRECOMPUTED DIFF) =====
+    comparison_keywords = ["compare visits", "visit comparison", "changes since", "progression", "compare findings"]
+    is_comparison_request = any(keyword in question.lower() for keyword in comparison_keywords)
 
-**Question**: {question}
+    if is_comparison_request:
+        comparison_data = session_state.get_visit_comparison_data(session_id)
+        if isinstance(comparison_data, str):
+            return _stream_reply(f"❌ {comparison_data}")
+        return _stream_generation("comparison", _comparison_prompt(comparison_data, question),
+                                  "Error generating comparison", answer_context, question, started)
 
-**CRITICAL: COMPREHENSIVE ANOMALY REPORTING**
-Regardless of the question type, you MUST ALWAYS:
-1. **FIRST**: Report ALL detected anomalies from the current visit data
-2. **THEN**: Provide your specific response to the question
-3. **NEVER**: Filter, omit, or selectively report anomalies based on question type
+    # ===== 3. GENERAL DENTAL QUESTIONS (NO JSONs) =====
+    general_dental_keywords = ["what is", "how to", "explain", "difference between", "standard treatment"]
+    is_general_question = any(keyword in question.lower() for keyword in general_dental_keywords)
 
-**INTELLIGENT RESPONSE GUIDELINES:**
-You are now comprehensively aware of ALL patient data. Respond intelligently to ANY question type:
+    if is_general_question and current_thread['json_context'] is None:
+        return _stream_generation("general", _fill_patient_context(_general_prompt(question), session_id),
+                                  "Error answering general question", answer_context, question, started)
 
-**For Anomaly Questions** ("what are the anomalies?", "what problems do you see?"):
-- Focus on CURRENT VISIT ANOMALIES only
-- Provide specific details about each anomaly
-- Suggest appropriate treatment options
+    # ===== 4. TREATMENT PLAN (CURRENT JSON ONLY) =====
+    is_treatment_plan_request = any(keyword in question.lower() for keyword in
+                                  ["treatment plan", "create treatment", "treatment recommendation",
+                                   "cdt codes", "treatment codes"])
 
-**For Procedure Questions** ("what procedures were done?", "what treatments exist?"):
-- Distinguish between current visit procedures vs historical procedures
-- Provide details about each procedure type and location
+    if is_treatment_plan_request:
+        return _stream_generation("treatment_plan", _treatment_plan_prompt(current_thread, question),
+                                  "Error creating treatment plan", answer_context, question, started)
 
-**For Foreign Object Questions** ("what appliances are present?", "what orthodontic work?"):
-- Reference CURRENT VISIT FOREIGN OBJECTS
-- Explain the purpose and implications of each object
+    # ===== 5. COMPREHENSIVE ANALYSIS (CURRENT + HISTORY) =====
+    # Sizes only: the case context and question are patient data
+    log.debug("🔍 Comprehensive prompt: %d case context chars, %d past visits",
+              len(current_thread['json_context'] or ""), len(session.get('patient_history', [])))
 
-**For General Questions** ("what do you see?", "summarize the findings"):
-- Provide a comprehensive overview of ALL current visit data
-- Organize by data type (anomalies, procedures, foreign objects)
-- Include relevant historical context
+    prompt = _fill_patient_context(_comprehensive_prompt(current_thread, question), session_id)
+    return _stream_generation("comprehensive", prompt, "Error processing your question", answer_context, question,
+                              started)
 
-**For Treatment Planning Questions** ("what should be done?", "recommendations?", "generate a treatment plan"):
-- **CRITICAL**: Report ALL CURRENT VISIT ANOMALIES first
-- Then consider ALL current findings (anomalies, procedures, foreign objects)
-- Provide evidence-based treatment recommendations for EACH finding
-- Reference appropriate CDT codes for EACH anomaly
 
-**For Comparison Questions** ("how has this changed?", "compare with previous visits"):
-- Use both current visit data and patient history
-- Highlight changes, improvements, or new concerns
+def _chunk_content(chunk):
+    return chunk.get('message', {}).get('content')
 
-**MANDATORY FORMAT FOR ALL RESPONSES:**
-1. **ANOMALIES DETECTED**: List ALL anomalies found in current visit
-2. **SPECIFIC RESPONSE**: Answer the user's question based on ALL findings
-3. **COMPREHENSIVE COVERAGE**: Ensure no findings are omitted
 
-**Always:**
-- Be specific about tooth numbers and conditions
-- Include confidence levels when available
-- Provide evidence-based recommendations
-- Maintain professional dental terminology
-- **NEVER filter or omit any detected anomalies**
+def enhanced_chat_with_medbot_stream(
+    question: str,
+    chat_history: List[Tuple[str, str]],
+    session_id: str,
+    current_thread_data: Optional[dict] = None,
+    current_patient_id: Optional[str] = None,
+    patient_name: Optional[str] = None,
+    patient_history: Optional[List[dict]] = None,
+    plan: Optional[dict] = None,
+    ticket=None
+):
+    """
+    Streaming version of enhanced_chat_with_medbot that yields text chunks
 
-**Response**:
-"""
-    
+    Pass ``plan`` and ``ticket`` (from prepare_stream_request and
+    reserve_stream_slot) when the caller already routed and queued the
+    request; otherwise both happen here.
+    """
+    if plan is None:
+        plan = prepare_stream_request(question, chat_history, session_id, current_thread_data,
+                                      current_patient_id, patient_name, patient_history)
+    if plan["prompt"] is None:
+        for chunk in _reply_chunks(plan):
+            yield chunk
+        return
+
+    stream = None
     try:
-        print(f"Starting LLM stream for comprehensive analysis")
-        chunk_count = 0
-        
-        # Use direct Ollama client for streaming
-        stream = ollama.chat(
-            model='mistral:latest',
-            messages=[{'role': 'user', 'content': prompt}],
-            stream=True
+        if ticket is None:
+            ticket = reserve_stream_slot(plan)
+        ticket.wait()
+        metrics.observe_queue_wait(plan["route"], ticket)
+        timer = metrics.StreamTimer(plan["route"])
+        log.info("Starting LLM stream (%s)", plan['route'])
+        stream = get_client().chat(
+            model=LLM_MODEL,
+            messages=[{'role': 'user', 'content': plan["prompt"]}],
+            stream=True,
+            options={"num_ctx": plan["num_ctx"]},
+            keep_alive=LLM_KEEP_ALIVE
         )
-        
+        parts = []
         for chunk in stream:
-            if chunk.get('message', {}).get('content'):
-                content = chunk['message']['content']
-                chunk_count += 1
-                print(f"LLM chunk {chunk_count}: {content[:30]}...")
-                
-                # Yield content directly for real-time streaming (no artificial delays)
+            content = _chunk_content(chunk)
+            if content:
+                timer.token()
+                parts.append(content)
+                if sample_chunk():
+                    log.debug("LLM chunk %d (%d chars)", len(parts), len(content))
                 yield content
-        
-        print(f"LLM streaming completed. Total chunks: {chunk_count}")
+            if chunk.get('done'):
+                report_prompt_eval(plan["route"], plan["prompt_tokens"], chunk.get('prompt_eval_count'))
+                model_residency.observe(LLM_MODEL, chunk, plan["route"])
+                timer.done(chunk)
+        log.info("LLM streaming completed (%s). Total chunks: %d", plan['route'], len(parts))
+        # Only answers streamed to the end are cached (not errors or abandoned streams)
+        answer_cache.put(plan["lookup"], "".join(parts))
+        metrics.count_generation(plan["route"], "ok")
     except Exception as e:
-        print(f"LLM streaming error: {str(e)}")
-        yield f"⚠️ Error processing your question: {str(e)}"
+        log.warning("⚠️ LLM streaming error (%s): %s", plan['route'], e)
+        metrics.count_generation(plan["route"], "error")
+        yield f"⚠️ {plan['error_prefix']}: {str(e)}"
+    finally:
+        # Closing the response on an early exit (client gone) stops Ollama generating
+        if stream is not None:
+            stream.close()
+        if ticket is not None:
+            ticket.release()
+
+
+async def enhanced_chat_with_medbot_astream(
+    question: str,
+    chat_history: List[Tuple[str, str]],
+    session_id: str,
+    current_thread_data: Optional[dict] = None,
+    current_patient_id: Optional[str] = None,
+    patient_name: Optional[str] = None,
+    patient_history: Optional[List[dict]] = None,
+    plan: Optional[dict] = None,
+    ticket=None
+):
+    """
+    Async version of enhanced_chat_with_medbot_stream on the Ollama AsyncClient.
 
+    Cancelling the consuming task closes the upstream HTTP response, which
+    aborts the generation in Ollama, and gives up the scheduler slot.
+    """
+    if plan is None:
+        plan = prepare_stream_request(question, chat_history, session_id, current_thread_data,
+                                      current_patient_id, patient_name, patient_history)
+    if plan["prompt"] is None:
+        for chunk in _reply_chunks(plan):
+            yield chunk
+        return
 
-def handle_json_text_input(json_text, chat_history, session_id):
+    stream = None
+    try:
+        if ticket is None:
+            ticket = reserve_stream_slot(plan)
+        await ticket.wait_async()
+        metrics.observe_queue_wait(plan["route"], ticket)
+        timer = metrics.StreamTimer(plan["route"])
+        log.info("Starting async LLM stream (%s)", plan['route'])
+        stream = await get_async_client().chat(
+            model=LLM_MODEL,
+            messages=[{'role': 'user', 'content': plan["prompt"]}],
+            stream=True,
+            options={"num_ctx": plan["num_ctx"]},
+            keep_alive=LLM_KEEP_ALIVE
+        )
+        parts = []
+        async for chunk in stream:
+            content = _chunk_content(chunk)
+            if content:
+                timer.token()
+                parts.append(content)
+                if sample_chunk():
+                    log.debug("LLM chunk %d (%d chars)", len(parts), len(content))
+                yield content
+            if chunk.get('done'):
+                report_prompt_eval(plan["route"], plan["prompt_tokens"], chunk.get('prompt_eval_count'))
+                model_residency.observe(LLM_MODEL, chunk, plan["route"])
+                timer.done(chunk)
+        log.info("LLM streaming completed (%s). Total chunks: %d", plan['route'], len(parts))
+        answer_cache.put(plan["lookup"], "".join(parts))
+        metrics.count_generation(plan["route"], "ok")
+    except Exception as e:
+        log.warning("⚠️ LLM streaming error (%s): %s", plan['route'], e)
+        metrics.count_generation(plan["route"], "error")
+        yield f"⚠️ {plan['error_prefix']}: {str(e)}"
+    finally:
+        if stream is not None:
+            await stream.aclose()
+        if ticket is not None:
+            ticket.release()
+
+
+def load_case_context(data, progress=None):
+    """(json_context, findings, cdt_matches) for an upload.
+
+    CDT retrieval for the findings starts first and runs on the context
+    loader's pool while the case text is rendered on this thread.
+    ``progress(stage, **info)`` is told about each step (see context_jobs).
+    """
+    findings = extract_anomalies(data)
+    pending = None
+    if findings:
+        pending = context_loader.start_matches(get_cdt(), get_cdt_match_cache(),
+                                               [f['description'] for f in findings], k=CDT_TOP_K,
+                                               progress=progress)
+    if progress is not None:
+        progress("rendering", findings=len(findings))
+    json_context = json_to_full_text(data)
+    if pending is None:
+        return json_context, findings, "No anomalies with metadata."
+    cdt_matches, _ = format_finding_matches(findings, pending.result())
+    return json_context, findings, cdt_matches
+
+
+def handle_json_text_input(json_text, chat_history, session_id, progress=None):
     """Handle JSON input - expects dict or string"""
-    current_thread = session_state.get_current_thread(session_id)
     session = session_state.get_session(session_id)
-    
-    if current_thread is None:
+    thread_id = session['current_thread']
+    if session['threads'].get(thread_id) is None:
         return chat_history, json_text
     
     try:
@@ -1212,34 +1274,64 @@ def handle_json_text_input(json_text, chat_history, session_id):
             
         # Handle both dict and string inputs
         if isinstance(json_text, str):
-            data = json.loads(json_text)
+            with metrics.span("json_parse"):
+                data = json.loads(json_text)
         else:
             data = json_text
         
-        # Store data in the CURRENT THREAD only
-        current_thread['json_context'] = json_to_full_text(data)
-        current_thread['findings'] = extract_anomalies(data)
-        current_thread['json_text'] = json.dumps(data) if isinstance(json_text, dict) else json_text
-        
-        if current_thread['findings']:
-            current_thread['cdt_matches'], _ = format_finding_matches(current_thread['findings'])
-            context_message = f"✅ Patient data loaded in case '{current_thread['name']}'\nFound {len(current_thread['findings'])} anomalies with metadata."
-        else:
-            current_thread['cdt_matches'] = "No anomalies with metadata."
-            context_message = f"✅ Patient data loaded in case '{current_thread['name']}'\nNo anomalies with metadata found."
-        
-        chat_history.append(("System", context_message))
-        current_thread['chat_history'] = chat_history
+        # Build the context first (CDT retrieval is slow), then store it in the
+        # CURRENT THREAD only, under the session lock
+        with metrics.span("context_load"):
+            json_context, findings, cdt_matches = load_case_context(data, progress)
+        if progress is not None:
+            progress("storing")
+
+        with session_state.locked(session_id) as session:
+            # Retrieval took a while: the record may have been reloaded or evicted meanwhile
+            current_thread = session['threads'].get(thread_id)
+            if current_thread is None:
+                raise ValueError("The case was closed while its upload was loading")
+            current_thread['json_context'] = json_context
+            current_thread['findings'] = findings
+            current_thread['cdt_matches'] = cdt_matches
+            if findings:
+                context_message = f"✅ Patient data loaded in case '{current_thread['name']}'\nFound {len(findings)} anomalies with metadata."
+            else:
+                context_message = f"✅ Patient data loaded in case '{current_thread['name']}'\nNo anomalies with metadata found."
+            session_state.append_chat(session_id, chat_history, ("System", context_message), thread=current_thread)
         
-        return chat_history, current_thread['json_text']
+        # The raw upload is not kept on the thread; callers get back what they sent
+        return chat_history, json_text
         
     except json.JSONDecodeError:
-        chat_history.append(("Error", "⚠️ Invalid JSON syntax."))
+        session_state.append_chat(session_id, chat_history, ("Error", "⚠️ Invalid JSON syntax."))
         return chat_history, json_text
     except Exception as e:
-        chat_history.append(("Error", f"⚠️ Error: {str(e)}"))
+        session_state.append_chat(session_id, chat_history, ("Error", f"⚠️ Error: {str(e)}"))
         return chat_history, json_text
 
+def start_context_job(json_text, session_id):
+    """Load an upload into the session's current case in the background; returns (ContextJob, started).
+
+    Sending the upload the session is already loading, or has loaded and
+    still holds, returns that job instead of repeating the CDT retrieval.
+    """
+    def load(job):
+        chat_history, _ = handle_json_text_input(json_text, [], session_id, progress=job.progress)
+        if not chat_history:
+            raise ValueError("No session found")
+        role, message = chat_history[-1]
+        if role == "Error":
+            raise ValueError(message.removeprefix("⚠️ "))
+        current_thread = session_state.get_current_thread(session_id)
+        return {"message": message, "case": current_thread['name'], "findings": len(current_thread['findings'] or [])}
+
+    def still_loaded():
+        current_thread = session_state.get_current_thread(session_id)
+        return current_thread is not None and current_thread.get('json_context') is not None
+
+    return context_jobs.start(session_id, context_fingerprint(json_text), load, still_loaded)
+
 def select_patient_with_persistence(patient_input, session_id, patient_history=None):
     """Handle patient selection with in-memory persistence"""
     if not patient_input.strip():
@@ -0,0 +1,207 @@
+import os
+import time
+import uuid
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from structured_log import get_logger
+
+# Uploads loaded at once per worker process, how long finished jobs stay
+# queryable (seconds), how many are kept, and how long a chat question waits
+# for a pending job on its session before it is turned away (ContextNotReady)
+CONTEXT_JOB_WORKERS = int(os.getenv("CONTEXT_JOB_WORKERS", "2"))
+CONTEXT_JOB_TTL = float(os.getenv("CONTEXT_JOB_TTL", "900"))
+CONTEXT_JOB_MAX = int(os.getenv("CONTEXT_JOB_MAX", "1000"))
+CONTEXT_JOB_JOIN_TIMEOUT = float(os.getenv("CONTEXT_JOB_JOIN_TIMEOUT", "60"))
+
+log = get_logger("context_jobs")
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class ContextNotReady(Exception):
+    """A question's pending upload was still loading after the join timeout, or failed to load"""
+
+    def __init__(self, job):
+        self.job = job
+        if job.state == FAILED:
+            message = f"The uploaded X-ray data could not be loaded: {job.error}"
+        else:
+            message = "The uploaded X-ray data is still loading; ask again when the context job finishes"
+        super().__init__(message)
+
+
+class ContextJob:
+    """One upload's context load: its state, progress events and result.
+
+    ``progress(stage, **info)`` is called by the loading code from any
+    thread; ``wait()`` blocks until the job finishes and ``events_since()``
+    lets a subscriber follow the progress events as they happen.
+    """
+
+    def __init__(self, session_id, fingerprint):
+        self.job_id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.fingerprint = fingerprint
+        self.state = QUEUED
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._events = [{"stage": QUEUED, "at": self.created_at}]
+        self._cond = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.state in (DONE, FAILED)
+
+    def progress(self, stage, **info):
+        with self._cond:
+            self._events.append({"stage": stage, "at": time.time(), **info})
+            self._cond.notify_all()
+
+    def _finish(self, state, result=None, error=None):
+        with self._cond:
+            self.state = state
+            self.result = result
+            self.error = error
+            self.finished_at = time.time()
+            self._events.append({"stage": state, "at": self.finished_at,
+                                 **({"error": error} if error else {})})
+            self._cond.notify_all()
+
+    def _run(self, load):
+        with self._cond:
+            self.state = RUNNING
+        self.progress(RUNNING)
+        try:
+            result = load(self)
+        except Exception as e:
+            log.warning("⚠️ Context job %s failed: %s", self.job_id, e)
+            self._finish(FAILED, error=str(e))
+        else:
+            self._finish(DONE, result=result)
+
+    def wait(self, timeout=None):
+        """Block until the job finishes; returns False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.finished, timeout)
+
+    def events_since(self, index, timeout=None):
+        """Progress events after the first ``index`` ones, waiting up to ``timeout`` for a new one"""
+        with self._cond:
+            self._cond.wait_for(lambda: len(self._events) > index or self.finished, timeout)
+            return self._events[index:]
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                "job_id": self.job_id,
+                "session_id": self.session_id,
+                "status": self.state,
+                "stage": self._events[-1]["stage"],
+                "events": list(self._events),
+                "result": self.result,
+                "error": self.error,
+                "created_at": self.created_at,
+                "finished_at": self.finished_at,
+            }
+
+
+class ContextJobs:
+    """Runs context loads in the background, one job per (session, upload).
+
+    Starting a job for the upload a session already has (loading or loaded)
+    returns that job instead of loading it again. Jobs live in this worker
+    process; their results are written to the session store like any upload.
+    """
+
+    def __init__(self, max_workers=CONTEXT_JOB_WORKERS, ttl=CONTEXT_JOB_TTL, max_jobs=CONTEXT_JOB_MAX):
+        self.max_workers = max(1, max_workers)
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()   # job_id -> ContextJob, oldest first
+        self._latest = {}            # session_id -> newest job for that session
+        self._executor = None
+        self._executor_pid = None
+        self._stats = {"started": 0, "reused": 0, "joined": 0}
+
+    def _pool(self):
+        # Pool threads don't survive a fork, so each worker process builds its own
+        pid = os.getpid()
+        if self._executor is None or self._executor_pid != pid:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="context-job")
+            self._executor_pid = pid
+        return self._executor
+
+    def _expire(self, now):
+        while self._jobs:
+            job = next(iter(self._jobs.values()))
+            expired = job.finished and now - job.finished_at > self.ttl
+            if not expired and len(self._jobs) <= self.max_jobs:
+                break
+            if not job.finished and len(self._jobs) <= self.max_jobs * 2:
+                break  # never drop a running job unless far over the cap
+            self._jobs.pop(job.job_id)
+            if self._latest.get(job.session_id) is job:
+                del self._latest[job.session_id]
+
+    def start(self, session_id, fingerprint, load, still_loaded=None):
+        """Run ``load(job)`` in the background unless this session's newest job is the same upload.
+
+        ``still_loaded()`` tells whether a finished job's result is still in
+        the session (it may have expired); if not, the upload loads again.
+        Returns (job, started).
+        """
+        with self._lock:
+            self._expire(time.time())
+            job = self._latest.get(session_id)
+            if (job is not None and job.fingerprint == fingerprint and job.state != FAILED
+                    and (not job.finished or still_loaded is None or still_loaded())):
+                self._stats["reused"] += 1
+                return job, False
+            job = ContextJob(session_id, fingerprint)
+            self._jobs[job.job_id] = job
+            self._latest[session_id] = job
+            self._stats["started"] += 1
+            pool = self._pool()
+        # The job logs under the request id that started it
+        pool.submit(contextvars.copy_context().run, job._run, load)
+        return job, True
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def join(self, session_id, timeout=CONTEXT_JOB_JOIN_TIMEOUT):
+        """Wait for the session's newest job if it's still loading; returns that job or None.
+
+        A failed job is returned to one caller only, so the next question
+        hears about the failure and later ones answer from the context the
+        session still has.
+        """
+        with self._lock:
+            job = self._latest.get(session_id)
+        if job is None:
+            return None
+        if not job.finished:
+            log.info("⏳ Waiting for context job %s", job.job_id)
+            with self._lock:
+                self._stats["joined"] += 1
+            job.wait(timeout)
+        if job.state == FAILED:
+            with self._lock:
+                if self._latest.get(session_id) is not job:
+                    return None
+                del self._latest[session_id]
+        return job
+
+    def stats(self):
+        with self._lock:
+            states = {}
+            for job in self._jobs.values():
+                states[job.state] = states.get(job.state, 0) + 1
+            return {"jobs": len(self._jobs), "states": states, "workers": self.max_workers, **self._stats}
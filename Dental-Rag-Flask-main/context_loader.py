@@ -0,0 +1,125 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from cdt_match_cache import normalize_description
+
+# Retrieval threads per worker process (0 = retrieve inline) and descriptions per retrieval call
+CONTEXT_LOADER_WORKERS = int(os.getenv("CONTEXT_LOADER_WORKERS", "4"))
+CONTEXT_LOADER_BATCH_SIZE = int(os.getenv("CONTEXT_LOADER_BATCH_SIZE", "8"))
+
+
+class PendingMatches:
+    """CDT matches still being retrieved; ``result()`` waits for them and fills the match cache"""
+
+    def __init__(self, loader, cache, matches, futures, started):
+        self._loader = loader
+        self._cache = cache
+        self._matches = matches
+        self._futures = futures
+        self._started = started
+        self._done = False
+
+    def result(self):
+        """{normalized description: records}"""
+        if not self._done:
+            fresh = {}
+            for keys, future in self._futures:
+                fresh.update(zip(keys, future.result()))
+            if fresh and self._cache is not None:
+                self._cache.put_many(fresh)
+            self._matches.update(fresh)
+            self._loader._record(len(fresh), time.perf_counter() - self._started)
+            self._done = True
+        return self._matches
+
+
+class ContextLoader:
+    """Runs CDT retrieval for an upload in the background while its context text is rendered.
+
+    Findings that share a description are looked up once, cached matches
+    come straight from the match cache, and the rest are split into batches
+    that embed and rank in parallel on a bounded thread pool.
+    """
+
+    def __init__(self, max_workers=CONTEXT_LOADER_WORKERS, batch_size=CONTEXT_LOADER_BATCH_SIZE):
+        self.max_workers = max_workers
+        self.batch_size = max(1, batch_size)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+        self._stats = {"loads": 0, "findings": 0, "unique": 0, "cached": 0, "retrieved": 0, "retrieval_seconds": 0.0}
+
+    def _pool(self):
+        # Pool threads don't survive a fork, so each worker process builds its own
+        pid = os.getpid()
+        if self._executor is None or self._executor_pid != pid:
+            with self._lock:
+                if self._executor is None or self._executor_pid != pid:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix="context-loader")
+                    self._executor_pid = pid
+        return self._executor
+
+    def start_matches(self, embedder, cache, descriptions, k=10, progress=None):
+        """Begin retrieving re-ranked CDT records for ``descriptions``; returns PendingMatches.
+
+        ``progress(stage, **info)`` hears "retrieving" once with the counts
+        and "retrieved" as each batch finishes.
+        """
+        started = time.perf_counter()
+        keys = list(dict.fromkeys(normalize_description(d) for d in descriptions))
+        matches = cache.get_many(keys) if cache is not None else {}
+        missing = [key for key in keys if key not in matches]
+        batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+        if progress is not None:
+            progress("retrieving", findings=len(descriptions), unique=len(keys),
+                     cached=len(keys) - len(missing), batches=len(batches))
+            finished = iter(range(1, len(batches) + 1))
+            report = lambda _: progress("retrieved", batches_done=next(finished), batches=len(batches))
+
+        futures = []
+        for batch in batches:
+            if self.max_workers > 0:
+                future = self._pool().submit(_rank_batch, embedder, batch, k)
+            else:
+                future = _Done(_rank_batch(embedder, batch, k))
+            if progress is not None:
+                future.add_done_callback(report)
+            futures.append((batch, future))
+
+        with self._lock:
+            self._stats["loads"] += 1
+            self._stats["findings"] += len(descriptions)
+            self._stats["unique"] += len(keys)
+            self._stats["cached"] += len(keys) - len(missing)
+        return PendingMatches(self, cache, matches, futures, started)
+
+    def _record(self, retrieved, seconds):
+        with self._lock:
+            self._stats["retrieved"] += retrieved
+            self._stats["retrieval_seconds"] += seconds
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.max_workers, "batch_size": self.batch_size, **self._stats}
+
+
+def _rank_batch(embedder, batch, k):
+    with metrics.span("cdt_retrieval"):
+        return embedder.rank_batch(batch, k)
+
+
+class _Done:
+    """An already-computed result with the Future interface PendingMatches reads"""
+
+    def __init__(self, value):
+        self._value = value
+
+    def result(self):
+        return self._value
+
+    def add_done_callback(self, fn):
+        fn(self)
@@ -0,0 +1,116 @@
+import os
+import time
+import atexit
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from structured_log import get_logger
+
+log = get_logger("embedding_cache")
+
+
+class EmbeddingCache:
+    """Bounded LRU (optionally TTL) cache of text -> embedding vector.
+
+    When ``path`` is given the cache is loaded from disk on start and written
+    back at interpreter exit. ``namespace`` guards against reusing vectors
+    produced by a different model or embedding setup.
+    """
+
+    def __init__(self, maxsize=4096, ttl=None, path=None, namespace=""):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.namespace = namespace
+        self._entries = OrderedDict()  # text -> (vector, stored_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.path:
+            self.load()
+            atexit.register(self.save)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expired(self, stored_at, now):
+        return self.ttl is not None and now - stored_at > self.ttl
+
+    def get(self, text):
+        with self._lock:
+            entry = self._entries.get(text)
+            if entry is None or self._expired(entry[1], time.time()):
+                if entry is not None:
+                    del self._entries[text]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(text)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, text, vector):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[text] = (vector, time.time())
+            self._entries.move_to_end(text)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def save(self):
+        """Write live entries to ``path`` (npz, no pickle)"""
+        if not self.path:
+            return
+        with self._lock:
+            now = time.time()
+            items = [(text, vec) for text, (vec, stored_at) in self._entries.items()
+                     if not self._expired(stored_at, now)]
+        if not items:
+            return
+        texts, vectors = zip(*items)
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(
+                    f,
+                    namespace=np.array(self.namespace),
+                    texts=np.array(texts),
+                    vectors=np.stack(vectors).astype(np.float32),
+                )
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.warning("⚠️ Could not save embedding cache to %s: %s", self.path, e)
+
+    def load(self):
+        if not self.path or self.maxsize <= 0 or not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                if str(data["namespace"]) != self.namespace:
+                    log.info("Ignoring embedding cache %s built for a different model", self.path)
+                    return
+                texts = data["texts"].tolist()
+                vectors = data["vectors"]
+        except (OSError, ValueError, KeyError) as e:
+            log.warning("⚠️ Could not load embedding cache from %s: %s", self.path, e)
+            return
+        now = time.time()
+        with self._lock:
+            for text, vector in zip(texts[-self.maxsize:], vectors[-self.maxsize:]):
+                self._entries[text] = (vector, now)
+        log.info("Loaded %d cached query embeddings from %s", len(self._entries), self.path)
@@ -0,0 +1,55 @@
+"""Gunicorn settings for serving the RAG API in production.
+
+    gunicorn -c gunicorn.conf.py
+
+Every value can be overridden from the environment. Use the ``gevent`` worker
+class for many concurrent SSE streams (one greenlet per stream), ``gthread``
+for a plain thread pool, or ``uvicorn_worker.UvicornWorker`` to serve the ASGI
+app (asgi.py), whose streams cancel the Ollama generation on disconnect.
+"""
+import os
+import threading
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+
+# gevent must patch the stdlib before the preloaded app imports anything
+if worker_class == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
+asgi_worker = worker_class.startswith("uvicorn")
+wsgi_app = "asgi:app" if asgi_worker else "wsgi:app"
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5001")
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "16"))  # gthread
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))  # gevent
+
+# Load the CDT catalog once in the master before forking
+preload_app = True
+
+# Streams stay open for the whole generation; keep idle connections around for the Node backend
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "75"))
+
+
+def post_fork(server, worker):
+    """Warm the chat model in each worker so /ready reflects that worker"""
+    # The preloaded app's log writer thread stayed behind in the master
+    from structured_log import setup_logging
+
+    setup_logging()
+    # The ASGI app warms up from its lifespan startup instead
+    if os.getenv("WARM_UP_ON_START", "1") == "0" or asgi_worker:
+        return
+    from claude_try import warm_up
+
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+def child_exit(server, worker):
+    """Drop a dead worker's live gauges from the shared Prometheus directory"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,198 @@
+import os
+import math
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+
+# Lower value = served first
+PRIORITY_INTERACTIVE = 0  # streamed answers a user is watching
+PRIORITY_STANDARD = 1     # non-streamed chat answers
+PRIORITY_BULK = 2         # history dumps, visit comparisons, treatment plans
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_STANDARD: "standard",
+    PRIORITY_BULK: "bulk",
+}
+
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "2"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "32"))
+
+# Assumed generation time until real ones have been observed
+_DEFAULT_SERVICE_TIME = 10.0
+
+
+class QueueFullError(Exception):
+    """Raised when a generation is rejected because the LLM queue is full"""
+
+    def __init__(self, priority, retry_after):
+        super().__init__(f"LLM queue is full ({PRIORITY_NAMES[priority]}), retry in {retry_after}s")
+        self.priority = priority
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """A place in the LLM queue, from reservation until the slot is released.
+
+    ``wait()`` / ``await wait_async()`` block until a generation slot is
+    granted. ``release()`` frees the slot, or gives up the place in the queue
+    if it was never granted, and is safe to call more than once. Tickets are
+    also (async) context managers.
+    """
+
+    def __init__(self, scheduler, priority):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.granted_at = None
+        self.released = False
+        self._event = threading.Event()
+        self._loop = None
+        self._future = None
+
+    def _grant(self):
+        # Called with the scheduler lock held
+        self.granted_at = time.monotonic()
+        self._event.set()
+        if self._future is not None:
+            self._loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self._future.done():
+            self._future.set_result(None)
+
+    def wait(self, timeout=None):
+        if not self._event.wait(timeout):
+            self.release()
+            raise TimeoutError("Timed out waiting for an LLM slot")
+
+    async def wait_async(self):
+        if self._event.is_set():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._future = self._loop.create_future()
+        if self._event.is_set():
+            return
+        try:
+            await self._future
+        except asyncio.CancelledError:
+            self.release()
+            raise
+
+    def release(self):
+        self.scheduler._release(self)
+
+    def __enter__(self):
+        self.wait()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    async def __aenter__(self):
+        await self.wait_async()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+
+class LLMScheduler:
+    """Admission control and priority queue for LLM generations.
+
+    At most ``max_in_flight`` generations run at once; the rest wait in
+    priority order (FIFO within a class). ``reserve`` rejects right away with
+    QueueFullError once ``max_queue`` requests are waiting, so callers can
+    answer 429 instead of piling more work onto Ollama.
+    """
+
+    def __init__(self, max_in_flight=LLM_MAX_IN_FLIGHT, max_queue=LLM_MAX_QUEUE):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._heap = []  # (priority, seq, ticket)
+        self._seq = itertools.count()
+        self._queued = 0
+        self._in_flight = 0
+        self._service_time = _DEFAULT_SERVICE_TIME  # moving average of slot hold time
+        self._classes = {
+            priority: {"admitted": 0, "rejected": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for priority in PRIORITY_NAMES
+        }
+
+    def reserve(self, priority=PRIORITY_STANDARD):
+        """Queue a generation and return its Ticket, or raise QueueFullError"""
+        with self._lock:
+            ticket = Ticket(self, priority)
+            if self._in_flight < self.max_in_flight and not self._queued:
+                self._admit(ticket)
+                return ticket
+            if self._queued >= self.max_queue:
+                self._classes[priority]["rejected"] += 1
+                raise QueueFullError(priority, self._retry_after())
+            heapq.heappush(self._heap, (priority, next(self._seq), ticket))
+            self._queued += 1
+            return ticket
+
+    def _admit(self, ticket):
+        self._in_flight += 1
+        ticket._grant()
+        wait = ticket.granted_at - ticket.enqueued_at
+        stats = self._classes[ticket.priority]
+        stats["admitted"] += 1
+        stats["wait_total"] += wait
+        stats["wait_max"] = max(stats["wait_max"], wait)
+
+    def _release(self, ticket):
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.granted_at is None:
+                # Gave up while queued; its heap entry is skipped when popped
+                self._queued -= 1
+                return
+            held = time.monotonic() - ticket.granted_at
+            self._service_time = 0.8 * self._service_time + 0.2 * held
+            self._in_flight -= 1
+            while self._heap and self._in_flight < self.max_in_flight:
+                _, _, waiter = heapq.heappop(self._heap)
+                if waiter.released:
+                    continue
+                self._queued -= 1
+                self._admit(waiter)
+
+    def _retry_after(self):
+        """Seconds until the current backlog should have drained"""
+        backlog = (self._queued + self._in_flight) / max(self.max_in_flight, 1)
+        return max(1, math.ceil(backlog * self._service_time))
+
+    def stats(self):
+        with self._lock:
+            classes = {}
+            waiting = {priority: 0 for priority in PRIORITY_NAMES}
+            for priority, _, ticket in self._heap:
+                if not ticket.released:
+                    waiting[priority] += 1
+            for priority, name in PRIORITY_NAMES.items():
+                stats = self._classes[priority]
+                classes[name] = {
+                    "admitted": stats["admitted"],
+                    "rejected": stats["rejected"],
+                    "waiting": waiting[priority],
+                    "wait_avg": stats["wait_total"] / stats["admitted"] if stats["admitted"] else 0.0,
+                    "wait_max": stats["wait_max"],
+                }
+            return {
+                "max_in_flight": self.max_in_flight,
+                "max_queue": self.max_queue,
+                "in_flight": self._in_flight,
+                "queued": self._queued,
+                "classes": classes,
+            }
+
+
+# Shared by every request path in this process
+llm_scheduler = LLMScheduler()
@@ -0,0 +1,110 @@
+import os
+import time
+from contextlib import contextmanager
+
+# Prometheus metrics are optional (pip install prometheus-client); without it every call here is a no-op
+try:
+    from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+                                   generate_latest, multiprocess)
+except ImportError:
+    Counter = Histogram = None
+
+# Upload stages are labelled with this route; chat stages with the prompt route
+UPLOAD_ROUTE = "upload"
+
+# Seconds, from a cached lookup to a long history generation
+_STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+_TOKEN_BUCKETS = (256, 512, 1024, 2048, 3072, 4096, 6144, 8192, 12288, 16384, 32768)
+_RATE_BUCKETS = (1, 2.5, 5, 7.5, 10, 15, 20, 30, 45, 60, 90, 120)
+
+enabled = Histogram is not None
+
+if enabled:
+    STAGE_SECONDS = Histogram(
+        "rag_stage_seconds", "Time spent in each stage of a request",
+        ["route", "stage"], buckets=_STAGE_BUCKETS)
+    PROMPT_TOKENS = Histogram(
+        "rag_prompt_tokens", "Estimated prompt size sent to the LLM",
+        ["route"], buckets=_TOKEN_BUCKETS)
+    TOKENS_PER_SECOND = Histogram(
+        "rag_llm_tokens_per_second", "Generation speed reported by Ollama (eval_count / eval_duration)",
+        ["route"], buckets=_RATE_BUCKETS)
+    GENERATED_TOKENS = Counter(
+        "rag_llm_generated_tokens", "Tokens generated by the LLM", ["route"])
+    GENERATIONS = Counter(
+        "rag_generations", "Answers by route and outcome (ok, cached, error, rejected)", ["route", "outcome"])
+
+
+def observe(stage, seconds, route=UPLOAD_ROUTE):
+    if enabled:
+        STAGE_SECONDS.labels(route=route, stage=stage).observe(seconds)
+
+
+@contextmanager
+def span(stage, route=UPLOAD_ROUTE):
+    """Time the enclosed block as ``stage`` (also when it raises)"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - started, route)
+
+
+def observe_prompt(route, tokens, build_started=None):
+    """A prompt ready to send: its size, and how long routing and building it took"""
+    if not enabled:
+        return
+    PROMPT_TOKENS.labels(route=route).observe(tokens)
+    if build_started is not None:
+        observe("prompt_build", time.perf_counter() - build_started, route)
+
+
+def observe_queue_wait(route, ticket):
+    """How long a granted scheduler ticket waited for its slot"""
+    if ticket is not None and ticket.granted_at is not None:
+        observe("queue_wait", ticket.granted_at - ticket.enqueued_at, route)
+
+
+def count_generation(route, outcome):
+    if enabled:
+        GENERATIONS.labels(route=route or "none", outcome=outcome).inc()
+
+
+def observe_ollama_done(route, chunk):
+    """Generation speed from Ollama's final response (eval_count over eval_duration)"""
+    if not enabled or not chunk:
+        return
+    eval_count = chunk.get("eval_count")
+    eval_duration = chunk.get("eval_duration")
+    if eval_count:
+        GENERATED_TOKENS.labels(route=route).inc(eval_count)
+        if eval_duration:
+            TOKENS_PER_SECOND.labels(route=route).observe(eval_count / (eval_duration / 1e9))
+
+
+class StreamTimer:
+    """Times one streamed generation: first token, then the whole stream"""
+
+    def __init__(self, route):
+        self.route = route
+        self.started = time.perf_counter()
+        self.first_token = None
+
+    def token(self):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+            observe("time_to_first_token", self.first_token - self.started, self.route)
+
+    def done(self, chunk):
+        observe("stream", time.perf_counter() - self.started, self.route)
+        observe_ollama_done(self.route, chunk)
+
+
+def render():
+    """(body, content type) for /metrics; every worker's metrics when PROMETHEUS_MULTIPROC_DIR is set"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
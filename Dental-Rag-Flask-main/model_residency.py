@@ -0,0 +1,158 @@
+import os
+import time
+import threading
+from collections import deque
+
+from ollama_client import get_client
+from structured_log import get_logger
+
+# Seconds between checks that reload a pinned model Ollama has unloaded (0 = no background checks)
+MODEL_RESIDENCY_INTERVAL = float(os.getenv("MODEL_RESIDENCY_INTERVAL", "60"))
+# A request whose load_duration exceeds this many seconds waited for the model to load
+MODEL_LOAD_EVENT_SECONDS = float(os.getenv("MODEL_LOAD_EVENT_SECONDS", "0.5"))
+
+log = get_logger("model_residency")
+
+# Load events kept for /health
+_EVENT_HISTORY = 50
+
+
+def model_key(name):
+    """Ollama reports untagged models as ':latest'"""
+    return name if ":" in name else f"{name}:latest"
+
+
+class ModelResidency:
+    """Keeps Ollama models loaded and reports when a request had to wait for a load.
+
+    Each pinned model is loaded on warm-up with its ``keep_alive``, and an
+    optional background thread checks Ollama's loaded models (``ps``) and
+    loads a pinned model again if it was unloaded, so the next user does
+    not pay for the cold start. Load events come from warm-ups, those
+    reloads and the ``load_duration`` Ollama reports on every response.
+    """
+
+    def __init__(self, interval=MODEL_RESIDENCY_INTERVAL, load_event_seconds=MODEL_LOAD_EVENT_SECONDS):
+        self.interval = interval
+        self.load_event_seconds = load_event_seconds
+        self._lock = threading.Lock()
+        self._models = {}
+        self._events = deque(maxlen=_EVENT_HISTORY)
+        self._keeper = None
+        self._keeper_pid = None
+        self._stop = threading.Event()
+
+    def pin(self, name, keep_alive, kind="chat", options=None):
+        """Keep ``name`` (a "chat" or "embed" model) loaded for ``keep_alive`` after each use.
+
+        ``options`` are the load options requests use (num_ctx): Ollama
+        reloads a model whose context size changes, so warm-ups match them.
+        """
+        with self._lock:
+            self._models[model_key(name)] = {
+                "name": name, "kind": kind, "keep_alive": keep_alive, "options": options,
+                "resident": None, "expires_at": None,
+                "loads": 0, "load_seconds": 0.0, "last_load_seconds": None, "unloads": 0,
+            }
+
+    def _record_load(self, key, seconds, reason):
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                model["loads"] += 1
+                model["load_seconds"] += seconds
+                model["last_load_seconds"] = round(seconds, 3)
+                model["resident"] = True
+            self._events.append({"model": key, "seconds": round(seconds, 3), "reason": reason, "at": time.time()})
+        log.info("🧊 %s loaded in %.1fs (%s)", key, seconds, reason)
+
+    def load(self, name, reason="warm-up"):
+        """Load a pinned model now (a no-op for Ollama if it already is) and return the seconds it took"""
+        key = model_key(name)
+        with self._lock:
+            model = dict(self._models[key])
+        client = get_client()
+        started = time.perf_counter()
+        if model["kind"] == "embed":
+            response = client.embed(model=model["name"], input=["warm-up"], keep_alive=model["keep_alive"])
+        else:
+            # An empty prompt loads the model without generating anything
+            response = client.generate(model=model["name"], prompt="", options=model["options"],
+                                       keep_alive=model["keep_alive"])
+        elapsed = time.perf_counter() - started
+        load_seconds = (response.get("load_duration") or 0) / 1e9 or elapsed
+        if load_seconds >= self.load_event_seconds:
+            self._record_load(key, load_seconds, reason)
+        else:
+            with self._lock:
+                self._models[key]["resident"] = True
+        return load_seconds
+
+    def prewarm(self):
+        """Load every pinned model, chat models first; raises if Ollama can't load one"""
+        with self._lock:
+            names = [m["name"] for m in sorted(self._models.values(), key=lambda m: m["kind"] != "chat")]
+        for name in names:
+            self.load(name, reason="warm-up")
+
+    def observe(self, name, response, route=None):
+        """Note the load_duration of a finished Ollama response (a cold start if it's long)"""
+        load_duration = response.get("load_duration") if response is not None else None
+        if not load_duration:
+            return
+        seconds = load_duration / 1e9
+        if seconds >= self.load_event_seconds:
+            self._record_load(model_key(name), seconds, f"request ({route})" if route else "request")
+
+    def check(self):
+        """Compare the pinned models with what Ollama has loaded and reload any that are missing"""
+        loaded = {model_key(m.get("model") or m.get("name")): m for m in get_client().ps().get("models") or []}
+        missing = []
+        with self._lock:
+            for key, model in self._models.items():
+                if key in loaded:
+                    model["resident"] = True
+                    expires_at = loaded[key].get("expires_at")
+                    model["expires_at"] = str(expires_at) if expires_at else None
+                else:
+                    if model["resident"]:
+                        model["unloads"] += 1
+                        self._events.append({"model": key, "seconds": None, "reason": "unloaded", "at": time.time()})
+                    model["resident"] = False
+                    model["expires_at"] = None
+                    missing.append(model["name"])
+        for name in missing:
+            log.warning("⚠️ %s is no longer loaded in Ollama, reloading", name)
+            self.load(name, reason="reload")
+        return missing
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                log.warning("⚠️ Model residency check failed: %s", e)
+
+    def start(self):
+        """Start the background residency checks in this process (once per worker; no-op when interval is 0)"""
+        if self.interval <= 0:
+            return
+        with self._lock:
+            pid = os.getpid()
+            if self._keeper is not None and self._keeper_pid == pid and self._keeper.is_alive():
+                return
+            self._stop.clear()
+            self._keeper_pid = pid
+            self._keeper = threading.Thread(target=self._run, name="model-residency", daemon=True)
+            self._keeper.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "interval": self.interval,
+                "models": {key: {k: v for k, v in model.items() if k != "name"} for key, model in self._models.items()},
+                "load_events": list(self._events)[-10:],
+            }
@@ -0,0 +1,46 @@
+import os
+import asyncio
+import threading
+
+import ollama
+
+_clients = {}
+_async_clients = {}
+_lock = threading.Lock()
+
+
+def get_client():
+    """Ollama client owned by the current process.
+
+    The module-level ``ollama.chat``/``ollama.embed`` share one HTTP pool that a
+    pre-forking server would copy into every worker; keying on the pid gives
+    each worker its own connections.
+    """
+    pid = os.getpid()
+    client = _clients.get(pid)
+    if client is None:
+        with _lock:
+            client = _clients.get(pid)
+            if client is None:
+                _clients.clear()
+                client = _clients[pid] = ollama.Client()
+    return client
+
+
+def get_async_client():
+    """Ollama ``AsyncClient`` for the running event loop in this process.
+
+    Its connection pool is bound to the loop that first uses it, so one client
+    is kept per (pid, loop). Must be called from a coroutine.
+    """
+    key = (os.getpid(), id(asyncio.get_running_loop()))
+    client = _async_clients.get(key)
+    if client is None:
+        with _lock:
+            client = _async_clients.get(key)
+            if client is None:
+                # Drop clients inherited from a parent process or a closed loop
+                for stale in [k for k in _async_clients if k[0] != key[0]]:
+                    del _async_clients[stale]
+                client = _async_clients[key] = ollama.AsyncClient()
+    return client
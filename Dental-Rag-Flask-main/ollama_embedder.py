@@ -1,55 +1,100 @@
-
-
 import os
-import pandas as pd
 import numpy as np
-from langchain_community.embeddings import OllamaEmbeddings
-from langchain.vectorstores import FAISS
-from langchain.docstore.document import Document
-from sklearn.metrics.pairwise import cosine_similarity
+from ollama_client import get_client
+from embedding_cache import EmbeddingCache
+from structured_log import get_logger
+from cdt_bundle import CatalogBundle, BundleError, EMBEDDING_CACHE_VERSION, catalog_key, load_catalog, write_bundle
+
+# Same instruction prefixes OllamaEmbeddings uses for documents and queries
+DOCUMENT_INSTRUCTION = "passage: "
+QUERY_INSTRUCTION = "query: "
+
+# Texts per /api/embed request when embedding the whole catalog
+EMBED_BATCH_SIZE = 64
+
+log = get_logger("cdt")
+
+
+def normalize_rows(matrix):
+    """Contiguous float32 copy with unit-length rows (zero rows stay zero)"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(matrix / norms)
+
 
 class CDTEmbedder:
-    def __init__(self, cdt_path="New_CDT.xlsx", model_name="nomic-embed-text:latest", index_path="faiss_cdt.index"):
+    # Re-ranking blend of exact cosine and keyword overlap
+    cosine_weight = 0.7
+    jaccard_weight = 0.3
+
+    def __init__(self, cdt_path="New_CDT.xlsx", model_name="nomic-embed-text:latest", bundle_path="cdt_catalog.bundle",
+                 query_cache_size=4096, query_cache_ttl=None, query_cache_path=None, rebuild=False, keep_alive=None):
         self.cdt_path = cdt_path
         self.model_name = model_name
-        self.index_path = index_path
-
-        # Load and preprocess CDT data
-        self.df = pd.read_excel(cdt_path)
-        self.df = self.df.rename(columns={
-            "Procedure Code": "Code",
-            "Description of Service": "Description",
-            "Keywords": "Keywords"
-        })
-        self.df = self.df.dropna(subset=['Code', 'Description'])
-        self.df['Keywords'] = self.df['Keywords'].fillna("").astype(str).str.lower().str.strip()
-
-        # Format text better before embedding
-        def format_text(row):
-            return (
-                f"CDT Code: {row['Code']}\n"
-                f"Service: {row['Description']}\n"
-                f"Keywords: {row['Keywords']}"
-            )
-
-        self.texts = self.df.apply(format_text, axis=1).tolist()
-
-        # Initialize Ollama embedding model
-        self.embedding = OllamaEmbeddings(model=model_name)
-
-        # Load or create FAISS index
-        if os.path.exists(self.index_path):
-            print(f"Loading FAISS index from {self.index_path}...")
-            self.vectorstore = FAISS.load_local(self.index_path, self.embedding, allow_dangerous_deserialization=True)
+        self.keep_alive = keep_alive
+        self.bundle_path = bundle_path
+
+        # Finding texts come from a small vocabulary, so query vectors are cached
+        self.query_cache = EmbeddingCache(
+            maxsize=query_cache_size,
+            ttl=query_cache_ttl,
+            path=query_cache_path,
+            namespace=f"{model_name}|{QUERY_INSTRUCTION}|{EMBEDDING_CACHE_VERSION}",
+        )
+
+        # The compiled bundle is keyed by catalog content + model. Without the
+        # spreadsheet (bundle-only deploys) the shipped bundle is trusted as-is.
+        self.bundle = None if rebuild else self._load_current_bundle()
+        if self.bundle is None:
+            log.info("Compiling CDT catalog bundle %s, this may take a moment...", self.bundle_path)
+            self._build_bundle()
+            self.bundle = CatalogBundle(self.bundle_path)
         else:
-            print("Creating FAISS index from documents, this may take a moment...")
-            docs = [Document(page_content=text) for text in self.texts]
-            self.vectorstore = FAISS.from_documents(docs, self.embedding)
-            print(f"Saving FAISS index to {self.index_path}...")
-            self.vectorstore.save_local(self.index_path)
-
-        # Precompute embeddings for re-ranking
-        self.embeddings_matrix = self.embedding.embed_documents(self.texts)
+            log.info("Loaded CDT catalog bundle %s (%d codes)", self.bundle_path, len(self.bundle))
+
+        self.cache_key = self.bundle.key
+        self.codes = self.bundle.codes
+        self.descriptions = self.bundle.descriptions
+        self.keyword_sets = self.bundle.keyword_sets
+        self.texts = self.bundle.texts
+
+        # Unit-length vectors straight from the mmap (zero-copy); they double as
+        # the exact inner-product search index and the re-ranking matrix
+        self.unit_matrix = self.bundle.vectors
+
+    def _load_current_bundle(self):
+        if not os.path.exists(self.bundle_path):
+            return None
+        try:
+            bundle = CatalogBundle(self.bundle_path)
+        except (OSError, ValueError, KeyError, BundleError) as e:
+            log.warning("⚠️ Ignoring unreadable CDT bundle %s: %s", self.bundle_path, e)
+            return None
+        if not os.path.exists(self.cdt_path):
+            return bundle
+        if bundle.key != catalog_key(self.cdt_path, self.model_name):
+            log.info("CDT bundle %s is stale (catalog or model changed)", self.bundle_path)
+            return None
+        return bundle
+
+    def _build_bundle(self):
+        """Parse the spreadsheet, embed every row once and write the bundle"""
+        codes, descriptions, keywords, texts = load_catalog(self.cdt_path)
+        vectors = np.concatenate([
+            self._embed_batch(texts[start:start + EMBED_BATCH_SIZE], DOCUMENT_INSTRUCTION)
+            for start in range(0, len(texts), EMBED_BATCH_SIZE)
+        ])
+        write_bundle(
+            self.bundle_path,
+            catalog_key(self.cdt_path, self.model_name),
+            self.model_name,
+            codes,
+            descriptions,
+            keywords,
+            texts,
+            normalize_rows(vectors),
+        )
 
     def _jaccard_similarity(self, set1, set2):
         if not set1 or not set2:
@@ -58,50 +103,87 @@ class CDTEmbedder:
         union = len(set1.union(set2))
         return intersection / union if union else 0.0
 
+    def _embed_batch(self, texts, instruction):
+        """Embed many texts with a single /api/embed request"""
+        response = get_client().embed(model=self.model_name, input=[f"{instruction}{text}" for text in texts],
+                                      keep_alive=self.keep_alive)
+        return np.asarray(response["embeddings"], dtype=np.float32)
+
+    def embed_queries(self, queries):
+        """Unit-length query vectors, embedding only texts missing from the cache"""
+        vectors = [self.query_cache.get(query) for query in queries]
+        missing = list(dict.fromkeys(q for q, vec in zip(queries, vectors) if vec is None))
+        if missing:
+            fresh = dict(zip(missing, normalize_rows(self._embed_batch(missing, QUERY_INSTRUCTION))))
+            for query, vec in fresh.items():
+                self.query_cache.put(query, vec)
+            vectors = [fresh[q] if vec is None else vec for q, vec in zip(queries, vectors)]
+        return np.ascontiguousarray(np.stack(vectors), dtype=np.float32)
+
+    def _search(self, query_vecs, k):
+        """Exact top-k rows by inner product (= cosine, = L2 order on unit vectors)"""
+        scores = query_vecs @ self.unit_matrix.T
+        k = min(k, scores.shape[1])
+        if k <= 0:
+            return np.empty((len(query_vecs), 0), dtype=np.intp)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable')
+        return np.take_along_axis(top, order, axis=1)
+
+    def _rerank(self, query, query_vec, rows, k):
+        """Score candidate rows against one unit-length query vector"""
+        if len(rows) == 0:
+            return []
+
+        # Exact cosine for all candidates in one matrix-vector product
+        cos_sims = self.unit_matrix[rows] @ query_vec
+
+        # Jaccard similarity on precomputed keyword sets
+        query_keywords = set(query.lower().split())
+        jac_sims = np.fromiter(
+            (self._jaccard_similarity(query_keywords, self.keyword_sets[row]) for row in rows),
+            dtype=np.float64,
+            count=len(rows),
+        )
+
+        scores = self.cosine_weight * cos_sims + self.jaccard_weight * jac_sims
+
+        # Sort by combined score descending (stable, like sorted(..., reverse=True))
+        order = np.argsort(-scores, kind='stable')[:k]
+        return [
+            {
+                "Code": self.codes[rows[i]],
+                "Description": self.descriptions[rows[i]],
+                "Cosine": float(cos_sims[i]),
+                "Jaccard": float(jac_sims[i]),
+                "Score": float(scores[i])
+            }
+            for i in order
+        ]
+
+    def rank_batch(self, queries, k=10):
+        """Re-ranked CDT records for many queries in one round-trip, in query order"""
+        if not queries:
+            return []
+
+        # Step 1: embed each query once (cache misses only, in one request);
+        # the same vector drives both the candidate search and the re-ranking
+        query_vecs = self.embed_queries(queries)
+
+        # Step 2: one multi-query search over the catalog matrix
+        candidates = self._search(query_vecs, k)
+
+        # Step 3: re-rank each query's candidates
+        return [self._rerank(query, query_vecs[i], candidates[i], k) for i, query in enumerate(queries)]
+
     def retrieve_best_match(self, query, k=10):
-        # Step 1: FAISS similarity search for initial candidates
-        results = self.vectorstore.similarity_search_with_score(query, k=k)
+        return self.retrieve_best_match_batch([query], k=k)[0]
 
-        # Embed query for exact cosine similarity
-        query_embedding = np.array(self.embedding.embed_query(query)).reshape(1, -1)
+    def retrieve_best_match_batch(self, queries, k=10):
+        """Retrieve and re-rank CDT codes for many queries in one round-trip.
 
-        re_ranked = []
-        query_keywords = set(query.lower().split())
+        Returns a list of (DataFrame, records) tuples in the same order as queries.
+        """
+        import pandas as pd
 
-        for doc, score in results:
-            lines = doc.page_content.split('\n')
-            if len(lines) >= 2:
-                # Extract code from first line "CDT Code: 1234"
-                code = lines[0].replace("CDT Code:", "").strip()
-                # Extract description from second line "Service: ... "
-                desc = lines[1].replace("Service:", "").strip()
-                # Extract keywords from third line if present
-                keywords_line = lines[2] if len(lines) > 2 else ""
-                candidate_keywords = set(keywords_line.replace("Keywords:", "").strip().split())
-
-                # Find index in original dataframe
-                idx = self.df[self.df['Code'].astype(str) == code].index[0]
-
-                # Calculate exact cosine similarity with precomputed embedding
-                candidate_emb = np.array(self.embeddings_matrix[idx]).reshape(1, -1)
-                cos_sim = cosine_similarity(query_embedding, candidate_emb)[0][0]
-
-                # Jaccard similarity on keywords
-                jac_sim = self._jaccard_similarity(query_keywords, candidate_keywords)
-
-                # Combine scores (weights can be tuned)
-                combined_score = 0.7 * cos_sim + 0.3 * jac_sim
-
-                re_ranked.append({
-                    "Code": code,
-                    "Description": desc,
-                    "Cosine": cos_sim,
-                    "Jaccard": jac_sim,
-                    "Score": combined_score
-                })
-
-        # Sort by combined score descending
-        re_ranked_sorted = sorted(re_ranked, key=lambda x: x['Score'], reverse=True)[:k]
-
-        # Convert to DataFrame
-        return pd.DataFrame(re_ranked_sorted), re_ranked_sorted
+        return [(pd.DataFrame(records), records) for records in self.rank_batch(queries, k=k)]
@@ -0,0 +1,103 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+from prompt_budget import PROMPT_RECENT_VISITS, RenderedVisit, fit_visits, render_visit_context, render_visit_json
+
+# Finished renderings (per history, budget and layout) and per-visit renderings kept in memory
+PATIENT_CONTEXT_CACHE_SIZE = int(os.getenv("PATIENT_CONTEXT_CACHE_SIZE", "512"))
+PATIENT_CONTEXT_VISIT_CACHE_SIZE = int(os.getenv("PATIENT_CONTEXT_VISIT_CACHE_SIZE", "20000"))
+
+# Budgets are rounded down to this step so follow-up questions of similar
+# length share one cached rendering
+_BUDGET_STEP = 256
+
+RENDERERS = {
+    "context": render_visit_context,  # patient context in chat prompts
+    "json": render_visit_json,        # raw visit data for the full-history route
+}
+
+
+def visit_fingerprint(visit):
+    encoded = json.dumps(visit, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    return hashlib.blake2b(encoded, digest_size=12).hexdigest()
+
+
+def fingerprint_history(history):
+    """(history fingerprint, per-visit fingerprints) for a visit list.
+
+    This walks the whole history, so it is computed once when a history is
+    set, not per question.
+    """
+    visits = tuple(visit_fingerprint(visit) for visit in history)
+    digest = hashlib.blake2b("\n".join(visits).encode("ascii"), digest_size=12).hexdigest()
+    return digest, visits
+
+
+EMPTY_HISTORY = fingerprint_history([])
+
+
+class PatientContextBuilder:
+    """Renders patient histories for prompts, cached by fingerprint.
+
+    Each visit is rendered and token-counted once and kept by its own
+    fingerprint, so a history that gained a visit only renders the new one.
+    Finished texts are kept by history fingerprint, layout and budget, so a
+    follow-up question on an unchanged history is a dict lookup.
+    """
+
+    def __init__(self, max_contexts=PATIENT_CONTEXT_CACHE_SIZE, max_visits=PATIENT_CONTEXT_VISIT_CACHE_SIZE):
+        self.max_contexts = max_contexts
+        self.max_visits = max_visits
+        self._lock = threading.Lock()
+        self._contexts = OrderedDict()
+        self._visits = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "visits_rendered": 0}
+
+    def render(self, history, fingerprints, budget=None, kind="context", recent=PROMPT_RECENT_VISITS):
+        """Tiered text for ``history`` (see prompt_budget.fit_visits) within ``budget`` tokens"""
+        history_fp, visit_fps = fingerprints
+        if budget is not None:
+            budget = budget // _BUDGET_STEP * _BUDGET_STEP
+        key = (history_fp, kind, recent, budget)
+        with self._lock:
+            text = self._contexts.get(key)
+            if text is not None:
+                self._contexts.move_to_end(key)
+                self._stats["hits"] += 1
+                return text
+            self._stats["misses"] += 1
+
+        rendered = [self._rendered_visit(fp, visit, kind) for fp, visit in zip(visit_fps, history)]
+        text, _ = fit_visits(history, budget, render_full=RENDERERS[kind], recent=recent, rendered=rendered)
+
+        with self._lock:
+            self._contexts[key] = text
+            while len(self._contexts) > self.max_contexts:
+                self._contexts.popitem(last=False)
+        return text
+
+    def _rendered_visit(self, fingerprint, visit, kind):
+        key = (fingerprint, kind)
+        with self._lock:
+            rendered = self._visits.get(key)
+            if rendered is not None:
+                self._visits.move_to_end(key)
+                return rendered
+        rendered = RenderedVisit(visit, RENDERERS[kind])
+        with self._lock:
+            self._visits[key] = rendered
+            self._stats["visits_rendered"] += 1
+            while len(self._visits) > self.max_visits:
+                self._visits.popitem(last=False)
+        return rendered
+
+    def stats(self):
+        with self._lock:
+            return {"contexts": len(self._contexts), "visits": len(self._visits), **self._stats}
+
+
+# Shared by every session in this process: one patient's history renders once
+patient_contexts = PatientContextBuilder()
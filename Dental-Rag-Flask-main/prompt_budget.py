@@ -0,0 +1,286 @@
+import os
+import re
+import json
+import math
+import threading
+
+from structured_log import get_logger
+
+# Largest context we ask Ollama for, and how much of it to keep free for the answer
+PROMPT_MAX_CTX = int(os.getenv("PROMPT_MAX_CTX", "8192"))
+PROMPT_MIN_CTX = int(os.getenv("PROMPT_MIN_CTX", "4096"))
+PROMPT_RESPONSE_TOKENS = int(os.getenv("PROMPT_RESPONSE_TOKENS", "1024"))
+# Newest visits kept verbatim in patient context; older ones become per-tooth summaries
+PROMPT_RECENT_VISITS = int(os.getenv("PROMPT_RECENT_VISITS", "2"))
+# Optional tokenizer.json for the chat model (needs the `tokenizers` package)
+PROMPT_TOKENIZER_PATH = os.getenv("PROMPT_TOKENIZER_PATH") or None
+
+# Upper bound for the single line that stands in for folded (dropped) visits
+_FOLD_TOKENS = 128
+
+# Words, single digits (SentencePiece splits numbers digit by digit), whitespace, other symbols
+_PIECES = re.compile(r"[A-Za-z]+|\d|\s+|[^\sA-Za-z\d]")
+
+log = get_logger("prompt_budget")
+
+
+class TokenCounter:
+    """Counts prompt tokens for the chat model.
+
+    Uses the model's own tokenizer when PROMPT_TOKENIZER_PATH points at one.
+    Otherwise it estimates from words, digits and symbols, and scales the
+    estimate by the ratio Ollama reports back (prompt_eval_count) so it
+    tracks the real tokenizer over time.
+    """
+
+    def __init__(self, tokenizer_path=PROMPT_TOKENIZER_PATH):
+        self._tokenizer = None
+        self._lock = threading.Lock()
+        self.scale = 1.0
+        if tokenizer_path:
+            try:
+                from tokenizers import Tokenizer
+                self._tokenizer = Tokenizer.from_file(tokenizer_path)
+                log.info("✅ Prompt tokenizer loaded from %s", tokenizer_path)
+            except Exception as e:
+                log.warning("⚠️ Prompt tokenizer unavailable (%s), estimating token counts", e)
+
+    @property
+    def mode(self):
+        return "tokenizer" if self._tokenizer is not None else "estimate"
+
+    def count(self, text):
+        if not text:
+            return 0
+        if self._tokenizer is not None:
+            return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+        return math.ceil(self.estimate(text) * self.scale)
+
+    @staticmethod
+    def estimate(text):
+        tokens = 0
+        for piece in _PIECES.findall(text):
+            first = piece[0]
+            if first.isalpha():
+                tokens += (len(piece) + 4) // 5
+            elif first.isspace():
+                tokens += piece.count("\n")  # spaces merge into the following word
+            else:
+                tokens += 1
+        return tokens
+
+    def calibrate(self, estimated, actual):
+        """Fold a real prompt_eval_count into the estimate's scale"""
+        if self._tokenizer is not None or not estimated or not actual:
+            return
+        ratio = min(2.0, max(0.5, actual / (estimated / self.scale)))
+        with self._lock:
+            self.scale = 0.9 * self.scale + 0.1 * ratio
+
+
+def context_size(prompt_tokens, response_tokens=PROMPT_RESPONSE_TOKENS):
+    """num_ctx for a prompt: room for it plus the answer, in power-of-two steps.
+
+    Ollama reloads the model whenever num_ctx changes, so sizes are bucketed
+    (PROMPT_MIN_CTX, x2, ... PROMPT_MAX_CTX) rather than exact.
+    """
+    num_ctx = PROMPT_MIN_CTX
+    while num_ctx < prompt_tokens + response_tokens and num_ctx < PROMPT_MAX_CTX:
+        num_ctx *= 2
+    return min(num_ctx, PROMPT_MAX_CTX)
+
+
+def available_tokens(fixed_tokens, response_tokens=PROMPT_RESPONSE_TOKENS):
+    """Tokens left for variable sections once the fixed part of a prompt is counted"""
+    return max(0, PROMPT_MAX_CTX - response_tokens - fixed_tokens)
+
+
+def visit_label(visit, index):
+    return f"Visit {index + 1} ({visit.get('timestamp', 'Unknown date')})"
+
+
+def summarize_visit(visit):
+    """Each tooth with its findings and confidences, on one line"""
+    teeth = {}
+    for finding in visit.get('findings') or []:
+        confidence = (finding.get('metadata') or {}).get('confidence')
+        label = finding.get('description', 'finding')
+        if isinstance(confidence, (int, float)):
+            label = f"{label} ({confidence:.2f})"
+        teeth.setdefault(finding.get('tooth', '?'), []).append(label)
+    if not teeth:
+        return "no findings"
+    return "; ".join(f"#{tooth} {', '.join(labels)}" for tooth, labels in teeth.items())
+
+
+def render_visit_context(visit):
+    """A visit in full, as listed in the patient context"""
+    lines = []
+    if visit.get('findings'):
+        lines.append(f"Findings: {json.dumps(visit['findings'])}")
+    if visit.get('cdt_matches'):
+        lines.append(f"CDT Matches: {visit['cdt_matches']}")
+    return "\n".join(lines)
+
+
+def render_visit_json(visit):
+    """A visit in full as raw JSON (compact separators: indentation costs tokens)"""
+    return json.dumps(visit, ensure_ascii=False)
+
+
+class RenderedVisit:
+    """A visit's full and summary text with their token counts; labels are added when joined"""
+
+    __slots__ = ("full", "full_tokens", "summary", "summary_tokens")
+
+    def __init__(self, visit, render_full=render_visit_context, counter=None):
+        counter = counter or token_counter
+        self.full = render_full(visit)
+        self.full_tokens = counter.count(self.full)
+        self.summary = summarize_visit(visit)
+        self.summary_tokens = counter.count(self.summary)
+
+
+def _fold_visits(history, start):
+    visits = history[start:]
+    teeth = sorted({str(f.get('tooth', '?')) for visit in visits for f in visit.get('findings') or []})
+    teeth_text = ", ".join(f"#{tooth}" for tooth in teeth[:32]) or "none"
+    first, last = visits[-1].get('timestamp', 'Unknown date'), visits[0].get('timestamp', 'Unknown date')
+    return (f"Visits {start + 1}-{len(history)} ({first} to {last}): "
+            f"{len(visits)} earlier visits not shown; teeth with findings: {teeth_text}")
+
+
+def fit_visits(history, budget=None, render_full=render_visit_context, recent=PROMPT_RECENT_VISITS,
+               counter=None, rendered=None):
+    """Render a newest-first visit list in tiers within ``budget`` tokens.
+
+    The ``recent`` newest visits are rendered in full and older ones as
+    one-line per-tooth summaries. While the text is over budget, the oldest
+    summaries are folded into a single closing line, then the full visits
+    drop to summaries (oldest first), then those are folded too.
+
+    ``rendered`` takes precomputed RenderedVisit objects for ``history`` so
+    callers can cache them. Returns (text, stats) with the visit count per
+    tier and the token total.
+    """
+    counter = counter or token_counter
+    if rendered is None:
+        rendered = [RenderedVisit(visit, render_full, counter) for visit in history]
+    n = len(history)
+    n_full = min(recent, n)
+    labels = [visit_label(visit, i) for i, visit in enumerate(history)]
+    # Label plus its "--- ... ---" or ": " and the line break
+    full_tokens = [counter.count(labels[i]) + 8 + rendered[i].full_tokens for i in range(n_full)]
+    summary_tokens = [counter.count(labels[i]) + 2 + rendered[i].summary_tokens for i in range(n)]
+
+    full_sum = sum(full_tokens)
+    summary_sum = sum(summary_tokens[n_full:])
+    n_kept = n
+
+    def total():
+        return full_sum + summary_sum + (_FOLD_TOKENS if n_kept < n else 0)
+
+    if budget is not None:
+        while total() > budget and n_kept > n_full:
+            n_kept -= 1
+            summary_sum -= summary_tokens[n_kept]
+        while total() > budget and n_full > 0:
+            n_full -= 1
+            full_sum -= full_tokens[n_full]
+            summary_sum += summary_tokens[n_full]
+        while total() > budget and n_kept > 0:
+            n_kept -= 1
+            summary_sum -= summary_tokens[n_kept]
+
+    parts = [f"--- {labels[i]} ---\n{rendered[i].full}".rstrip() for i in range(n_full)]
+    parts.extend(f"{labels[i]}: {rendered[i].summary}" for i in range(n_full, n_kept))
+    if n_kept < n:
+        parts.append(_fold_visits(history, n_kept))
+    text = "\n".join(parts)
+    return text, {
+        "visits": n,
+        "full": n_full,
+        "summarized": n_kept - n_full,
+        "folded": n - n_kept,
+        "tokens": total(),
+    }
+
+
+def fit_section(prompt, placeholder, render, counter=None):
+    """Fill ``placeholder`` with render(budget), sized to what the rest of the prompt leaves"""
+    counter = counter or token_counter
+    fixed = counter.count(prompt.replace(placeholder, ""))
+    return prompt.replace(placeholder, render(available_tokens(fixed)))
+
+
+class PromptStats:
+    """Per-route prompt sizes: estimated tokens, num_ctx used and Ollama's real counts"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def _route(self, route):
+        return self._routes.setdefault(route, {
+            "requests": 0, "tokens_total": 0, "tokens_max": 0, "num_ctx_max": 0, "over_budget": 0,
+            "actual_total": 0, "actual_requests": 0,
+        })
+
+    def record(self, route, tokens, num_ctx):
+        with self._lock:
+            stats = self._route(route)
+            stats["requests"] += 1
+            stats["tokens_total"] += tokens
+            stats["tokens_max"] = max(stats["tokens_max"], tokens)
+            stats["num_ctx_max"] = max(stats["num_ctx_max"], num_ctx)
+            if tokens + PROMPT_RESPONSE_TOKENS > num_ctx:
+                stats["over_budget"] += 1
+
+    def record_actual(self, route, actual):
+        with self._lock:
+            stats = self._route(route)
+            stats["actual_total"] += actual
+            stats["actual_requests"] += 1
+
+    def stats(self):
+        with self._lock:
+            routes = {}
+            for route, stats in self._routes.items():
+                routes[route] = {
+                    "requests": stats["requests"],
+                    "tokens_avg": stats["tokens_total"] / stats["requests"] if stats["requests"] else 0.0,
+                    "tokens_max": stats["tokens_max"],
+                    "num_ctx_max": stats["num_ctx_max"],
+                    "over_budget": stats["over_budget"],
+                    "actual_avg": (stats["actual_total"] / stats["actual_requests"]
+                                   if stats["actual_requests"] else None),
+                }
+        return {
+            "counter": token_counter.mode,
+            "estimate_scale": round(token_counter.scale, 3),
+            "max_ctx": PROMPT_MAX_CTX,
+            "response_tokens": PROMPT_RESPONSE_TOKENS,
+            "routes": routes,
+        }
+
+
+def measure_prompt(route, prompt):
+    """Count a finished prompt, pick its num_ctx and record both for the route"""
+    tokens = token_counter.count(prompt)
+    num_ctx = context_size(tokens)
+    prompt_stats.record(route, tokens, num_ctx)
+    log.info("📏 Prompt (%s): %d tokens, num_ctx=%d", route, tokens, num_ctx)
+    return tokens, num_ctx
+
+
+def report_prompt_eval(route, estimated, actual):
+    """Record Ollama's prompt_eval_count for a prompt we estimated at ``estimated`` tokens"""
+    if not actual:
+        return
+    prompt_stats.record_actual(route, actual)
+    token_counter.calibrate(estimated, actual)
+
+
+# Shared by every request path in this process
+token_counter = TokenCounter()
+prompt_stats = PromptStats()
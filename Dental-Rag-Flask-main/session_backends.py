@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+
+# Sessions are stored as a flat map of field name -> JSON value:
+#   "meta"                      current thread, patient, thread ids
+#   "history"                   patient visit history
+#   "thread:<id>"               thread header (name, patient/visit id, type)
+#   "thread:<id>:<field>"       large thread fields, loaded lazily
+# plus a version number that every write bumps, so workers can tell when
+# their cached copy of a session is stale.
+
+
+def encode(value):
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def decode(raw):
+    return json.loads(raw)
+
+
+class SessionBackend(ABC):
+    """Storage behind SessionState.
+
+    ``save`` writes several fields at once (a value of None deletes the
+    field) and returns the session's new version. ``version`` returns None
+    for sessions that do not exist or have expired.
+    """
+
+    persistent = True
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+
+    @abstractmethod
+    def version(self, session_id):
+        ...
+
+    @abstractmethod
+    def load(self, session_id, fields):
+        """{field: value} for the requested fields that exist"""
+
+    @abstractmethod
+    def save(self, session_id, values):
+        ...
+
+    @abstractmethod
+    def increment(self, session_id, counter):
+        """Atomically add one to an integer counter and return the new value"""
+
+    @abstractmethod
+    def delete(self, session_id):
+        ...
+
+
+class MemorySessionBackend(SessionBackend):
+    """Sessions live only in SessionState's own memory (per process, lost on restart)"""
+
+    persistent = False
+
+    def __init__(self, ttl=None):
+        super().__init__(ttl)
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def version(self, session_id):
+        return None
+
+    def load(self, session_id, fields):
+        return {}
+
+    def save(self, session_id, values):
+        return 0
+
+    def increment(self, session_id, counter):
+        with self._lock:
+            key = (session_id, counter)
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def delete(self, session_id):
+        with self._lock:
+            for key in [key for key in self._counters if key[0] == session_id]:
+                del self._counters[key]
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """Sessions in a local SQLite file, shared by every worker on the host"""
+
+    # Refresh a session's idle timer at most this often (fraction of the TTL)
+    TOUCH_FRACTION = 0.1
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path, ttl=None):
+        super().__init__(ttl)
+        self.path = path
+        self._local = threading.local()
+        self._last_purge = 0.0
+
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " session_id TEXT PRIMARY KEY,"
+                " version INTEGER NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_fields ("
+                " session_id TEXT NOT NULL,"
+                " field TEXT NOT NULL,"
+                " value BLOB NOT NULL,"
+                " PRIMARY KEY (session_id, field))"
+            )
+        self.purge_expired()
+
+    def _conn(self):
+        # One connection per thread and per process (workers may fork after init)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def purge_expired(self):
+        self._last_purge = time.time()
+        if self.ttl is None:
+            return
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            deadline = time.time() - self.ttl
+            conn.execute(
+                "DELETE FROM session_fields WHERE session_id IN"
+                " (SELECT session_id FROM sessions WHERE updated_at < ?)", (deadline,)
+            )
+            conn.execute("DELETE FROM sessions WHERE updated_at < ?", (deadline,))
+
+    def version(self, session_id):
+        now = time.time()
+        if now - self._last_purge > self.PURGE_INTERVAL:
+            self.purge_expired()
+        conn = self._conn()
+        row = conn.execute("SELECT version, updated_at FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        version, updated_at = row
+        if self.ttl is not None:
+            if now - updated_at > self.ttl:
+                self.delete(session_id)
+                return None
+            if now - updated_at > self.ttl * self.TOUCH_FRACTION:
+                conn.execute("UPDATE sessions SET updated_at = ? WHERE session_id = ?", (now, session_id))
+        return version
+
+    def load(self, session_id, fields):
+        fields = list(fields)
+        found = {}
+        conn = self._conn()
+        # Stay well under SQLite's bound-parameter limit
+        for start in range(0, len(fields), 500):
+            chunk = fields[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT field, value FROM session_fields WHERE session_id = ? AND field IN ({placeholders})",
+                [session_id, *chunk],
+            ).fetchall()
+            for field, value in rows:
+                found[field] = decode(value)
+        return found
+
+    def save(self, session_id, values):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT INTO sessions (session_id, version, updated_at) VALUES (?, 1, ?)"
+                " ON CONFLICT(session_id) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at",
+                (session_id, time.time()),
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO session_fields (session_id, field, value) VALUES (?, ?, ?)",
+                [(session_id, field, encode(value)) for field, value in values.items() if value is not None],
+            )
+            conn.executemany(
+                "DELETE FROM session_fields WHERE session_id = ? AND field = ?",
+                [(session_id, field) for field, value in values.items() if value is None],
+            )
+            return conn.execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()[0]
+
+    def increment(self, session_id, counter):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT value FROM session_fields WHERE session_id = ? AND field = ?", (session_id, counter)
+            ).fetchone()
+            value = (decode(row[0]) if row else 0) + 1
+            conn.execute(
+                "INSERT OR REPLACE INTO session_fields (session_id, field, value) VALUES (?, ?, ?)",
+                (session_id, counter, encode(value)),
+            )
+            return value
+
+    def delete(self, session_id):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM session_fields WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+
+class RedisSessionBackend(SessionBackend):
+    """Sessions in Redis (or anything speaking its hash commands), one hash per session.
+
+    Redis expires idle sessions itself: every read and write pushes the
+    key's expiry out by the TTL.
+    """
+
+    VERSION_FIELD = "__version__"
+
+    def __init__(self, client, ttl=None, prefix="dentalplan:session:"):
+        super().__init__(ttl)
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, ttl=None):
+        import redis
+
+        return cls(redis.Redis.from_url(url), ttl=ttl)
+
+    def _key(self, session_id):
+        return f"{self.prefix}{session_id}"
+
+    def _expire(self, pipe, key):
+        if self.ttl is not None:
+            pipe.expire(key, max(1, int(self.ttl)))
+
+    def version(self, session_id):
+        key = self._key(session_id)
+        pipe = self.client.pipeline()
+        pipe.hget(key, self.VERSION_FIELD)
+        self._expire(pipe, key)
+        version = pipe.execute()[0]
+        return None if version is None else int(version)
+
+    def load(self, session_id, fields):
+        fields = list(fields)
+        if not fields:
+            return {}
+        values = self.client.hmget(self._key(session_id), fields)
+        return {field: decode(value) for field, value in zip(fields, values) if value is not None}
+
+    def save(self, session_id, values):
+        key = self._key(session_id)
+        sets = {field: encode(value) for field, value in values.items() if value is not None}
+        deletes = [field for field, value in values.items() if value is None]
+        pipe = self.client.pipeline(transaction=True)
+        if sets:
+            pipe.hset(key, mapping=sets)
+        if deletes:
+            pipe.hdel(key, *deletes)
+        pipe.hincrby(key, self.VERSION_FIELD, 1)
+        self._expire(pipe, key)
+        results = pipe.execute()
+        return int(results[len(results) - 2 if self.ttl is not None else -1])
+
+    def increment(self, session_id, counter):
+        return int(self.client.hincrby(self._key(session_id), counter, 1))
+
+    def delete(self, session_id):
+        self.client.delete(self._key(session_id))
+
+
+def create_session_backend(kind, sqlite_path="sessions.sqlite3", redis_url=None, ttl=None):
+    """Backend for SESSION_BACKEND=memory|sqlite|redis"""
+    if kind == "memory":
+        return MemorySessionBackend(ttl)
+    if kind == "sqlite":
+        return SQLiteSessionBackend(sqlite_path, ttl=ttl)
+    if kind == "redis":
+        if not redis_url:
+            raise ValueError("SESSION_REDIS_URL is required for the redis session backend")
+        return RedisSessionBackend.from_url(redis_url, ttl=ttl)
+    raise ValueError(f"Unknown session backend {kind!r} (expected memory, sqlite or redis)")
@@ -0,0 +1,608 @@
+import time
+import threading
+from uuid import uuid4
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import List
+
+from patient_context import EMPTY_HISTORY, fingerprint_history, patient_contexts
+from prompt_budget import token_counter
+from session_backends import MemorySessionBackend
+from visit_diff import diff_visits
+
+
+def estimate_size(obj):
+    """Rough heap footprint in bytes of nested str/list/tuple/dict data.
+
+    Close enough to CPython's real object sizes to keep a memory budget,
+    without the cost of sys.getsizeof on every node.
+    """
+    if obj is None or obj is _UNLOADED or isinstance(obj, bool):
+        return 0
+    if isinstance(obj, str):
+        return 49 + len(obj)
+    if isinstance(obj, (int, float)):
+        return 28
+    if isinstance(obj, (list, tuple)):
+        return 56 + 8 * len(obj) + sum(estimate_size(item) for item in obj)
+    if isinstance(obj, dict):
+        return 64 + 24 * len(obj) + sum(estimate_size(k) + estimate_size(v) for k, v in obj.items())
+    return 64
+
+
+# Placeholder for a field that has not been read from the session backend yet
+_UNLOADED = object()
+
+# The current request (see begin_request); a cached session's backend version is checked once in it
+_request_scope = ContextVar("session_request_scope", default=None)
+
+
+def begin_request():
+    """Start a request scope, so each cached session is checked against a shared backend once per request.
+
+    Outside a scope (background jobs, scripts) every access checks.
+    """
+    _request_scope.set(object())
+
+
+def thread_field(thread_id, field=None):
+    """Backend field name for a thread's header, or for one of its large fields"""
+    return f"thread:{thread_id}" if field is None else f"thread:{thread_id}:{field}"
+
+
+class _Record:
+    """Fixed-field record that also supports the dict access the chat code uses.
+
+    Item access loads lazy fields on first read and writes changes through
+    to the session backend.
+    """
+
+    __slots__ = ()
+    FIELDS = ()
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        value = getattr(self, key)
+        if value is _UNLOADED:
+            value = self._load(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+        self._stored(key)
+
+    def __contains__(self, key):
+        return key in self.FIELDS
+
+    def get(self, key, default=None):
+        return self[key] if key in self.FIELDS else default
+
+    def update(self, values):
+        """Copy known fields from a dict; unknown keys (e.g. legacy 'json_text') are ignored"""
+        for key, value in dict(values).items():
+            if key in self.FIELDS:
+                self[key] = value
+
+    def _load(self, key):
+        raise KeyError(key)
+
+    def _stored(self, key):
+        pass
+
+
+class ThreadRecord(_Record):
+    """One case thread. Patient history lives on the session, not on every thread.
+
+    The small header fields are always loaded; the large ones are fetched
+    from the backend the first time they are read.
+    """
+
+    HEADER_FIELDS = ('name', 'patient_id', 'visit_id', 'thread_type')
+    LAZY_FIELDS = ('json_context', 'cdt_matches', 'findings', 'chat_history')
+    FIELDS = LAZY_FIELDS + HEADER_FIELDS
+    __slots__ = FIELDS + ('thread_id', 'session')
+
+    def __init__(self, name, patient_id=None, visit_id=None, thread_type='scenario', lazy=False):
+        self.json_context = _UNLOADED if lazy else None
+        self.cdt_matches = _UNLOADED if lazy else None
+        self.findings = _UNLOADED if lazy else None
+        self.chat_history = _UNLOADED if lazy else []
+        self.name = name
+        self.patient_id = patient_id
+        self.visit_id = visit_id
+        self.thread_type = thread_type
+        self.thread_id = None
+        self.session = None  # set when added to a SessionRecord
+
+    def header(self):
+        return {field: getattr(self, field) for field in self.HEADER_FIELDS}
+
+    def snapshot(self):
+        """Backend fields for every loaded value of this thread"""
+        values = {thread_field(self.thread_id): self.header()}
+        for field in self.LAZY_FIELDS:
+            value = getattr(self, field)
+            if value is not _UNLOADED:
+                values[thread_field(self.thread_id, field)] = value
+        return values
+
+    def _load(self, key):
+        value = self.session.load_field(thread_field(self.thread_id, key)) if self.session else None
+        if value is None and key == 'chat_history':
+            value = []
+        setattr(self, key, value)
+        return value
+
+    def _stored(self, key):
+        if self.session is None:
+            return
+        if key in self.HEADER_FIELDS:
+            self.session.persist({thread_field(self.thread_id): self.header()})
+        else:
+            self.session.persist({thread_field(self.thread_id, key): getattr(self, key)})
+
+    def estimate_size(self):
+        return 64 + 8 * len(self.__slots__) + sum(
+            estimate_size(getattr(self, field)) for field in self.LAZY_FIELDS + ('name',)
+        )
+
+
+class SessionRecord(_Record):
+    """A chat session; every change is written through to the session backend"""
+
+    META_FIELDS = ('current_thread', 'current_patient_id', 'patient_name')
+    FIELDS = ('threads', 'patient_history') + META_FIELDS
+    __slots__ = FIELDS + ('session_id', 'backend', 'version', 'checked_in', 'last_access', 'size',
+                          'history_size', 'history_fingerprints', 'lock')
+
+    def __init__(self, session_id, backend, lock=None):
+        self.session_id = session_id
+        self.backend = backend
+        self.version = 0
+        self.checked_in = None  # request scope in which the version was last checked against the backend
+        self.threads = {}
+        self.current_thread = 'default'
+        self.current_patient_id = None
+        self.patient_name = None
+        self.patient_history = []
+        self.last_access = time.monotonic()
+        self.size = 0
+        self.history_size = 0  # measured once when the history is set or loaded
+        self.history_fingerprints = EMPTY_HISTORY  # keys the cached patient context, set with the history
+        self.lock = lock or threading.RLock()
+
+    @classmethod
+    def create(cls, session_id, backend, lock=None):
+        session = cls(session_id, backend, lock)
+        session.add_thread('default', ThreadRecord('Default Case'))
+        return session
+
+    @classmethod
+    def load(cls, session_id, backend, lock=None):
+        """Session header and thread headers from the backend, or None if it has none"""
+        version = backend.version(session_id)
+        if version is None:
+            return None
+        meta = backend.load(session_id, ["meta"]).get("meta")
+        if meta is None:
+            return None
+
+        session = cls(session_id, backend, lock)
+        session.version = version
+        session.current_thread = meta["current_thread"]
+        session.current_patient_id = meta["current_patient_id"]
+        session.patient_name = meta["patient_name"]
+        session.patient_history = _UNLOADED
+
+        headers = backend.load(session_id, [thread_field(thread_id) for thread_id in meta["threads"]])
+        for thread_id in meta["threads"]:
+            header = headers.get(thread_field(thread_id)) or {}
+            thread = ThreadRecord(
+                header.get('name', thread_id),
+                patient_id=header.get('patient_id'),
+                visit_id=header.get('visit_id'),
+                thread_type=header.get('thread_type', 'scenario'),
+                lazy=True
+            )
+            thread.thread_id = thread_id
+            thread.session = session
+            session.threads[thread_id] = thread
+        return session
+
+    def meta(self):
+        return {
+            "current_thread": self.current_thread,
+            "current_patient_id": self.current_patient_id,
+            "patient_name": self.patient_name,
+            "threads": list(self.threads),
+        }
+
+    def persist(self, values):
+        if not self.backend.persistent:
+            return
+        version = self.backend.save(self.session_id, values)
+        self.version = max(self.version, version)
+
+    def load_field(self, field):
+        if not self.backend.persistent:
+            return None
+        return self.backend.load(self.session_id, [field]).get(field)
+
+    def next_thread_number(self):
+        # Counted in the backend so ids stay unique across workers sharing it
+        return self.backend.increment(self.session_id, "thread_seq")
+
+    def add_thread(self, thread_id, thread, make_current=False):
+        thread.thread_id = thread_id
+        thread.session = self
+        self.threads[thread_id] = thread
+        if make_current:
+            self.current_thread = thread_id
+        self.persist({"meta": self.meta(), **thread.snapshot()})
+
+    def remove_thread(self, thread_id):
+        del self.threads[thread_id]
+        if self.current_thread == thread_id:
+            self.current_thread = 'default' if 'default' in self.threads else next(iter(self.threads.keys()), None)
+        removed = {thread_field(thread_id): None}
+        removed.update({thread_field(thread_id, field): None for field in ThreadRecord.LAZY_FIELDS})
+        self.persist({"meta": self.meta(), **removed})
+
+    def _load(self, key):
+        # Only the patient history is lazy at session level
+        history = self.load_field("history") or []
+        self.patient_history = history
+        self.history_size = estimate_size(history)
+        self.history_fingerprints = fingerprint_history(history)
+        return history
+
+    def _stored(self, key):
+        if key == 'patient_history':
+            self.history_size = estimate_size(self.patient_history)
+            self.history_fingerprints = fingerprint_history(self.patient_history)
+            self.persist({"history": self.patient_history})
+        else:
+            self.persist({"meta": self.meta()})
+
+    def estimate_size(self):
+        # Snapshot the dict: other requests may add threads while this runs
+        return 256 + self.history_size + sum(
+            estimate_size(thread_id) + thread.estimate_size() for thread_id, thread in list(self.threads.items())
+        )
+
+
+class _SessionShard:
+    """One stripe of the session map: its own LRU order, lock and share of the limits"""
+
+    def __init__(self, state):
+        self.state = state
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()
+        self.total_size = 0
+        self.last_touched = None
+        self.evictions = {"ttl": 0, "lru": 0, "memory": 0}
+
+    def _remeasure(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            return
+        size = session.estimate_size()
+        self.total_size += size - session.size
+        session.size = size
+
+    def drop(self, session_id, reason=None):
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return
+        self.total_size -= session.size
+        if not self.state.backend.persistent:
+            # This record was the only copy; its thread counter goes with it
+            self.state.backend.delete(session_id)
+        if reason:
+            self.evictions[reason] += 1
+
+    def _evict(self, keep):
+        """Expire idle sessions, then trim to the count cap and memory budget (never ``keep``)"""
+        ttl = self.state.ttl
+        max_sessions = self.state._per_shard(self.state.max_sessions)
+        memory_budget = self.state._per_shard(self.state.memory_budget)
+        if ttl is not None:
+            deadline = time.monotonic() - ttl
+            while self.sessions:
+                session_id, session = next(iter(self.sessions.items()))
+                if session_id == keep or session.last_access >= deadline:
+                    break
+                self.drop(session_id, "ttl")
+        while max_sessions is not None and len(self.sessions) > max_sessions:
+            session_id = next(iter(self.sessions))
+            if session_id == keep:
+                break
+            self.drop(session_id, "lru")
+        while memory_budget is not None and self.total_size > memory_budget and len(self.sessions) > 1:
+            session_id = next(iter(self.sessions))
+            if session_id == keep:
+                break
+            self.drop(session_id, "memory")
+
+    def _touch(self, session_id, session):
+        self.sessions.move_to_end(session_id)
+        session.last_access = time.monotonic()
+        self._evict(keep=session_id)
+        return session
+
+    def _insert(self, session_id, session):
+        self.sessions[session_id] = session
+        self._remeasure(session_id)
+        return self._touch(session_id, session)
+
+    def get(self, session_id, refresh=False):
+        """The cached record, checked against a shared backend once per request (always with ``refresh``)"""
+        backend = self.state.backend
+        scope = _request_scope.get()
+        with self.lock:
+            # Repeat hits on the same session skip the walk over its chat history
+            if self.last_touched is not None and self.last_touched != session_id:
+                self._remeasure(self.last_touched)
+            self.last_touched = session_id
+
+            cached = self.sessions.get(session_id)
+            if cached is not None and not (backend.persistent and (refresh or scope is None
+                                                                   or cached.checked_in is not scope)):
+                return self._touch(session_id, cached)
+            if not backend.persistent:
+                return self._insert(session_id, SessionRecord.create(session_id, backend))
+
+        # Backend reads happen outside the shard lock, so other sessions in
+        # this stripe don't wait on them
+        version = backend.version(session_id)
+        loaded = None
+        if cached is None or cached.version != version:
+            # Changed by another worker, expired in the backend, or not cached:
+            # reload it, keeping the lock so in-process callers stay serialized
+            loaded = SessionRecord.load(session_id, backend, cached.lock if cached is not None else None)
+
+        with self.lock:
+            current = self.sessions.get(session_id)
+            if current is not None and current is not cached:
+                # Another request loaded or replaced it while we read the backend
+                session = current
+            elif loaded is None and cached is not None:
+                session = cached
+            else:
+                session = loaded or SessionRecord.create(session_id, backend,
+                                                         cached.lock if cached is not None else None)
+            if current is not session:
+                if current is not None:
+                    self.drop(session_id)
+                self.sessions[session_id] = session
+                self._remeasure(session_id)
+            session.checked_in = scope
+            return self._touch(session_id, session)
+
+
+class SessionState:
+    """Sessions with idle expiry, an LRU count cap and a memory budget.
+
+    With the default MemorySessionBackend the records here are the only
+    copy. With a shared backend (SQLite, Redis) they are a per-worker cache:
+    every change is written through, each request (see begin_request) and
+    each ``locked()`` change checks the backend version and reloads a session
+    another worker has changed, and a session evicted
+    here can be loaded again later, including after a restart. If two
+    workers change the same session's thread list at the same moment, the
+    last write wins; requests for one session normally land on one worker.
+
+    The session map is split into ``stripes`` shards by session id, each with
+    its own lock, LRU order and an equal share of the count and memory
+    limits, so requests for unrelated patients never wait on each other.
+    Changes inside one session are serialized by that session's own lock.
+
+    Sizes are estimated, not measured: the most recently used session of a
+    shard is re-measured when the shard is next accessed for another session,
+    after the request that touched it has mutated it.
+    """
+
+    def __init__(self, ttl=None, max_sessions=None, memory_budget=None, stripes=16, backend=None):
+        self.backend = backend or MemorySessionBackend()
+        self.ttl = ttl  # seconds idle before a session expires
+        self.max_sessions = max_sessions
+        self.memory_budget = memory_budget  # bytes, estimated
+        self._shards = [_SessionShard(self) for _ in range(stripes)]
+
+    @property
+    def ttl(self):
+        return self._ttl
+
+    @ttl.setter
+    def ttl(self, ttl):
+        # Shared backends expire idle sessions on the same schedule
+        self._ttl = ttl
+        self.backend.ttl = ttl
+
+    def _per_shard(self, limit):
+        return None if limit is None else max(1, -(-limit // len(self._shards)))
+
+    def _shard(self, session_id):
+        return self._shards[hash(session_id) % len(self._shards)]
+
+    @property
+    def sessions(self):
+        """Snapshot of all sessions by id"""
+        merged = {}
+        for shard in self._shards:
+            with shard.lock:
+                merged.update(shard.sessions)
+        return merged
+
+    def get_session(self, session_id, refresh=False):
+        return self._shard(session_id).get(session_id, refresh)
+
+    def locked(self, session_id):
+        """``with session_state.locked(session_id) as session:`` serializes changes to one session"""
+        return _LockedSession(self, session_id)
+
+    def append_chat(self, session_id, chat_history, entry, thread=None):
+        """Append a chat entry under the session lock, optionally storing the list on ``thread``"""
+        with self.locked(session_id):
+            chat_history.append(entry)
+            if thread is not None:
+                thread['chat_history'] = chat_history
+        return chat_history
+
+    def set_current_patient(self, session_id: str, patient_id: str, patient_name: str, patient_history: List[dict] = None):
+        """Set current patient for the session with optional history from MongoDB"""
+        history = patient_history or []
+        history_size = estimate_size(history)
+        fingerprints = fingerprint_history(history)
+        with self.locked(session_id) as session:
+            session.current_patient_id = patient_id
+            session.patient_name = patient_name
+            session.patient_history = history
+            session.history_size = history_size
+            session.history_fingerprints = fingerprints
+            changes = {"meta": session.meta(), "history": history}
+
+            current_thread = session.threads.get(session.current_thread)
+            if current_thread is not None:
+                current_thread.patient_id = patient_id
+                current_thread.visit_id = str(uuid4())
+                current_thread.name = f"📋 Visit: {patient_name} - Current Visit"
+                changes[thread_field(current_thread.thread_id)] = current_thread.header()
+
+            # One backend write for the whole change
+            session.persist(changes)
+
+        return len(history)
+
+    def get_patient_context(self, session_id: str, max_tokens: int = None) -> str:
+        """Build patient context for AI from visit history.
+
+        Recent visits are listed in full and older ones as per-tooth
+        summaries; with ``max_tokens`` the list is compressed further to fit.
+        The rendering is cached by history fingerprint, so it is only built
+        again when the history changes.
+        """
+        session = self.get_session(session_id)
+        if not session['current_patient_id']:
+            return ""
+
+        history = session['patient_history']
+        if not history:
+            return f"New patient: {session['patient_name']} - No previous visits."
+
+        header = f"Patient: {session['patient_name']} - {len(history)} previous visits"
+        if max_tokens is not None:
+            max_tokens = max(0, max_tokens - token_counter.count(header) - 1)
+        visits = patient_contexts.render(history, session.history_fingerprints, max_tokens)
+        return f"{header}\n{visits}"
+
+    def get_visit_data(self, session_id: str, max_tokens: int = None) -> str:
+        """Raw JSON of every visit, summarizing the oldest only if ``max_tokens`` requires it (cached)"""
+        session = self.get_session(session_id)
+        history = session['patient_history']
+        return patient_contexts.render(history, session.history_fingerprints, max_tokens,
+                                       kind="json", recent=len(history))
+
+    def create_thread(self, session_id, thread_name, thread_type='scenario'):
+        """Create thread with explicit type: 'scenario' or 'visit'"""
+        type_prefix = "🔬 Scenario: " if thread_type == 'scenario' else "📋 Visit: "
+        display_name = f"{type_prefix}{thread_name}"
+
+        with self.locked(session_id) as session:
+            # Ids come from a per-session counter, so they stay unique after clear_thread
+            thread_id = f"thread_{session.next_thread_number()}"
+            thread = ThreadRecord(
+                display_name,
+                patient_id=session['current_patient_id'],
+                visit_id=str(uuid4()) if thread_type == 'visit' else None,
+                thread_type=thread_type
+            )
+            session.add_thread(thread_id, thread, make_current=True)
+        return thread_id
+
+    def get_visit_comparison_data(self, session_id, visit_ids=None):
+        """Per-tooth diff of the patient's visits (all of them, or ``visit_ids``); see visit_diff.diff_visits"""
+        session = self.get_session(session_id)
+        if not session['current_patient_id']:
+            return "No patient selected for comparison."
+
+        history = session['patient_history']
+        if visit_ids:
+            history = [v for v in history if v.get('visit_id') in visit_ids]
+        if len(history) < 2:
+            return "Need at least 2 visits for comparison."
+
+        return {'patient_name': session['patient_name'], **diff_visits(history)}
+
+    def switch_thread(self, session_id, thread_id):
+        with self.locked(session_id) as session:
+            if thread_id in session['threads']:
+                session['current_thread'] = thread_id
+
+    def get_current_thread(self, session_id):
+        session = self.get_session(session_id)
+        return session['threads'].get(session['current_thread'], None)
+
+    def get_thread_list(self, session_id):
+        with self.locked(session_id) as session:
+            return [{'id': tid, 'name': t['name']} for tid, t in session['threads'].items()]
+
+    def clear_thread(self, session_id, thread_id):
+        with self.locked(session_id) as session:
+            if thread_id in session['threads']:
+                session.remove_thread(thread_id)
+
+    def clear_session(self, session_id):
+        shard = self._shard(session_id)
+        with shard.lock:
+            shard.drop(session_id)
+            self.backend.delete(session_id)
+
+    def stats(self):
+        sessions = threads = estimated_bytes = 0
+        evictions = {"ttl": 0, "lru": 0, "memory": 0}
+        for shard in self._shards:
+            with shard.lock:
+                sessions += len(shard.sessions)
+                threads += sum(len(session.threads) for session in shard.sessions.values())
+                estimated_bytes += shard.total_size
+                for reason, count in shard.evictions.items():
+                    evictions[reason] += count
+        return {
+            "sessions": sessions,
+            "threads": threads,
+            "estimated_bytes": estimated_bytes,
+            "memory_budget": self.memory_budget,
+            "max_sessions": self.max_sessions,
+            "ttl": self.ttl,
+            "stripes": len(self._shards),
+            "patient_context": patient_contexts.stats(),
+            "backend": type(self.backend).__name__,
+            "evictions": evictions,
+        }
+
+
+class _LockedSession:
+    def __init__(self, state, session_id):
+        self.state = state
+        self.session_id = session_id
+        self.lock = None
+
+    def __enter__(self):
+        while True:
+            # Changes always start from the backend's latest version
+            session = self.state.get_session(self.session_id, refresh=True)
+            session.lock.acquire()
+            # Fetch again under the lock: the record may have been reloaded
+            # (changed by another worker) or evicted while we waited
+            current = self.state.get_session(self.session_id)
+            if current.lock is session.lock:
+                self.lock = session.lock
+                return current
+            session.lock.release()
+
+    def __exit__(self, *exc):
+        self.lock.release()
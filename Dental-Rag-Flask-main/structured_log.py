@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import uuid
+import queue
+import atexit
+import random
+import logging
+import threading
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+# Level, "text" or "json" lines, and how many records may wait for the writer thread before new ones are dropped
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Fraction of streamed chunks logged at DEBUG (0 = none, 1 = every chunk)
+LOG_CHUNK_SAMPLE_RATE = float(os.getenv("LOG_CHUNK_SAMPLE_RATE", "0"))
+
+# Request payloads are logged with these keys redacted, cut to LOG_PAYLOAD_MAX_CHARS
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "512"))
+LOG_REDACT_KEYS = frozenset(key.strip().lower() for key in os.getenv(
+    "LOG_REDACT_KEYS",
+    "patient_name,patient_id,patientid,name,query,question,content,json,annotationdata,patient_history,"
+    "findings,anomalies,notes,json_context"
+).split(",") if key.strip())
+
+ROOT_LOGGER = "medbot"
+REDACTED = "[redacted]"
+
+_request_id = ContextVar("request_id", default="-")
+
+# LogRecord attributes; anything else on a record came in through ``extra``
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "request_id"}
+
+
+def get_logger(name):
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def new_request_id(request_id=None):
+    """Bind a correlation id (the caller's X-Request-ID, or a fresh one) to the current context"""
+    request_id = (request_id or uuid.uuid4().hex)[:64]
+    _request_id.set(request_id)
+    return request_id
+
+
+def bind_request_id(request_id):
+    """Re-bind an id captured earlier, e.g. inside a response generator"""
+    _request_id.set(request_id)
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+def sample_chunk():
+    """Whether to log this streamed chunk (cheap when chunk logging is off)"""
+    return LOG_CHUNK_SAMPLE_RATE > 0 and random.random() < LOG_CHUNK_SAMPLE_RATE
+
+
+def _redact(value, depth=0):
+    if isinstance(value, dict):
+        if depth > 4:
+            return f"<{len(value)} keys>"
+        return {key: (_summary(item) if str(key).lower() in LOG_REDACT_KEYS else _redact(item, depth + 1))
+                for key, item in value.items()}
+    if isinstance(value, list):
+        if depth > 4 or len(value) > 20:
+            return f"<{len(value)} items>"
+        return [_redact(item, depth + 1) for item in value]
+    return value
+
+
+def _summary(value):
+    if isinstance(value, (dict, list)):
+        return f"{REDACTED} <{len(value)} {'keys' if isinstance(value, dict) else 'items'}>"
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return f"{REDACTED} <{len(str(value))} chars>"
+
+
+def redact_payload(payload, max_chars=None):
+    """JSON text of ``payload`` with PHI keys replaced by their size, capped at ``max_chars``"""
+    max_chars = LOG_PAYLOAD_MAX_CHARS if max_chars is None else max_chars
+    text = json.dumps(_redact(payload), default=str, ensure_ascii=False)
+    if len(text) > max_chars:
+        text = f"{text[:max_chars]}...(+{len(text) - max_chars} chars)"
+    return text
+
+
+class _RequestIdFilter(logging.Filter):
+    """Stamps records with the request id on the caller's thread, before they are queued"""
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        return True
+
+
+def _extras(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_FIELDS}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+            **_extras(record),
+        }
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [%(request_id)s] %(message)s")
+
+    def format(self, record):
+        record.request_id = getattr(record, "request_id", "-")
+        line = super().format(record)
+        extras = _extras(record)
+        if extras:
+            line += " " + " ".join(f"{key}={value}" for key, value in extras.items())
+        return line
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """Never blocks the request: a full queue drops the record and counts it"""
+
+    def __init__(self, log_queue, stats):
+        super().__init__(log_queue)
+        self.stats = stats
+
+    def prepare(self, record):
+        # Format args now (they may change later) but leave the line to the writer thread
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.stats["queued"] += 1
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+
+class _Logging:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._listener = None
+        self._handler = None
+        self._queue = None
+        self._stats = {"queued": 0, "dropped": 0}
+
+    def setup(self, level=None, fmt=None, stream=None, queue_size=None):
+        """Send the ``medbot`` loggers through a queue to a writer thread (once per process)"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # A forked worker inherits the handler but not the writer thread
+            logger = logging.getLogger(ROOT_LOGGER)
+            if self._handler is not None:
+                logger.removeHandler(self._handler)
+            output = logging.StreamHandler(stream)
+            output.setFormatter(JsonFormatter() if (fmt or LOG_FORMAT) == "json" else TextFormatter())
+            self._queue = queue.Queue(maxsize=queue_size or LOG_QUEUE_SIZE)
+            self._handler = _DroppingQueueHandler(self._queue, self._stats)
+            self._handler.addFilter(_RequestIdFilter())
+            self._listener = QueueListener(self._queue, output, respect_handler_level=True)
+            self._listener.start()
+            logger.addHandler(self._handler)
+            logger.setLevel(level or LOG_LEVEL)
+            logger.propagate = False
+            self._pid = os.getpid()
+
+    def flush(self, timeout=5.0):
+        """Wait until the writer thread has caught up (tests, shutdown)"""
+        deadline = time.monotonic() + timeout
+        while self._queue is not None and self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+    def close(self):
+        with self._lock:
+            if self._listener is not None and self._pid == os.getpid():
+                self._listener.stop()
+            if self._handler is not None:
+                logging.getLogger(ROOT_LOGGER).removeHandler(self._handler)
+            self._listener = self._handler = self._queue = self._pid = None
+
+    def stats(self):
+        return {
+            "level": logging.getLevelName(logging.getLogger(ROOT_LOGGER).getEffectiveLevel()),
+            "format": LOG_FORMAT,
+            "queued": self._stats["queued"],
+            "dropped": self._stats["dropped"],
+            "waiting": self._queue.qsize() if self._queue is not None else 0,
+            "chunk_sample_rate": LOG_CHUNK_SAMPLE_RATE,
+        }
+
+
+log_setup = _Logging()
+setup_logging = log_setup.setup
+atexit.register(log_setup.close)
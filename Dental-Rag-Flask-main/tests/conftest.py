@@ -0,0 +1,184 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import claude_try  # noqa: E402
+import session_store  # noqa: E402
+from answer_cache import AnswerCache  # noqa: E402
+from audit_log import AuditLog  # noqa: E402
+from context_jobs import ContextJobs  # noqa: E402
+from llm_scheduler import LLMScheduler  # noqa: E402
+from session_store import SessionState  # noqa: E402
+
+
+class FakeEmbedder:
+    """Stands in for CDTEmbedder: deterministic records, no Ollama"""
+
+    def rank_batch(self, queries, k=10):
+        return [
+            [{"Code": f"D{len(query) % 10}{i:03d}", "Description": f"Procedure for {query}",
+              "Cosine": 0.9, "Jaccard": 0.1, "Score": 0.66}
+             for i in range(min(k, 3))]
+            for query in queries
+        ]
+
+
+class FakeLLM:
+    def invoke(self, prompt, **kwargs):
+        return f"Response: answer ({len(prompt)} prompt chars)"
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._chunks)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClient:
+    def chat(self, model=None, messages=None, stream=False, **kwargs):
+        return FakeStream([{"message": {"content": f"tok{i} "}} for i in range(5)])
+
+
+class FakeRedis:
+    """The hash, expiry and pipeline commands RedisSessionBackend uses, in memory.
+
+    Values come back as bytes like redis-py; ``advance`` moves the expiry clock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hashes = {}
+        self._expires = {}
+        self._now = 0.0
+
+    def advance(self, seconds):
+        with self._lock:
+            self._now += seconds
+
+    def _hash(self, key, create=False):
+        if key in self._expires and self._expires[key] <= self._now:
+            self._hashes.pop(key, None)
+            self._expires.pop(key, None)
+        if create:
+            return self._hashes.setdefault(key, {})
+        return self._hashes.get(key, {})
+
+    @staticmethod
+    def _bytes(value):
+        return value if isinstance(value, bytes) else str(value).encode("utf-8")
+
+    def _hget(self, key, field):
+        return self._hash(key).get(field)
+
+    def _hmget(self, key, fields):
+        values = self._hash(key)
+        return [values.get(field) for field in fields]
+
+    def _hset(self, key, mapping):
+        self._hash(key, create=True).update({field: self._bytes(value) for field, value in mapping.items()})
+        return len(mapping)
+
+    def _hdel(self, key, *fields):
+        values = self._hash(key)
+        return sum(values.pop(field, None) is not None for field in fields)
+
+    def _hincrby(self, key, field, amount=1):
+        values = self._hash(key, create=True)
+        value = int(values.get(field, b"0")) + amount
+        values[field] = self._bytes(value)
+        return value
+
+    def _expire(self, key, seconds):
+        if key not in self._hashes:
+            return False
+        self._expires[key] = self._now + seconds
+        return True
+
+    def _delete(self, *keys):
+        return sum(self._hashes.pop(key, None) is not None for key in keys)
+
+    def __getattr__(self, name):
+        command = getattr(self, f"_{name}")
+
+        def call(*args, **kwargs):
+            with self._lock:
+                return command(*args, **kwargs)
+        return call
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self._redis = redis
+        self._commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self._commands.append((getattr(self._redis, f"_{name}"), args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        # Queued commands run atomically, like MULTI/EXEC
+        with self._redis._lock:
+            return [command(*args, **kwargs) for command, args, kwargs in self._commands]
+
+
+@pytest.fixture(autouse=True)
+def no_request_scope():
+    """Test client requests leave their session request scope bound to this thread; start each test without one"""
+    token = session_store._request_scope.set(None)
+    yield
+    session_store._request_scope.reset(token)
+
+
+@pytest.fixture
+def fake_models(monkeypatch):
+    """Route claude_try's models, scheduler and session store to in-process fakes"""
+    monkeypatch.setattr(claude_try, "_cdt", FakeEmbedder())
+    monkeypatch.setattr(claude_try, "_cdt_match_cache", None)
+    monkeypatch.setattr(claude_try, "_llm", FakeLLM())
+    monkeypatch.setattr(claude_try, "get_client", lambda: FakeClient())
+    monkeypatch.setattr(claude_try, "audit_log", AuditLog(directory=""))
+    monkeypatch.setattr(claude_try, "llm_scheduler", LLMScheduler(max_in_flight=8, max_queue=10000))
+    monkeypatch.setattr(claude_try, "session_state", SessionState(ttl=None, max_sessions=None, memory_budget=None))
+    monkeypatch.setattr(claude_try, "answer_cache", AnswerCache(similarity=0))
+    monkeypatch.setattr(claude_try, "context_jobs", ContextJobs())
+    return claude_try
+
+
+@pytest.fixture
+def fast_switching():
+    """Switch threads far more often than usual to shake out races"""
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+SAMPLE_VISIT = {
+    "teeth": [
+        {"number": 14, "anomalies": [{"description": "Caries", "metadata": {"confidence": 0.91}}]},
+        {"number": 30, "anomalies": [{"description": "Periapical lesion", "metadata": {"confidence": 0.77}}]},
+    ]
+}
+
+
+@pytest.fixture
+def sample_visit():
+    return SAMPLE_VISIT
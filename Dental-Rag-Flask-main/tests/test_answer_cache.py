@@ -0,0 +1,214 @@
+import json
+
+import numpy as np
+import pytest
+
+import answer_cache
+from answer_cache import AnswerCache, normalize_question, replay_chunks
+
+
+def bag_of_words(texts):
+    """Deterministic unit vectors: questions sharing most words point the same way"""
+    vectors = np.zeros((len(texts), 64), dtype=np.float32)
+    for i, text in enumerate(texts):
+        for word in text.split():
+            vectors[i, sum(map(ord, word)) % 64] += 1.0
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_exact_match_ignores_case_spacing_and_punctuation():
+    cache = AnswerCache(maxsize=8, ttl=None, similarity=0)
+    lookup = cache.lookup("ctx", "comprehensive", "What are the anomalies?")
+    assert lookup.answer is None
+    cache.put(lookup, "Caries on #14")
+
+    assert normalize_question("  what ARE the   anomalies ") == "what are the anomalies"
+    assert cache.lookup("ctx", "comprehensive", "what are the  anomalies").answer == "Caries on #14"
+    assert cache.lookup("ctx", "treatment_plan", "What are the anomalies?").answer is None
+    assert cache.lookup("other", "comprehensive", "What are the anomalies?").answer is None
+
+    routes = cache.stats()["routes"]
+    assert routes["comprehensive"]["exact"] == 1 and routes["comprehensive"]["misses"] == 2
+    assert routes["comprehensive"]["hit_rate"] == pytest.approx(1 / 3)
+
+
+def test_semantic_match_stays_within_context_and_route():
+    cache = AnswerCache(maxsize=8, ttl=None, similarity=0.8, embed=bag_of_words)
+    cache.put(cache.lookup("ctx", "comprehensive", "what are the anomalies in this xray"), "Caries on #14")
+
+    hit = cache.lookup("ctx", "comprehensive", "what are the anomalies in the xray")
+    assert (hit.answer, hit.match) == ("Caries on #14", "semantic")
+    assert cache.lookup("ctx", "comprehensive", "generate a treatment plan").answer is None
+    assert cache.lookup("ctx", "general", "what are the anomalies in the xray").answer is None
+
+
+def test_embedding_failure_falls_back_to_exact():
+    def broken(texts):
+        raise ConnectionError("ollama down")
+
+    cache = AnswerCache(maxsize=8, ttl=None, similarity=0.8, embed=broken)
+    cache.put(cache.lookup("ctx", "general", "what is a crown"), "A cap over a tooth")
+    assert cache.lookup("ctx", "general", "What is a crown?").match == "exact"
+    assert cache.lookup("ctx", "general", "what is a bridge").answer is None
+
+
+def test_ttl_and_size_eviction(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(answer_cache.time, "time", lambda: now[0])
+    cache = AnswerCache(maxsize=2, ttl=60, similarity=0)
+    for question in ("q1", "q2", "q3"):
+        cache.put(cache.lookup("ctx", "general", question), f"answer {question}")
+    assert cache.lookup("ctx", "general", "q1").answer is None
+    assert cache.stats()["evictions"] == 1
+
+    now[0] += 61
+    assert cache.lookup("ctx", "general", "q3").answer is None
+    assert cache.stats()["size"] == 1
+
+
+def test_replay_reassembles_the_answer():
+    answer = "## Findings\n\n- Tooth 14: caries  (0.91)\n"
+    chunks = replay_chunks(answer)
+    assert len(chunks) > 5
+    assert "".join(chunks) == answer
+
+
+class CountingClient:
+    def __init__(self):
+        self.calls = 0
+
+    def chat(self, model=None, messages=None, stream=False, **kwargs):
+        from conftest import FakeStream
+
+        self.calls += 1
+        return FakeStream([{"message": {"content": f"tok{i} "}} for i in range(5)] + [{"done": True}])
+
+
+def sse_events(body):
+    return [json.loads(line[len("data: "):]) for line in body.split("\n") if line.startswith("data: {")]
+
+
+def test_repeat_stream_question_replays_without_generation(fake_models, monkeypatch, sample_visit):
+    from app import create_app
+
+    client = CountingClient()
+    monkeypatch.setattr(fake_models, "get_client", lambda: client)
+    app = create_app(warm_up_on_start=False).test_client()
+    request = {"patient_name": "s1", "json": sample_visit, "query": "What are the anomalies?"}
+
+    first = app.post("/api/rag-chat-stream", json=request).get_data(as_text=True)
+    second = app.post("/api/rag-chat-stream", json={"patient_name": "s1", "query": "what are the anomalies"})
+    second = second.get_data(as_text=True)
+
+    assert client.calls == 1
+    assert second.endswith("event: done\ndata: [DONE]\n\n")
+    replayed = sse_events(second)
+    assert all(event["type"] == "chunk" for event in replayed) and len(replayed) == 5
+    assert "".join(e["content"] for e in replayed) == "".join(e["content"] for e in sse_events(first))
+    assert fake_models.answer_cache.stats()["routes"]["comprehensive"]["exact"] == 1
+
+
+def test_new_upload_or_history_misses(fake_models, monkeypatch, sample_visit):
+    client = CountingClient()
+    monkeypatch.setattr(fake_models, "get_client", lambda: client)
+
+    def ask():
+        plan = fake_models.prepare_stream_request("what are the anomalies", [], "s1")
+        return "".join(fake_models.enhanced_chat_with_medbot_stream("what are the anomalies", [], "s1", plan=plan))
+
+    fake_models.handle_json_text_input(sample_visit, [], "s1")
+    ask()
+    ask()
+    assert client.calls == 1
+
+    changed = {"teeth": sample_visit["teeth"][:1]}
+    fake_models.handle_json_text_input(changed, [], "s1")
+    ask()
+    assert client.calls == 2
+
+    fake_models.session_state.set_current_patient("s1", "p-1", "Jane Doe", [{"timestamp": "2024-01-01", "findings": []}])
+    ask()
+    assert client.calls == 3
+
+
+@pytest.mark.parametrize("kind", ["sqlite", "redis"])
+def test_history_changed_by_another_worker_misses(fake_models, monkeypatch, sample_visit, tmp_path, kind):
+    from conftest import FakeRedis
+    from session_backends import RedisSessionBackend, SQLiteSessionBackend
+    from session_store import SessionState
+
+    redis = FakeRedis()
+    client = CountingClient()
+    monkeypatch.setattr(fake_models, "get_client", lambda: client)
+
+    def worker():
+        """A fresh per-worker session cache over the shared backend"""
+        backend = (SQLiteSessionBackend(str(tmp_path / "sessions.sqlite3")) if kind == "sqlite"
+                   else RedisSessionBackend(redis))
+        state = SessionState(backend=backend)
+        monkeypatch.setattr(fake_models, "session_state", state)
+        return state
+
+    def ask():
+        worker()
+        plan = fake_models.prepare_stream_request("what are the anomalies", [], "s1")
+        return "".join(fake_models.enhanced_chat_with_medbot_stream("what are the anomalies", [], "s1", plan=plan))
+
+    worker().set_current_patient("s1", "p-1", "Jane Doe", [{"timestamp": "2024-01-01", "findings": []}])
+    fake_models.handle_json_text_input(sample_visit, [], "s1")
+    ask()
+    ask()
+    assert client.calls == 1
+
+    worker().set_current_patient("s1", "p-1", "Jane Doe", [{"timestamp": "2024-03-01", "findings": [{"tooth": 14, "description": "Caries"}]}])
+    ask()
+    assert client.calls == 2
+
+
+def test_errors_are_not_cached(fake_models, monkeypatch):
+    class FailingClient:
+        def chat(self, **kwargs):
+            raise ConnectionError("ollama down")
+
+    monkeypatch.setattr(fake_models, "get_client", lambda: FailingClient())
+    chunks = list(fake_models.enhanced_chat_with_medbot_stream("what is a crown", [], "s1"))
+    assert chunks[0].startswith("⚠️")
+    assert fake_models.answer_cache.stats()["size"] == 0
+
+
+def test_blocking_chat_reuses_answers(fake_models, monkeypatch):
+    calls = []
+
+    class RecordingLLM:
+        def invoke(self, prompt, **kwargs):
+            calls.append(prompt)
+            return "Response: a cap over a tooth"
+
+    monkeypatch.setattr(fake_models, "_llm", RecordingLLM())
+    _, history = fake_models.enhanced_chat_with_medbot("what is a crown", [], "s1")
+    _, history = fake_models.enhanced_chat_with_medbot("What is a crown?", history, "s1")
+    assert len(calls) == 1
+    assert history[0][1] == history[1][1] == "Response: a cap over a tooth"
+
+
+def test_question_embeddings_bypass_the_cdt_query_cache(fake_models, monkeypatch):
+    class EmbedClient:
+        def __init__(self):
+            self.inputs = []
+
+        def embed(self, model=None, input=(), keep_alive=None):
+            self.inputs.extend(input)
+            return {"embeddings": bag_of_words([text[len("query: "):] for text in input]) * 3}
+
+    client = EmbedClient()
+    monkeypatch.setattr(fake_models, "get_client", lambda: client)
+    # Any use of the CDT embedder (and its query cache) would fail here
+    monkeypatch.setattr(fake_models, "_cdt", None)
+    monkeypatch.setattr(fake_models, "get_cdt", lambda: pytest.fail("question embedded through the CDT embedder"))
+    cache = AnswerCache(maxsize=8, ttl=None, similarity=0.8, embed=fake_models.embed_questions)
+
+    cache.put(cache.lookup("ctx", "general", "what are the anomalies in this xray"), "Caries on #14")
+    hit = cache.lookup("ctx", "general", "what are the anomalies in the xray")
+    assert (hit.answer, hit.match) == ("Caries on #14", "semantic")
+    assert client.inputs[0] == "query: what are the anomalies in this xray"
+    np.testing.assert_allclose(np.linalg.norm(hit.vector), 1.0, rtol=1e-6)
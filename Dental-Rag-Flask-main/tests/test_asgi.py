@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def asgi(fake_models):
+    # Importing asgi maps the CDT catalog; fake_models makes that the fake embedder
+    import asgi
+    return asgi
+
+
+def test_cancelled_stream_closes_the_generator_before_returning(asgi, monkeypatch):
+    closed = []
+
+    async def chunks(**kwargs):
+        try:
+            for i in range(10):
+                yield f"tok{i} "
+        finally:
+            closed.append(True)  # where the real generator closes Ollama and releases its slot
+
+    monkeypatch.setattr(asgi, "enhanced_chat_with_medbot_astream", chunks)
+
+    async def run():
+        sent = []
+        stalled = asyncio.Event()
+
+        async def send(message):
+            sent.append(message)
+            if len(sent) == 2:  # the client stops reading
+                stalled.set()
+                await asyncio.Event().wait()
+
+        task = asyncio.ensure_future(asgi._pump(send, {"plan": {"route": "general"}}))
+        await stalled.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return list(closed)
+
+    assert asyncio.run(run()) == [True]
@@ -0,0 +1,83 @@
+import threading
+
+import pandas as pd
+
+import audit_log
+from audit_log import AuditLog, export_excel, read_records, segment_paths
+
+
+def rows(n, start=0):
+    return [{"Tooth No": 14, "Anomaly Description": f"finding {i}", "CDT Codes": "D2391"}
+            for i in range(start, start + n)]
+
+
+def test_rows_are_batched_into_an_append_only_segment(tmp_path):
+    log = AuditLog(directory=str(tmp_path), flush_seconds=0.05, batch_size=100)
+    log.record(rows(3), session_id="s1")
+    log.record(rows(2, start=3), session_id="s2")
+    assert log.flush(timeout=2)
+
+    records = list(read_records(str(tmp_path)))
+    assert [r["Anomaly Description"] for r in records] == [f"finding {i}" for i in range(5)]
+    assert records[0]["session_id"] == "s1" and records[-1]["session_id"] == "s2"
+    assert all("logged_at" in r for r in records)
+    stats = log.stats()
+    assert stats["written"] == 5 and stats["batches"] <= 2 and stats["dropped"] == 0
+    log.close()
+
+
+def test_full_queue_drops_instead_of_blocking(tmp_path, monkeypatch):
+    log = AuditLog(directory=str(tmp_path), queue_size=4, flush_seconds=0.05)
+    gate = threading.Event()
+    write = log._write
+    monkeypatch.setattr(log, "_write", lambda batch: gate.wait(2) and write(batch))
+
+    log.record(rows(1))
+    assert log.flush(timeout=0.2) is False  # the writer is stuck on the first batch
+    log.record(rows(10))
+    assert log.stats()["dropped"] > 0
+
+    gate.set()
+    assert log.flush(timeout=2)
+    assert log.stats()["written"] + log.stats()["dropped"] == 11
+    log.close()
+
+
+def test_segments_roll_over_and_skip_torn_lines(tmp_path):
+    log = AuditLog(directory=str(tmp_path), flush_seconds=0, batch_size=1, segment_bytes=200)
+    for i in range(4):
+        log.record(rows(1, start=i))
+        log.flush(timeout=2)
+    log.close()
+    paths = segment_paths(str(tmp_path))
+    assert len(paths) > 1
+
+    with open(paths[-1], "a", encoding="utf-8") as f:
+        f.write('{"Tooth No": 3, "Anomaly')  # a crash mid-write
+    assert [r["Anomaly Description"] for r in read_records(str(tmp_path))] == [f"finding {i}" for i in range(4)]
+
+
+def test_export_excel(tmp_path):
+    log = AuditLog(directory=str(tmp_path / "log"), flush_seconds=0)
+    log.record(rows(3), session_id="s1")
+    log.flush(timeout=2)
+    log.close()
+
+    out = tmp_path / "report.xlsx"
+    assert audit_log.main(["export", "--dir", str(tmp_path / "log"), "--out", str(out)]) == 0
+    df = pd.read_excel(out)
+    assert list(df["Anomaly Description"]) == ["finding 0", "finding 1", "finding 2"]
+    assert export_excel(str(tmp_path / "log"), str(out), since="2999-01-01") == 0
+
+
+def test_treatment_plan_question_records_rows(fake_models, sample_visit, tmp_path, monkeypatch):
+    log = AuditLog(directory=str(tmp_path), flush_seconds=0)
+    monkeypatch.setattr(fake_models, "audit_log", log)
+    fake_models.handle_json_text_input(sample_visit, [], "s1")
+    fake_models.enhanced_chat_with_medbot("Create treatment plan", [], "s1")
+    assert log.flush(timeout=2)
+
+    records = list(read_records(str(tmp_path)))
+    assert [r["Tooth No"] for r in records] == [14, 30]
+    assert records[0]["session_id"] == "s1" and records[0]["CDT Codes"].startswith("D")
+    log.close()
@@ -0,0 +1,152 @@
+import os
+import zlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import cdt_bundle
+import ollama_embedder
+from cdt_bundle import BUNDLE_FORMAT_VERSION, VECTOR_ALIGN, BundleError, CatalogBundle, catalog_key, write_bundle
+from ollama_embedder import CDTEmbedder
+
+CATALOG = [
+    ("D0220", "Intraoral periapical first radiographic image", "periapical radiograph"),
+    ("D2391", "Resin-based composite one surface posterior", "caries filling composite"),
+    ("D3310", "Endodontic therapy anterior tooth", "root canal periapical lesion"),
+]
+
+
+class FakeEmbedClient:
+    """/api/embed stand-in: deterministic, deliberately unnormalized vectors"""
+
+    def __init__(self, dim=8):
+        self.dim = dim
+        self.calls = []
+
+    def embed(self, model=None, input=(), keep_alive=None):
+        self.calls.append(list(input))
+        vectors = [np.random.default_rng(zlib.crc32(text.encode("utf-8"))).normal(size=self.dim) * 5
+                   for text in input]
+        return {"embeddings": [vector.tolist() for vector in vectors]}
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    path = str(tmp_path / "New_CDT.xlsx")
+    pd.DataFrame(CATALOG, columns=["Procedure Code", "Description of Service", "Keywords"]).to_excel(path, index=False)
+    return path
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = FakeEmbedClient()
+    monkeypatch.setattr(ollama_embedder, "get_client", lambda: client)
+    return client
+
+
+def make_embedder(catalog, tmp_path, **kwargs):
+    return CDTEmbedder(catalog, bundle_path=str(tmp_path / "cdt_catalog.bundle"), **kwargs)
+
+
+def sample_bundle(path, key="k1", rows=3, dim=5):
+    vectors = np.arange(rows * dim, dtype=np.float32).reshape(rows, dim)
+    codes = [f"D{i:04d}" for i in range(rows)]
+    write_bundle(path, key, "model", codes, [f"desc {i}" for i in range(rows)], ["a b"] * rows,
+                 [f"text {i}" for i in range(rows)], vectors)
+    return vectors, codes
+
+
+def test_bundle_round_trip(tmp_path):
+    path = str(tmp_path / "catalog.bundle")
+    vectors, codes = sample_bundle(path)
+
+    bundle = CatalogBundle(path)
+    assert bundle.key == "k1" and bundle.model_name == "model" and len(bundle) == 3
+    assert bundle.codes == codes and bundle.descriptions[2] == "desc 2" and bundle.texts[0] == "text 0"
+    assert bundle.keyword_sets[0] == frozenset({"a", "b"})
+    np.testing.assert_array_equal(bundle.vectors, vectors)
+
+    # The vector block ends the file and starts on an aligned offset
+    assert (os.path.getsize(path) - vectors.nbytes) % VECTOR_ALIGN == 0
+    assert not bundle.vectors.flags.writeable
+
+
+@pytest.mark.parametrize("corrupt", [
+    lambda data: b"NOTABNDL" + data[8:],
+    lambda data: data[:8] + (BUNDLE_FORMAT_VERSION + 1).to_bytes(4, "little") + data[12:],
+    lambda data: data[:-4],
+    lambda data: data[:10],
+])
+def test_bundle_rejects_foreign_or_truncated_files(tmp_path, corrupt):
+    path = str(tmp_path / "catalog.bundle")
+    sample_bundle(path)
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(corrupt(data))
+    with pytest.raises(BundleError):
+        CatalogBundle(path)
+
+
+def test_write_bundle_replaces_the_file_atomically(tmp_path):
+    path = str(tmp_path / "catalog.bundle")
+    old_vectors, _ = sample_bundle(path, key="old")
+    mapped = CatalogBundle(path)
+
+    with pytest.raises(BundleError):
+        write_bundle(path, "bad", "model", ["D0001"], ["d"], [""], ["t"], np.zeros((2, 5)))
+    sample_bundle(path, key="new", rows=4)
+
+    # A worker that mapped the old file keeps reading it intact
+    np.testing.assert_array_equal(mapped.vectors, old_vectors)
+    assert CatalogBundle(path).key == "new" and len(CatalogBundle(path)) == 4
+    assert os.listdir(tmp_path) == ["catalog.bundle"]
+
+
+def test_embedder_builds_then_reuses_the_bundle(catalog, tmp_path, client):
+    embedder = make_embedder(catalog, tmp_path)
+    assert len(client.calls) == 1 and all(text.startswith("passage: ") for text in client.calls[0])
+    assert embedder.codes == [code for code, _, _ in CATALOG]
+    assert embedder.cache_key == catalog_key(catalog, embedder.model_name)
+    np.testing.assert_allclose(np.linalg.norm(embedder.unit_matrix, axis=1), 1.0, rtol=1e-6)
+
+    again = make_embedder(catalog, tmp_path)
+    assert len(client.calls) == 1
+    np.testing.assert_array_equal(again.unit_matrix, embedder.unit_matrix)
+
+    records = again.rank_batch(["root canal periapical lesion"], k=2)[0]
+    assert len(records) == 2 and records[0]["Score"] >= records[1]["Score"]
+
+
+def test_embedder_rebuilds_a_stale_bundle(catalog, tmp_path, client, monkeypatch):
+    make_embedder(catalog, tmp_path)
+    pd.DataFrame(CATALOG[:2], columns=["Procedure Code", "Description of Service", "Keywords"]).to_excel(
+        catalog, index=False)
+
+    rebuilt = make_embedder(catalog, tmp_path)
+    assert len(client.calls) == 2 and len(rebuilt.codes) == 2
+    assert rebuilt.cache_key == catalog_key(catalog, rebuilt.model_name)
+
+    # Another embedding model or vector recipe invalidates the bundle too
+    make_embedder(catalog, tmp_path, model_name="other-embed")
+    assert len(client.calls) == 3
+    monkeypatch.setattr(cdt_bundle, "EMBEDDING_CACHE_VERSION", cdt_bundle.EMBEDDING_CACHE_VERSION + 1)
+    make_embedder(catalog, tmp_path, model_name="other-embed")
+    assert len(client.calls) == 4
+
+
+def test_embedder_trusts_the_bundle_without_the_spreadsheet(catalog, tmp_path, client):
+    make_embedder(catalog, tmp_path)
+    os.remove(catalog)
+
+    shipped = make_embedder(catalog, tmp_path)
+    assert len(client.calls) == 1 and len(shipped.codes) == len(CATALOG)
+
+
+def test_embedder_rebuilds_an_unreadable_bundle(catalog, tmp_path, client):
+    with open(tmp_path / "cdt_catalog.bundle", "wb") as f:
+        f.write(b"garbage")
+
+    embedder = make_embedder(catalog, tmp_path)
+    assert len(client.calls) == 1 and len(embedder.codes) == len(CATALOG)
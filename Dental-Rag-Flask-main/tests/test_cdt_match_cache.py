@@ -0,0 +1,42 @@
+import threading
+
+from cdt_match_cache import CDTMatchCache
+
+RECORDS = [{"Code": "D2391", "Description": "Resin-based composite", "Score": 0.8}]
+
+
+def test_other_namespaces_are_kept_until_purged(tmp_path):
+    path = str(tmp_path / "matches.sqlite3")
+    old = CDTMatchCache(path, "catalog-v1")
+    old.put_many({"caries": RECORDS})
+
+    # A worker opening the new catalog does not delete what others still read
+    new = CDTMatchCache(path, "catalog-v2")
+    assert new.get_many(["caries"]) == {}
+    assert old.get_many(["caries"]) == {"caries": RECORDS}
+
+    new.put_many({"caries": RECORDS[:0]})
+    assert new.purge_other_namespaces() == 1
+    assert old.get_many(["caries"]) == {}
+    assert new.get_many(["caries"]) == {"caries": []}
+    assert new.purge_other_namespaces() == 0
+
+
+def test_counters_are_exact_under_concurrent_lookups(tmp_path):
+    cache = CDTMatchCache(str(tmp_path / "matches.sqlite3"), "test")
+    cache.put_many({"caries": RECORDS})
+    start = threading.Event()
+
+    def lookup():
+        start.wait()
+        for _ in range(50):
+            cache.get_many(["caries", "abscess"])
+
+    threads = [threading.Thread(target=lookup) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+
+    assert cache.stats() == {"hits": 400, "misses": 400, "hit_rate": 0.5}
@@ -0,0 +1,196 @@
+import json
+import threading
+
+import pytest
+
+from conftest import FakeEmbedder
+
+
+class GatedEmbedder(FakeEmbedder):
+    """FakeEmbedder whose retrieval waits until ``release`` is set"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def rank_batch(self, queries, k=10):
+        self.calls += 1
+        assert self.release.wait(timeout=2)
+        return super().rank_batch(queries, k)
+
+
+@pytest.fixture
+def gated(fake_models, monkeypatch):
+    embedder = GatedEmbedder()
+    monkeypatch.setattr(fake_models, "_cdt", embedder)
+    return embedder
+
+
+def test_job_reports_progress_and_stores_context(fake_models, gated, sample_visit):
+    job, started = fake_models.start_context_job(sample_visit, "s1")
+    assert started and not job.finished
+
+    gated.release.set()
+    assert job.wait(timeout=2)
+    snapshot = job.snapshot()
+    assert snapshot["status"] == "done" and snapshot["result"]["findings"] == 2
+    stages = [event["stage"] for event in snapshot["events"]]
+    assert stages[:3] == ["queued", "running", "retrieving"]
+    assert stages[-2:] == ["storing", "done"]
+    assert {"rendering", "retrieved"} <= set(stages)
+    assert "Tooth 14" in fake_models.session_state.get_current_thread("s1")["json_context"]
+
+
+def test_repeat_upload_reuses_the_job(fake_models, gated, sample_visit):
+    gated.release.set()
+    job, _ = fake_models.start_context_job(sample_visit, "s1")
+    job.wait(timeout=2)
+
+    again, started = fake_models.start_context_job(json.loads(json.dumps(sample_visit)), "s1")
+    assert again is job and not started and gated.calls == 1
+
+    changed = {"teeth": sample_visit["teeth"][:1]}
+    other, started = fake_models.start_context_job(changed, "s1")
+    assert started and other is not job
+    other.wait(timeout=2)
+
+    # A new case has no context, so the same upload loads into it again
+    fake_models.session_state.create_thread("s1", "Second case")
+    reloaded, started = fake_models.start_context_job(changed, "s1")
+    assert started and reloaded is not other
+    assert fake_models.context_jobs.stats()["reused"] == 1
+
+
+def test_question_joins_the_pending_job(fake_models, gated, sample_visit, monkeypatch):
+    prompts = []
+    invoke = fake_models._llm.invoke
+    monkeypatch.setattr(fake_models._llm, "invoke", lambda prompt, **kwargs: prompts.append(prompt) or invoke(prompt, **kwargs))
+
+    job, _ = fake_models.start_context_job(sample_visit, "s1")
+    threading.Timer(0.1, gated.release.set).start()
+    fake_models.enhanced_chat_with_medbot("What are the findings?", [], "s1")
+
+    assert job.finished and fake_models.context_jobs.stats()["joined"] == 1
+    assert "Tooth 14" in prompts[-1]
+
+
+def test_invalid_upload_fails_the_job(fake_models):
+    job, _ = fake_models.start_context_job("{not json", "s1")
+    assert job.wait(timeout=2)
+    assert job.state == "failed" and "Invalid JSON" in job.error
+
+    # A failed upload is not reused
+    retry, started = fake_models.start_context_job("{not json", "s1")
+    assert started and retry is not job
+
+
+def test_job_endpoints(fake_models, sample_visit, monkeypatch):
+    import app
+    monkeypatch.setattr(app, "context_jobs", fake_models.context_jobs)
+    client = app.create_app(warm_up_on_start=False).test_client()
+
+    response = client.post("/api/context-jobs", json={"json": sample_visit, "patient_name": "s1"})
+    assert response.status_code == 202
+    body = response.get_json()
+    assert body["reused"] is False
+
+    events = client.get(body["events"]).get_data(as_text=True)
+    stages = [json.loads(line[len("data: "):])["stage"] for line in events.splitlines()
+              if line.startswith("data: {")]
+    assert stages[0] == "queued" and stages[-1] == "done"
+    assert events.endswith("event: done\ndata: [DONE]\n\n")
+
+    polled = client.get(body["poll"]).get_json()
+    assert polled["status"] == "done" and polled["result"]["findings"] == 2
+    assert client.get("/api/context-jobs/missing").status_code == 404
+
+    upload = client.post("/api/xray-upload", json={
+        "patientId": "p1", "visitId": "v1", "annotationData": {"annotations": [1]},
+        "json": sample_visit, "patient_name": "s1"})
+    assert upload.get_json()["contextJob"]["job_id"] == body["job_id"]
+
+    queued = client.post("/api/rag-chat", json={"json": sample_visit, "patient_name": "s2", "async": True})
+    assert queued.status_code == 202 and queued.get_json()["status"] in ("queued", "running", "done")
+
+
+def test_upload_without_query_stops_waiting_at_the_join_timeout(fake_models, gated, sample_visit, monkeypatch):
+    import app
+    monkeypatch.setattr(app, "context_jobs", fake_models.context_jobs)
+    monkeypatch.setattr(app, "CONTEXT_JOB_JOIN_TIMEOUT", 0.05)
+    client = app.create_app(warm_up_on_start=False).test_client()
+
+    pending = client.post("/api/rag-chat", json={"json": sample_visit, "patient_name": "s1"})
+    assert pending.status_code == 202 and pending.get_json()["status"] == "running"
+
+    streamed = client.post("/api/rag-chat-stream", json={"json": sample_visit, "patient_name": "s1"})
+    event = json.loads(streamed.get_data(as_text=True).split("\n")[0][len("data: "):])
+    assert event["type"] == "context_job" and event["job_id"] == pending.get_json()["job_id"]
+
+    gated.release.set()
+    assert fake_models.context_jobs.get(event["job_id"]).wait(timeout=2)
+
+
+def test_context_lands_in_the_session_record_stored_after_retrieval(fake_models, gated, sample_visit):
+    fake_models.session_state.get_session("s1")
+    job, _ = fake_models.start_context_job(sample_visit, "s1")
+
+    # The record is replaced while CDT retrieval runs (evicted, or reloaded from a shared backend)
+    fake_models.session_state.clear_session("s1")
+    gated.release.set()
+    assert job.wait(timeout=2) and job.state == "done"
+    assert "Tooth 14" in fake_models.session_state.get_current_thread("s1")["json_context"]
+
+
+def test_question_on_a_still_loading_upload_gets_the_job_links(fake_models, gated, sample_visit, monkeypatch):
+    import app
+    monkeypatch.setattr(fake_models, "CONTEXT_JOB_JOIN_TIMEOUT", 0.05)
+    client = app.create_app(warm_up_on_start=False).test_client()
+    job, _ = fake_models.start_context_job(sample_visit, "s1")
+
+    answered = client.post("/api/rag-chat", json={"patient_name": "s1", "query": "What are the findings?"})
+    assert answered.status_code == 202
+    assert answered.get_json()["job_id"] == job.job_id and "still loading" in answered.get_json()["error"]
+
+    streamed = client.post("/api/rag-chat-stream", json={"patient_name": "s1", "query": "What are the findings?"})
+    event = json.loads(streamed.get_data(as_text=True).split("\n")[0][len("data: "):])
+    assert event["type"] == "context_job" and event["job_id"] == job.job_id
+
+    gated.release.set()
+    assert job.wait(timeout=2)
+    assert client.post("/api/rag-chat", json={"patient_name": "s1", "query": "What are the findings?"}).status_code == 200
+
+
+@pytest.mark.parametrize("route", ["/api/rag-chat", "/api/rag-chat-stream"])
+def test_question_after_a_failed_upload_reports_the_failure_once(fake_models, monkeypatch, route):
+    import app
+    invoked = []
+    monkeypatch.setattr(fake_models._llm, "invoke", lambda prompt, **kwargs: invoked.append(prompt) or "Response: ok")
+    client = app.create_app(warm_up_on_start=False).test_client()
+    job, _ = fake_models.start_context_job("{not json", "s1")
+    job.wait(timeout=2)
+
+    failed = client.post(route, json={"patient_name": "s1", "query": "What are the findings?"})
+    if route == "/api/rag-chat":
+        assert failed.status_code == 500 and "could not be loaded" in failed.get_json()["error"]
+    else:
+        event = json.loads(failed.get_data(as_text=True).split("\n")[0][len("data: "):])
+        assert event["type"] == "error" and "could not be loaded" in event["content"]
+    assert not invoked
+
+    # Once reported, later questions answer from whatever context the session has
+    assert client.post(route, json={"patient_name": "s1", "query": "What are the findings?"}).status_code == 200
+
+
+@pytest.mark.parametrize("ollama_up, kind, text", [(True, "context", "✅"), (False, "error", "ollama down")])
+def test_stream_upload_without_query_sends_the_job_message(fake_models, sample_visit, monkeypatch,
+                                                           ollama_up, kind, text):
+    import app
+    if not ollama_up:
+        def down(queries, k=10):
+            raise ConnectionError("ollama down")
+        monkeypatch.setattr(fake_models._cdt, "rank_batch", down)
+    client = app.create_app(warm_up_on_start=False).test_client()
+
+    body = client.post("/api/rag-chat-stream", json={"json": sample_visit, "patient_name": "s1"})
+    event = json.loads(body.get_data(as_text=True).split("\n")[0][len("data: "):])
+    assert event["type"] == kind and text in event["content"]
@@ -0,0 +1,109 @@
+import threading
+import time
+
+import pytest
+
+from cdt_match_cache import CDTMatchCache
+from conftest import FakeEmbedder
+from context_loader import ContextLoader
+
+
+class RecordingEmbedder(FakeEmbedder):
+    """FakeEmbedder that records each rank_batch call, its thread and the peak overlap"""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.calls = []
+        self.threads = set()
+        self._active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def rank_batch(self, queries, k=10):
+        with self._lock:
+            self.calls.append(list(queries))
+            self.threads.add(threading.current_thread().name)
+            self._active += 1
+            self.peak = max(self.peak, self._active)
+        time.sleep(self.delay)
+        with self._lock:
+            self._active -= 1
+        return super().rank_batch(queries, k)
+
+
+def full_mouth(descriptions):
+    return {"teeth": [
+        {"number": tooth, "anomalies": [{"description": descriptions[tooth % len(descriptions)],
+                                         "metadata": {"confidence": 0.8}}]}
+        for tooth in range(1, 33)
+    ]}
+
+
+@pytest.fixture
+def loader(fake_models, monkeypatch):
+    loader = ContextLoader(max_workers=4, batch_size=4)
+    monkeypatch.setattr(fake_models, "context_loader", loader)
+    return loader
+
+
+def test_duplicate_findings_are_retrieved_once(fake_models, loader, monkeypatch):
+    embedder = RecordingEmbedder(delay=0)
+    monkeypatch.setattr(fake_models, "_cdt", embedder)
+    data = full_mouth(["Caries", "caries ", "Periapical lesion", "CARIES", "Bone loss"])
+
+    _, findings, cdt_matches = fake_models.load_case_context(data)
+    assert len(findings) == 32
+    assert sorted(sum(embedder.calls, [])) == ["bone loss", "caries", "periapical lesion"]
+    assert cdt_matches.count("Finding: Tooth") == 32
+    assert loader.stats()["unique"] == 3
+
+
+def test_misses_fan_out_over_the_pool(fake_models, loader, monkeypatch):
+    embedder = RecordingEmbedder()
+    monkeypatch.setattr(fake_models, "_cdt", embedder)
+    data = full_mouth([f"finding {i}" for i in range(16)])
+
+    fake_models.load_case_context(data)
+    assert len(embedder.calls) == 4 and all(len(call) == 4 for call in embedder.calls)
+    assert embedder.peak > 1
+    assert all(name.startswith("context-loader") for name in embedder.threads)
+
+
+def test_rendering_overlaps_retrieval(fake_models, loader, monkeypatch):
+    rendered = threading.Event()
+    render = fake_models.json_to_full_text
+
+    class WaitingEmbedder(FakeEmbedder):
+        def rank_batch(self, queries, k=10):
+            # Sequential loading would render only after this returns
+            assert rendered.wait(timeout=2), "context text was not rendered while retrieval ran"
+            return super().rank_batch(queries, k)
+
+    def render_and_signal(data):
+        text = render(data)
+        rendered.set()
+        return text
+
+    monkeypatch.setattr(fake_models, "_cdt", WaitingEmbedder())
+    monkeypatch.setattr(fake_models, "json_to_full_text", render_and_signal)
+    json_context, _, cdt_matches = fake_models.load_case_context(full_mouth(["Caries"]))
+    assert "Tooth 1: Caries" in json_context
+    assert "D" in cdt_matches
+
+
+def test_cache_hits_skip_retrieval_and_results_match_sequential(fake_models, monkeypatch, tmp_path):
+    embedder = RecordingEmbedder(delay=0)
+    cache = CDTMatchCache(str(tmp_path / "matches.sqlite3"), "test")
+    monkeypatch.setattr(fake_models, "_cdt", embedder)
+    monkeypatch.setattr(fake_models, "_cdt_match_cache", cache)
+    data = full_mouth(["Caries", "Periapical lesion", "Bone loss", "Calculus", "Abscess"])
+
+    monkeypatch.setattr(fake_models, "context_loader", ContextLoader(max_workers=0, batch_size=2))
+    _, findings, inline = fake_models.load_case_context(data)
+    assert len(embedder.calls) == 3
+
+    monkeypatch.setattr(fake_models, "context_loader", ContextLoader(max_workers=4, batch_size=2))
+    _, _, pooled = fake_models.load_case_context(data)
+    assert len(embedder.calls) == 3
+    assert fake_models.context_loader.stats()["cached"] == 5
+    assert pooled == inline == fake_models.format_finding_matches(findings)[0]
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+import embedding_cache
+from embedding_cache import EmbeddingCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(embedding_cache.time, "time", clock.time)
+    return clock
+
+
+@pytest.fixture
+def exit_hooks(monkeypatch):
+    """Collect the atexit saves instead of running them when pytest exits"""
+    hooks = []
+    monkeypatch.setattr(embedding_cache.atexit, "register", hooks.append)
+    return hooks
+
+
+def vector(seed):
+    return np.full(4, seed, dtype=np.float32)
+
+
+def test_lru_eviction_and_counters():
+    cache = EmbeddingCache(maxsize=2)
+    cache.put("a", vector(1))
+    cache.put("b", vector(2))
+    assert cache.get("a") is not None  # "b" is now least recently used
+    cache.put("c", vector(3))
+
+    assert cache.get("b") is None
+    np.testing.assert_array_equal(cache.get("c"), vector(3))
+    assert cache.stats() == {"size": 2, "maxsize": 2, "hits": 2, "misses": 1, "evictions": 1,
+                             "hit_rate": 2 / 3}
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = EmbeddingCache(ttl=60)
+    cache.put("a", vector(1))
+    clock.advance(60)
+    assert cache.get("a") is not None
+    clock.advance(1)
+    assert cache.get("a") is None and len(cache) == 0
+    assert cache.stats()["misses"] == 1
+
+
+def test_zero_size_disables_the_cache():
+    cache = EmbeddingCache(maxsize=0)
+    cache.put("a", vector(1))
+    assert cache.get("a") is None and len(cache) == 0
+
+
+def test_save_and_load_round_trip(tmp_path, clock, exit_hooks):
+    path = str(tmp_path / "queries.npz")
+    cache = EmbeddingCache(ttl=60, path=path, namespace="nomic|query: |2")
+    assert exit_hooks == [cache.save]
+    cache.put("expired", vector(1))
+    clock.advance(61)
+    cache.put("caries", vector(2))
+    cache.put("periapical lesion", vector(3))
+    cache.save()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["queries.npz"]
+
+    loaded = EmbeddingCache(maxsize=1, path=path, namespace="nomic|query: |2")
+    # Only live entries are written, and the most recent ones fill a smaller cache
+    assert len(loaded) == 1 and loaded.get("expired") is None
+    np.testing.assert_array_equal(loaded.get("periapical lesion"), vector(3))
+    assert loaded.get("periapical lesion").dtype == np.float32
+
+
+def test_cache_for_another_model_is_ignored(tmp_path, exit_hooks):
+    path = str(tmp_path / "queries.npz")
+    cache = EmbeddingCache(path=path, namespace="nomic-embed-text|query: |2")
+    cache.put("caries", vector(1))
+    cache.save()
+
+    other = EmbeddingCache(path=path, namespace="mxbai-embed-large|query: |2")
+    assert len(other) == 0 and other.get("caries") is None
+
+
+def test_unreadable_cache_file_is_ignored(tmp_path, exit_hooks):
+    path = tmp_path / "queries.npz"
+    path.write_bytes(b"not an npz file")
+    cache = EmbeddingCache(path=str(path))
+    assert len(cache) == 0
+
+    cache.put("caries", vector(1))
+    cache.save()
+    assert len(EmbeddingCache(path=str(path))) == 1
@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+from llm_scheduler import (PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_STANDARD, LLMScheduler,
+                           QueueFullError)
+
+
+def granted(tickets):
+    return [ticket.granted_at is not None for ticket in tickets]
+
+
+def test_in_flight_limit():
+    scheduler = LLMScheduler(max_in_flight=2, max_queue=10)
+    tickets = [scheduler.reserve() for _ in range(3)]
+    assert granted(tickets) == [True, True, False]
+    assert scheduler.stats()["in_flight"] == 2 and scheduler.stats()["queued"] == 1
+
+    tickets[0].release()
+    assert granted(tickets) == [True, True, True]
+    assert scheduler.stats()["in_flight"] == 2 and scheduler.stats()["queued"] == 0
+
+
+def test_priority_order_fifo_within_a_class():
+    scheduler = LLMScheduler(max_in_flight=1, max_queue=10)
+    running = scheduler.reserve()
+    bulk = scheduler.reserve(PRIORITY_BULK)
+    standard = scheduler.reserve(PRIORITY_STANDARD)
+    first = scheduler.reserve(PRIORITY_INTERACTIVE)
+    second = scheduler.reserve(PRIORITY_INTERACTIVE)
+
+    waiting = [first, second, standard, bulk]
+    assert granted(waiting) == [False, False, False, False]
+    for ticket, expected in zip([running] + waiting, ([True, False, False, False], [True, True, False, False],
+                                                      [True, True, True, False], [True, True, True, True])):
+        ticket.release()
+        assert granted(waiting) == expected
+
+
+def test_full_queue_rejects_with_retry_after():
+    scheduler = LLMScheduler(max_in_flight=1, max_queue=1)
+    scheduler.reserve()
+    scheduler.reserve(PRIORITY_BULK)
+    with pytest.raises(QueueFullError) as excinfo:
+        scheduler.reserve(PRIORITY_STANDARD)
+    assert excinfo.value.retry_after >= 1 and excinfo.value.priority == PRIORITY_STANDARD
+    assert scheduler.stats()["classes"]["standard"]["rejected"] == 1
+
+
+def test_release_is_idempotent():
+    scheduler = LLMScheduler(max_in_flight=1, max_queue=10)
+    running = scheduler.reserve()
+    queued = scheduler.reserve()
+    behind = scheduler.reserve()
+
+    # Giving up a queued place twice frees it once, and its heap entry is skipped
+    queued.release()
+    queued.release()
+    assert scheduler.stats()["queued"] == 1
+
+    running.release()
+    running.release()
+    assert behind.granted_at is not None and queued.granted_at is None
+    assert scheduler.stats()["in_flight"] == 1 and scheduler.stats()["queued"] == 0
+    behind.release()
+    assert scheduler.stats()["in_flight"] == 0
+
+
+def test_wait_timeout_gives_up_the_place():
+    scheduler = LLMScheduler(max_in_flight=1, max_queue=10)
+    scheduler.reserve()
+    ticket = scheduler.reserve()
+    with pytest.raises(TimeoutError):
+        ticket.wait(timeout=0.01)
+    assert ticket.released and scheduler.stats()["queued"] == 0
+
+
+def test_cancelled_async_wait_gives_up_the_place():
+    scheduler = LLMScheduler(max_in_flight=1, max_queue=10)
+    running = scheduler.reserve()
+
+    async def waiter():
+        ticket = scheduler.reserve()
+        task = asyncio.ensure_future(ticket.wait_async())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return ticket
+
+    ticket = asyncio.run(waiter())
+    assert ticket.released and scheduler.stats()["queued"] == 0
+    running.release()
+    assert scheduler.stats()["in_flight"] == 0
+
+
+def test_abandoned_stream_releases_its_slot(fake_models, monkeypatch, sample_visit):
+    from conftest import FakeClient
+
+    scheduler = LLMScheduler(max_in_flight=1, max_queue=10)
+    monkeypatch.setattr(fake_models, "llm_scheduler", scheduler)
+    streams = []
+    chat = FakeClient.chat
+    monkeypatch.setattr(FakeClient, "chat", lambda self, **kwargs: streams.append(chat(self, **kwargs)) or streams[-1])
+    fake_models.handle_json_text_input(sample_visit, [], "s1")
+
+    stream = fake_models.enhanced_chat_with_medbot_stream("What are the anomalies?", [], "s1")
+    assert next(stream)
+    assert scheduler.stats()["in_flight"] == 1
+    stream.close()  # the client went away mid-answer
+    assert scheduler.stats()["in_flight"] == 0 and streams[0].closed
+
+
+@pytest.mark.parametrize("route", ["/api/rag-chat", "/api/rag-chat-stream"])
+def test_full_queue_answers_429(fake_models, monkeypatch, route):
+    from app import create_app
+
+    scheduler = LLMScheduler(max_in_flight=1, max_queue=0)
+    monkeypatch.setattr(fake_models, "llm_scheduler", scheduler)
+    running = scheduler.reserve()
+    client = create_app(warm_up_on_start=False).test_client()
+
+    response = client.post(route, json={"patient_name": "s1", "query": "What is a periapical lesion?"})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) == response.get_json()["retry_after"] >= 1
+    assert "queue is full" in response.get_json()["error"]
+    running.release()
@@ -0,0 +1,104 @@
+import asyncio
+import threading
+
+import ollama
+import pytest
+from werkzeug.serving import make_server
+
+from tools.fake_ollama import FakeOllamaConfig, FakeOllamaServer, Recorder
+from tools.sse_load import percentile, run_load, summarize
+
+
+def serve(config=None, **kwargs):
+    server = FakeOllamaServer(("127.0.0.1", 0), config or FakeOllamaConfig(ttft=0, tokens_per_sec=0), **kwargs)
+    server.start()
+    return server
+
+
+@pytest.fixture
+def fake_ollama():
+    server = serve(FakeOllamaConfig(ttft=0.01, tokens_per_sec=0, response_tokens=12, load_seconds=0.05))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_chat_generate_and_embed(fake_ollama):
+    client = ollama.Client(host=fake_ollama.url)
+    messages = [{"role": "user", "content": "Which teeth need attention?"}]
+
+    chunks = list(client.chat(model="mistral:latest", messages=messages, stream=True))
+    text = "".join(c["message"]["content"] for c in chunks)
+    assert len(chunks) == 13 and chunks[-1]["done"] and chunks[-1]["eval_count"] == 12
+    assert chunks[-1]["load_duration"] == pytest.approx(0.05e9)
+    assert client.chat(model="mistral:latest", messages=messages)["message"]["content"] == text
+
+    assert client.generate(model="mistral:latest", prompt="")["response"] == ""
+    first = client.embed(model="nomic-embed-text", input=["caries", "bone loss"])["embeddings"]
+    assert len(first) == 2 and len(first[0]) == 768
+    assert client.embed(model="nomic-embed-text", input=["caries"])["embeddings"][0] == first[0]
+    assert {m["model"] for m in client.ps()["models"]} == {"mistral:latest", "nomic-embed-text"}
+
+
+def test_injected_failures(fake_ollama):
+    client = ollama.Client(host=fake_ollama.url)
+    messages = [{"role": "user", "content": "hi"}]
+
+    fake_ollama.config.fail_rate = 1.0
+    with pytest.raises(ollama.ResponseError):
+        client.chat(model="mistral:latest", messages=messages)
+
+    fake_ollama.config.fail_rate = 0.0
+    fake_ollama.config.stream_fail_rate = 1.0
+    with pytest.raises(ollama.ResponseError, match="mid-stream"):
+        list(client.chat(model="mistral:latest", messages=messages, stream=True))
+    assert fake_ollama.counts["failed"] == 1 and fake_ollama.counts["stream_failed"] == 1
+
+
+def test_record_and_replay(fake_ollama, tmp_path):
+    path = tmp_path / "sessions.jsonl"
+    proxy = serve(upstream=fake_ollama.url, recorder=Recorder(record_path=str(path)))
+    messages = [{"role": "user", "content": "Create treatment plan"}]
+    recorded = list(ollama.Client(host=proxy.url).chat(model="mistral:latest", messages=messages, stream=True))
+    proxy.shutdown()
+
+    # The replaying server would answer with a single token on its own
+    replay = serve(FakeOllamaConfig(ttft=0, tokens_per_sec=0, response_tokens=1),
+                   recorder=Recorder(replay_path=str(path)))
+    client = ollama.Client(host=replay.url)
+    replayed = list(client.chat(model="mistral:latest", messages=messages, stream=True))
+    assert [c["message"]["content"] for c in replayed] == [c["message"]["content"] for c in recorded]
+    text = "".join(c["message"]["content"] for c in recorded)
+    assert client.chat(model="mistral:latest", messages=messages)["message"]["content"] == text
+    assert replay.counts["replayed"] == 2
+    replay.shutdown()
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 101))
+    assert [percentile(values, p) for p in (50, 95, 99)] == [50, 95, 99]
+    assert percentile([], 50) is None
+
+
+def test_load_run_against_the_app(fake_models, fake_ollama, monkeypatch):
+    import app
+    import prompt_budget
+
+    # The fake's prompt_eval_count recalibrates the shared token estimate; put it back afterwards
+    monkeypatch.setattr(prompt_budget.token_counter, "scale", prompt_budget.token_counter.scale)
+    monkeypatch.setattr(fake_models, "get_client", lambda: ollama.Client(host=fake_ollama.url))
+    monkeypatch.setattr(app, "session_state", fake_models.session_state)
+    monkeypatch.setattr(fake_models.answer_cache, "maxsize", 0)  # every question reaches the model
+    server = make_server("127.0.0.1", 0, app.create_app(warm_up_on_start=False), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        results, elapsed = asyncio.run(run_load(f"http://127.0.0.1:{server.port}", concurrency=4, requests=8,
+                                                questions=["Which teeth need attention first?"]))
+    finally:
+        server.shutdown()
+
+    summary = summarize(results, elapsed)
+    assert summary["requests"] == 8 and summary["ok"] == 8 and summary["error_rate"] == 0
+    assert summary["time_to_first_chunk_ms"]["p50"] is not None
+    assert summary["chunks_per_second"] > 0 and summary["inter_chunk_gap_ms"]["p99"] is not None
+    assert fake_ollama.counts["/api/chat"] == 8
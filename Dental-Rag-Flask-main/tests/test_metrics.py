@@ -0,0 +1,97 @@
+import pytest
+
+pytest.importorskip("prometheus_client")
+
+from prometheus_client import REGISTRY  # noqa: E402
+
+import metrics  # noqa: E402
+from conftest import FakeStream  # noqa: E402
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+class DoneClient:
+    """Streams a few tokens and finishes with Ollama's timing fields"""
+
+    def chat(self, model=None, messages=None, stream=False, **kwargs):
+        chunks = [{"message": {"content": f"tok{i} "}} for i in range(4)]
+        chunks.append({"message": {"content": ""}, "done": True, "prompt_eval_count": 100,
+                       "eval_count": 40, "eval_duration": 2_000_000_000})
+        return FakeStream(chunks)
+
+
+def test_stream_records_stages_speed_and_outcome(fake_models, monkeypatch, sample_visit):
+    monkeypatch.setattr(fake_models, "get_client", lambda: DoneClient())
+    route = {"route": "comprehensive"}
+    stages = ("prompt_build", "queue_wait", "time_to_first_token", "stream")
+    before = {stage: sample("rag_stage_seconds_count", stage=stage, **route) for stage in stages}
+    before.update({
+        "prompt": sample("rag_prompt_tokens_count", **route),
+        "tps": sample("rag_llm_tokens_per_second_sum", **route),
+        "tokens": sample("rag_llm_generated_tokens_total", **route),
+        "ok": sample("rag_generations_total", outcome="ok", **route),
+        "retrieval": sample("rag_stage_seconds_count", route="upload", stage="cdt_retrieval"),
+        "load": sample("rag_stage_seconds_count", route="upload", stage="context_load"),
+    })
+
+    fake_models.handle_json_text_input(sample_visit, [], "s1")
+    "".join(fake_models.enhanced_chat_with_medbot_stream("What are the anomalies?", [], "s1"))
+
+    assert sample("rag_prompt_tokens_count", **route) == before["prompt"] + 1
+    for stage in stages:
+        assert sample("rag_stage_seconds_count", stage=stage, **route) == before[stage] + 1
+    assert sample("rag_llm_tokens_per_second_sum", **route) == pytest.approx(before["tps"] + 20)
+    assert sample("rag_llm_generated_tokens_total", **route) == before["tokens"] + 40
+    assert sample("rag_generations_total", outcome="ok", **route) == before["ok"] + 1
+    assert sample("rag_stage_seconds_count", route="upload", stage="cdt_retrieval") > before["retrieval"]
+    assert sample("rag_stage_seconds_count", route="upload", stage="context_load") == before["load"] + 1
+
+
+def test_blocking_answers_count_cached_and_errors(fake_models, monkeypatch):
+    route = {"route": "general"}
+    question = "What is a periapical lesion?"
+    ok = sample("rag_generations_total", outcome="ok", **route)
+    cached = sample("rag_generations_total", outcome="cached", **route)
+    generated = sample("rag_stage_seconds_count", stage="generate", **route)
+
+    fake_models.enhanced_chat_with_medbot(question, [], "s1")
+    fake_models.enhanced_chat_with_medbot(question, [], "s1")
+    assert sample("rag_generations_total", outcome="ok", **route) == ok + 1
+    assert sample("rag_generations_total", outcome="cached", **route) == cached + 1
+    assert sample("rag_stage_seconds_count", stage="generate", **route) == generated + 1
+
+    class BrokenLLM:
+        def invoke(self, prompt, **kwargs):
+            raise RuntimeError("model not found")
+
+    errors = sample("rag_generations_total", outcome="error", **route)
+    monkeypatch.setattr(fake_models, "_llm", BrokenLLM())
+    _, history = fake_models.enhanced_chat_with_medbot("Explain bone loss", [], "s1")
+    assert history[-1][1].startswith("⚠️")
+    assert sample("rag_generations_total", outcome="error", **route) == errors + 1
+
+
+def test_metrics_endpoint(fake_models, sample_visit):
+    from app import create_app
+
+    client = create_app(warm_up_on_start=False).test_client()
+    parsed = sample("rag_stage_seconds_count", route="upload", stage="json_parse")
+    transformed = sample("rag_stage_seconds_count", route="upload", stage="transform_anomalies")
+    client.post("/api/rag-chat", json={"patient_name": "s1", "json": sample_visit})
+
+    response = client.get("/metrics")
+    assert response.status_code == 200 and response.content_type.startswith("text/plain")
+    body = response.get_data(as_text=True)
+    assert "rag_stage_seconds_bucket" in body and "rag_generations_total" in body
+    assert sample("rag_stage_seconds_count", route="upload", stage="json_parse") == parsed + 1
+    assert sample("rag_stage_seconds_count", route="upload", stage="transform_anomalies") == transformed + 1
+
+
+def test_span_records_failed_blocks():
+    count = sample("rag_stage_seconds_count", route="upload", stage="test_failure")
+    with pytest.raises(ValueError):
+        with metrics.span("test_failure"):
+            raise ValueError("boom")
+    assert sample("rag_stage_seconds_count", route="upload", stage="test_failure") == count + 1
@@ -0,0 +1,88 @@
+import os
+
+import model_residency
+from model_residency import ModelResidency
+
+
+class FakeOllama:
+    """generate/embed/ps with a set of loaded models; loading a cold one takes 3 s of load_duration"""
+
+    def __init__(self):
+        self.loaded = set()
+        self.calls = []
+
+    def _load(self, model):
+        cold = model not in self.loaded
+        self.loaded.add(model)
+        return {"load_duration": 3_000_000_000 if cold else 2_000_000}
+
+    def generate(self, model=None, prompt=None, options=None, keep_alive=None):
+        self.calls.append(("generate", model, prompt, options, keep_alive))
+        return self._load(model)
+
+    def embed(self, model=None, input=None, keep_alive=None):
+        self.calls.append(("embed", model, keep_alive))
+        return self._load(model)
+
+    def ps(self):
+        return {"models": [{"model": model, "expires_at": "2026-01-01T00:00:00Z"} for model in sorted(self.loaded)]}
+
+
+def make_residency(monkeypatch):
+    ollama = FakeOllama()
+    monkeypatch.setattr(model_residency, "get_client", lambda: ollama)
+    residency = ModelResidency(interval=0, load_event_seconds=0.5)
+    residency.pin("mistral:latest", "30m", options={"num_ctx": 4096})
+    residency.pin("nomic-embed-text", "1h", kind="embed")
+    return residency, ollama
+
+
+def test_prewarm_loads_with_keep_alive_and_request_options(monkeypatch):
+    residency, ollama = make_residency(monkeypatch)
+    residency.prewarm()
+
+    assert ollama.calls[0] == ("generate", "mistral:latest", "", {"num_ctx": 4096}, "30m")
+    assert ollama.calls[1] == ("embed", "nomic-embed-text", "1h")
+    stats = residency.stats()
+    assert stats["models"]["mistral:latest"]["loads"] == 1
+    assert stats["models"]["nomic-embed-text:latest"]["resident"] is True
+    assert [event["reason"] for event in stats["load_events"]] == ["warm-up", "warm-up"]
+
+    # Already loaded: no new load events
+    residency.prewarm()
+    assert residency.stats()["models"]["mistral:latest"]["loads"] == 1
+
+
+def test_check_reloads_unloaded_models(monkeypatch):
+    residency, ollama = make_residency(monkeypatch)
+    residency.prewarm()
+    assert residency.check() == []
+
+    ollama.loaded.discard("mistral:latest")
+    assert residency.check() == ["mistral:latest"]
+    model = residency.stats()["models"]["mistral:latest"]
+    assert model["unloads"] == 1 and model["loads"] == 2 and model["resident"] is True
+    assert "mistral:latest" in ollama.loaded
+
+
+def test_observe_reports_cold_loads_only(monkeypatch):
+    residency, _ = make_residency(monkeypatch)
+    residency.observe("mistral:latest", {"done": True, "load_duration": 4_000_000}, "comprehensive")
+    residency.observe("mistral:latest", {"done": True}, "comprehensive")
+    assert residency.stats()["load_events"] == []
+
+    residency.observe("mistral:latest", {"done": True, "load_duration": 7_500_000_000}, "comprehensive")
+    event = residency.stats()["load_events"][-1]
+    assert event["reason"] == "request (comprehensive)" and event["seconds"] == 7.5
+
+
+def test_start_runs_one_keeper_per_process(monkeypatch):
+    residency, _ = make_residency(monkeypatch)
+    residency.interval = 3600
+    residency.start()
+    keeper = residency._keeper
+    residency.start()
+    assert residency._keeper is keeper and residency._keeper_pid == os.getpid()
+    residency.stop()
+    keeper.join(timeout=1)
+    assert not keeper.is_alive()
@@ -0,0 +1,79 @@
+import pytest
+
+import session_store
+from patient_context import PatientContextBuilder, fingerprint_history
+from prompt_budget import fit_visits
+from session_store import SessionState
+
+
+def visit(i, teeth=4):
+    return {
+        "timestamp": f"2024-01-{i + 1:02d}",
+        "visit_id": f"v{i}",
+        "findings": [{"tooth": t, "description": "Caries", "metadata": {"confidence": 0.8}} for t in range(teeth)],
+        "cdt_matches": "Tooth 1: D2391",
+    }
+
+
+@pytest.fixture
+def builder(monkeypatch):
+    builder = PatientContextBuilder()
+    monkeypatch.setattr(session_store, "patient_contexts", builder)
+    return builder
+
+
+def test_matches_uncached_rendering(builder):
+    history = [visit(i) for i in range(30, 0, -1)]
+    for budget in (None, 4000, 700):
+        expected, _ = fit_visits(history, budget // 256 * 256 if budget else None)
+        assert builder.render(history, fingerprint_history(history), budget) == expected
+
+
+def test_follow_up_questions_hit_the_cache(builder):
+    state = SessionState()
+    state.set_current_patient("s1", "p-1", "Jane Doe", [visit(i) for i in range(50, 0, -1)])
+    first = state.get_patient_context("s1", max_tokens=3100)
+    rendered = builder.stats()["visits_rendered"]
+
+    # Different question lengths leave slightly different budgets
+    for extra in range(0, 150, 15):
+        assert state.get_patient_context("s1", max_tokens=3100 + extra) == first
+    stats = builder.stats()
+    assert stats["visits_rendered"] == rendered == 50
+    assert stats["hits"] == 10 and stats["misses"] == 1
+
+
+def test_new_visit_only_renders_itself(builder):
+    state = SessionState()
+    history = [visit(i) for i in range(20, 0, -1)]
+    state.set_current_patient("s1", "p-1", "Jane Doe", history)
+    state.get_patient_context("s1")
+
+    state.set_current_patient("s1", "p-1", "Jane Doe", [visit(21)] + history)
+    context = state.get_patient_context("s1")
+    assert builder.stats()["visits_rendered"] == 21
+    assert "--- Visit 1 (2024-01-22) ---" in context
+    assert "21 previous visits" in context
+
+
+def test_stream_and_blocking_chat_share_the_block(builder, fake_models):
+    state = fake_models.session_state
+    state.set_current_patient("s1", "p-1", "Jane Doe", [visit(i) for i in range(40, 0, -1)])
+
+    fake_models.prepare_stream_request("summarize the findings", [], "s1")
+    fake_models.enhanced_chat_with_medbot("summarize the findings", [], "s1")
+    fake_models.prepare_stream_request("summarize the findings again", [], "s1")
+    stats = builder.stats()
+    assert stats["misses"] == 1 and stats["hits"] == 2
+
+
+def test_sessions_reloaded_from_a_backend_reuse_the_cache(builder, tmp_path):
+    from session_backends import SQLiteSessionBackend
+
+    path = str(tmp_path / "sessions.sqlite3")
+    SessionState(backend=SQLiteSessionBackend(path)).set_current_patient(
+        "s1", "p-1", "Jane Doe", [visit(i) for i in range(10, 0, -1)])
+    first = SessionState(backend=SQLiteSessionBackend(path)).get_patient_context("s1")
+    second = SessionState(backend=SQLiteSessionBackend(path)).get_patient_context("s1")
+    assert first == second
+    assert builder.stats()["hits"] == 1
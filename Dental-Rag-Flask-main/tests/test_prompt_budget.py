@@ -0,0 +1,145 @@
+import pytest
+
+import prompt_budget
+from prompt_budget import (
+    PROMPT_MAX_CTX,
+    PROMPT_RESPONSE_TOKENS,
+    TokenCounter,
+    context_size,
+    fit_visits,
+    render_visit_json,
+    summarize_visit,
+)
+
+
+def make_history(visits, teeth=6):
+    """Newest first, like the history the backend sends"""
+    return [
+        {
+            "timestamp": f"2024-{12 - i % 12:02d}-01",
+            "visit_id": f"v{i}",
+            "findings": [
+                {"tooth": t + 1, "description": "Caries", "metadata": {"confidence": 0.5 + t / 100, "bbox": [t, t, 40, 40]}}
+                for t in range(teeth)
+            ],
+            "cdt_matches": "Tooth 1: D2391, D2392",
+        }
+        for i in range(visits)
+    ]
+
+
+def test_estimate_counts_digits_and_symbols():
+    counter = TokenCounter()
+    assert counter.count("") == 0
+    assert counter.count("12345") == 5
+    assert counter.count('{"a": 1}') == 7
+    assert counter.count("caries") == 2
+
+
+def test_calibration_moves_estimate_toward_real_counts():
+    counter = TokenCounter()
+    text = "periapical lesion on the mesial root " * 20
+    estimated = counter.count(text)
+    for _ in range(50):
+        counter.calibrate(counter.count(text), estimated * 1.5)
+    assert counter.count(text) == pytest.approx(estimated * 1.5, rel=0.05)
+
+
+def test_context_size_is_bucketed():
+    assert context_size(10) == prompt_budget.PROMPT_MIN_CTX
+    assert context_size(prompt_budget.PROMPT_MIN_CTX) == prompt_budget.PROMPT_MIN_CTX * 2
+    assert context_size(10 ** 6) == PROMPT_MAX_CTX
+
+
+def test_recent_visits_full_and_older_summarized():
+    history = make_history(6)
+    text, stats = fit_visits(history, budget=None, recent=2)
+    assert (stats["full"], stats["summarized"], stats["folded"]) == (2, 4, 0)
+    assert text.count("Findings: ") == 2
+    assert f"Visit 6 (2024-07-01): {summarize_visit(history[5])}" in text
+    assert "#3 Caries (0.52)" in summarize_visit(history[0])
+
+
+@pytest.mark.parametrize("budget", [2000, 500, 150, 20])
+def test_history_fits_budget(budget):
+    text, stats = fit_visits(make_history(200), budget=budget, recent=2)
+    assert stats["tokens"] <= max(budget, 128)
+    assert TokenCounter().count(text) <= max(budget, 128)
+    assert stats["full"] + stats["summarized"] + stats["folded"] == 200
+    if stats["folded"]:
+        assert "earlier visits not shown" in text
+
+
+def test_recent_visits_are_kept_in_full_before_older_ones():
+    history = make_history(40)
+    full_cost = fit_visits(history[:2], budget=None, recent=2)[1]["tokens"]
+    text, stats = fit_visits(history, budget=full_cost + 300, recent=2)
+    assert stats["full"] == 2
+    assert stats["folded"] > 0
+
+
+def test_raw_history_drops_oldest_to_summaries_first():
+    history = make_history(30)
+    text, stats = fit_visits(history, budget=3000, render_full=render_visit_json, recent=len(history))
+    assert 0 < stats["full"] < 30
+    assert text.startswith("--- Visit 1 ")
+    assert '"visit_id": "v0"' in text
+
+
+def test_long_history_prompt_stays_inside_context(fake_models):
+    state = fake_models.session_state
+    state.set_current_patient("s1", "p-1", "Jane Doe", make_history(300, teeth=12))
+
+    for question in ["full history please", "what is a crown", "summarize the findings"]:
+        plan = fake_models.prepare_stream_request(question, [], "s1")
+        assert plan["prompt_tokens"] + PROMPT_RESPONSE_TOKENS <= plan["num_ctx"] <= PROMPT_MAX_CTX
+        assert "\x00" not in plan["prompt"]
+
+    routes = prompt_budget.prompt_stats.stats()["routes"]
+    assert {"history", "general", "comprehensive"} <= set(routes)
+
+
+def test_invoke_passes_num_ctx(fake_models, monkeypatch):
+    seen = {}
+
+    class RecordingLLM:
+        def invoke(self, prompt, **kwargs):
+            seen.update(kwargs)
+            return "Response: ok"
+
+    monkeypatch.setattr(fake_models, "_llm", RecordingLLM())
+    fake_models.session_state.set_current_patient("s1", "p-1", "Jane Doe", make_history(50))
+    fake_models.enhanced_chat_with_medbot("what is a crown", [], "s1")
+    assert seen["num_ctx"] in (prompt_budget.PROMPT_MIN_CTX, prompt_budget.PROMPT_MIN_CTX * 2, PROMPT_MAX_CTX)
+
+
+def test_follow_up_prompts_share_the_context_prefix(fake_models, sample_visit):
+    fake_models.handle_json_text_input(sample_visit, [], "s1")
+    fake_models.session_state.set_current_patient("s1", "p-1", "Jane Doe", make_history(5))
+
+    first = fake_models.prepare_stream_request("summarize the findings", [], "s1")["prompt"]
+    second = fake_models.prepare_stream_request("which teeth need attention first", [], "s1")["prompt"]
+    prefix = first[:first.rindex("summarize the findings")]
+    assert second.startswith(prefix)
+    # Instructions, then history, then the current case; nothing but the answer cue after the question
+    sections = ["INTELLIGENT RESPONSE GUIDELINES", "**PATIENT HISTORY** (", "**CURRENT VISIT DATA:**", "**Question**"]
+    positions = [prefix.index(section) for section in sections]
+    assert positions == sorted(positions)
+    assert first.endswith("summarize the findings\n\n**Response**:\n")
+
+
+def test_blocking_and_stream_prompts_match(fake_models, monkeypatch, sample_visit):
+    prompts = []
+
+    class RecordingLLM:
+        def invoke(self, prompt, **kwargs):
+            prompts.append(prompt)
+            return "Answer: ok"
+
+    monkeypatch.setattr(fake_models, "_llm", RecordingLLM())
+    monkeypatch.setattr(fake_models.answer_cache, "maxsize", 0)
+    fake_models.handle_json_text_input(sample_visit, [], "s1")
+    fake_models.session_state.set_current_patient("s1", "p-1", "Jane Doe", make_history(3))
+    for question in ["summarize the findings", "create treatment plan", "full history please"]:
+        fake_models.enhanced_chat_with_medbot(question, [], "s1")
+        assert prompts[-1] == fake_models.prepare_stream_request(question, [], "s1")["prompt"]
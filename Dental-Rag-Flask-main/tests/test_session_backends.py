@@ -0,0 +1,278 @@
+import contextvars
+import threading
+
+import pytest
+
+import session_backends
+from conftest import FakeRedis
+from session_backends import (MemorySessionBackend, RedisSessionBackend, SessionBackend, SQLiteSessionBackend,
+                              create_session_backend)
+from session_store import _UNLOADED, SessionState, begin_request
+
+
+class Clock:
+    def __init__(self, redis=None):
+        self.now = 1_000_000.0
+        self.redis = redis
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+        if self.redis is not None:
+            self.redis.advance(seconds)
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def backend_factory(request, tmp_path, monkeypatch):
+    """Returns (new_backend, clock): each call is a fresh client on the same storage, like a restarted worker"""
+    redis = FakeRedis()
+    clock = Clock(redis if request.param == "redis" else None)
+    monkeypatch.setattr(session_backends.time, "time", clock.time)
+
+    def new_backend(ttl=None):
+        if request.param == "sqlite":
+            return SQLiteSessionBackend(str(tmp_path / "sessions.sqlite3"), ttl=ttl)
+        return RedisSessionBackend(redis, ttl=ttl)
+    return new_backend, clock
+
+
+def load_case(state, session_id):
+    state.set_current_patient(session_id, "p-1", "Jane Doe", [{"timestamp": "2024-01-02", "findings": []}])
+    thread_id = state.create_thread(session_id, "Crown follow-up", thread_type="visit")
+    thread = state.get_current_thread(session_id)
+    with state.locked(session_id):
+        thread.update({"json_context": {"teeth": [14]}, "findings": [{"tooth": 14, "anomaly": "Caries"}],
+                       "cdt_matches": "Tooth 14: D2391"})
+    state.append_chat(session_id, [], ("q", "a"), thread=thread)
+    return thread_id
+
+
+def test_session_survives_restart(backend_factory):
+    new_backend, _ = backend_factory
+    load_case(SessionState(backend=new_backend()), "s1")
+
+    restarted = SessionState(backend=new_backend())
+    session = restarted.get_session("s1")
+    assert session["patient_name"] == "Jane Doe"
+    thread = restarted.get_current_thread("s1")
+    assert thread["name"] == "📋 Visit: Crown follow-up"
+    assert thread["findings"] == [{"tooth": 14, "anomaly": "Caries"}]
+    assert thread["cdt_matches"] == "Tooth 14: D2391"
+    assert thread["chat_history"] == [["q", "a"]]
+    assert "Jane Doe" in restarted.get_patient_context("s1")
+
+
+def test_large_fields_load_lazily(backend_factory):
+    new_backend, _ = backend_factory
+    load_case(SessionState(backend=new_backend()), "s1")
+
+    restarted = SessionState(backend=new_backend())
+    session = restarted.get_session("s1")
+    thread = restarted.get_current_thread("s1")
+    assert session.patient_history is _UNLOADED
+    assert thread.json_context is _UNLOADED and thread.chat_history is _UNLOADED
+
+    assert thread["json_context"] == {"teeth": [14]}
+    assert thread.chat_history is _UNLOADED
+    assert len(session["patient_history"]) == 1
+
+
+def test_workers_see_each_others_changes(backend_factory):
+    new_backend, _ = backend_factory
+    worker_a = SessionState(backend=new_backend())
+    worker_b = SessionState(backend=new_backend())
+
+    worker_a.get_session("s1")
+    assert len(worker_b.get_session("s1")["threads"]) == 1
+    thread_id = worker_a.create_thread("s1", "case")
+    assert worker_b.get_current_thread("s1") is worker_b.get_session("s1")["threads"][thread_id]
+
+    worker_b.clear_thread("s1", thread_id)
+    assert thread_id not in worker_a.get_session("s1")["threads"]
+
+
+def test_thread_ids_are_unique_across_workers(backend_factory):
+    new_backend, _ = backend_factory
+    workers = [SessionState(backend=new_backend()) for _ in range(4)]
+    ids = []
+    lock = threading.Lock()
+
+    def create(state):
+        for _ in range(10):
+            thread_id = state.create_thread("s1", "case")
+            with lock:
+                ids.append(thread_id)
+
+    threads = [threading.Thread(target=create, args=(state,)) for state in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(ids)) == 40
+
+
+def test_concurrent_changes_in_one_worker_are_not_lost(backend_factory):
+    new_backend, _ = backend_factory
+    state = SessionState(backend=new_backend())
+    ids = []
+    lock = threading.Lock()
+
+    def create():
+        for _ in range(10):
+            thread_id = state.create_thread("s1", "case")
+            with lock:
+                ids.append(thread_id)
+
+    threads = [threading.Thread(target=create) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert set(ids) <= set(SessionState(backend=new_backend()).get_session("s1")["threads"])
+
+
+def test_idle_sessions_expire_in_backend(backend_factory):
+    new_backend, clock = backend_factory
+    load_case(SessionState(ttl=300, backend=new_backend(ttl=300)), "s1")
+
+    clock.advance(200)
+    assert SessionState(ttl=300, backend=new_backend(ttl=300)).get_session("s1")["patient_name"] == "Jane Doe"
+    clock.advance(200)  # the read above refreshed the idle timer
+    assert SessionState(ttl=300, backend=new_backend(ttl=300)).get_session("s1")["patient_name"] == "Jane Doe"
+
+    clock.advance(301)
+    fresh = SessionState(ttl=300, backend=new_backend(ttl=300)).get_session("s1")
+    assert fresh["patient_name"] is None and list(fresh["threads"]) == ["default"]
+
+
+def test_clear_session_deletes_from_backend(backend_factory):
+    new_backend, _ = backend_factory
+    state = SessionState(backend=new_backend())
+    load_case(state, "s1")
+    state.clear_session("s1")
+    assert SessionState(backend=new_backend()).get_session("s1")["current_patient_id"] is None
+
+
+def test_memory_eviction_keeps_backend_copy(backend_factory):
+    new_backend, _ = backend_factory
+    state = SessionState(max_sessions=1, stripes=1, backend=new_backend())
+    load_case(state, "s1")
+    state.get_session("s2")
+    assert "s1" not in state.sessions
+    assert state.get_current_thread("s1")["cdt_matches"] == "Tooth 14: D2391"
+
+
+def test_chat_uses_context_loaded_by_another_worker(fake_models, sample_visit, tmp_path, monkeypatch):
+    path = str(tmp_path / "sessions.sqlite3")
+    uploader = SessionState(backend=SQLiteSessionBackend(path))
+    monkeypatch.setattr(fake_models, "session_state", uploader)
+    fake_models.handle_json_text_input(dict(sample_visit), [], "s1")
+
+    monkeypatch.setattr(fake_models, "session_state", SessionState(backend=SQLiteSessionBackend(path)))
+    _, history = fake_models.enhanced_chat_with_medbot("summarize the findings", [], "s1")
+    assert "Error" not in history[-1][1]
+    assert "Tooth 14" in fake_models.session_state.get_current_thread("s1")["cdt_matches"]
+
+
+def test_unknown_backend_is_rejected():
+    with pytest.raises(ValueError):
+        create_session_backend("memcached")
+    with pytest.raises(ValueError):
+        create_session_backend("redis")
+
+
+def test_backends_share_one_contract():
+    with pytest.raises(TypeError):
+        SessionBackend()
+
+    backend = MemorySessionBackend()
+    assert [backend.increment("s1", "thread_seq") for _ in range(3)] == [1, 2, 3]
+    assert backend.increment("s2", "thread_seq") == 1
+    backend.delete("s1")
+    assert backend.increment("s1", "thread_seq") == 1
+
+
+def test_memory_thread_ids_are_unique_under_concurrency():
+    state = SessionState()
+    ids = []
+    lock = threading.Lock()
+
+    def create():
+        for _ in range(25):
+            thread_id = state.create_thread("s1", "case")
+            with lock:
+                ids.append(thread_id)
+
+    threads = [threading.Thread(target=create) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(ids)) == 100
+
+
+class CountingBackend(SQLiteSessionBackend):
+    """SQLite backend that counts version checks and can hold one until ``release`` is set"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.version_calls = 0
+        self.hold = None
+        self.release = threading.Event()
+        self.holding = threading.Event()
+
+    def version(self, session_id):
+        self.version_calls += 1
+        if session_id == self.hold:
+            self.holding.set()
+            assert self.release.wait(timeout=2)
+        return super().version(session_id)
+
+
+def test_version_is_checked_once_per_request(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    backend = CountingBackend(path)
+    state = SessionState(backend=backend)
+    other = SessionState(backend=SQLiteSessionBackend(path))
+    load_case(state, "s1")
+
+    def request():
+        begin_request()
+        before = backend.version_calls
+        for _ in range(5):
+            state.get_current_thread("s1")
+        return backend.version_calls - before
+
+    assert contextvars.copy_context().run(request) == 1
+    assert contextvars.copy_context().run(request) == 1
+
+    # Changes still start from the latest version, even inside a request
+    def change_after_another_worker():
+        begin_request()
+        state.get_session("s1")
+        other.create_thread("s1", "second opinion")
+        with state.locked("s1") as session:
+            return len(session["threads"])
+
+    assert contextvars.copy_context().run(change_after_another_worker) == 3
+
+
+def test_backend_reads_do_not_hold_the_stripe(tmp_path):
+    backend = CountingBackend(str(tmp_path / "sessions.sqlite3"))
+    state = SessionState(backend=backend, stripes=1)
+    state.get_session("slow")
+    backend.hold = "slow"
+
+    reader = threading.Thread(target=state.get_session, args=("slow",))
+    reader.start()
+    assert backend.holding.wait(timeout=2)
+    # Same stripe, while the other request waits on the backend
+    other = threading.Thread(target=state.get_session, args=("fast",))
+    other.start()
+    other.join(timeout=1)
+    finished = not other.is_alive()
+    backend.release.set()
+    reader.join(timeout=2)
+    assert finished
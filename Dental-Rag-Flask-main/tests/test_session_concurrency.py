@@ -0,0 +1,160 @@
+"""Stress tests for the session store under many concurrent request threads"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from session_store import SessionState
+
+WORKERS = 32
+
+
+def run_concurrently(fn, args_list, workers=WORKERS):
+    """Run fn(*args) for every args tuple, releasing all workers at once"""
+    start = threading.Event()
+
+    def call(args):
+        start.wait()
+        return fn(*args)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(call, args) for args in args_list]
+        start.set()
+        return [future.result() for future in futures]
+
+
+def test_get_session_creates_each_session_once(fast_switching):
+    state = SessionState()
+    sessions = run_concurrently(state.get_session, [("patient-1",)] * 200)
+    assert all(session is sessions[0] for session in sessions)
+    assert state.stats()["sessions"] == 1
+
+
+def test_create_thread_ids_are_unique(fast_switching):
+    state = SessionState()
+
+    def create_many(worker):
+        return [state.create_thread("patient-1", f"case {worker}-{i}") for i in range(25)]
+
+    thread_ids = [tid for ids in run_concurrently(create_many, [(w,) for w in range(WORKERS)]) for tid in ids]
+
+    assert len(thread_ids) == len(set(thread_ids)) == WORKERS * 25
+    threads = state.get_session("patient-1")["threads"]
+    assert set(thread_ids) <= set(threads)
+    assert len(threads) == WORKERS * 25 + 1  # plus 'default'
+
+
+def test_thread_ids_are_not_reused_after_clear():
+    state = SessionState()
+    first = state.create_thread("patient-1", "a")
+    state.clear_thread("patient-1", first)
+    assert state.create_thread("patient-1", "b") != first
+
+
+def test_append_chat_loses_no_entries(fast_switching):
+    state = SessionState()
+    history = []
+    thread = state.get_current_thread("patient-1")
+
+    def append_many(worker):
+        for i in range(200):
+            state.append_chat("patient-1", history, (f"q{worker}-{i}", "a"), thread=thread)
+
+    run_concurrently(append_many, [(w,) for w in range(WORKERS)])
+    assert len(history) == WORKERS * 200
+    assert thread["chat_history"] is history
+
+
+def test_unrelated_sessions_do_not_contend():
+    state = SessionState(stripes=16)
+    other = next(f"patient-{i}" for i in range(1, 100) if state._shard(f"patient-{i}") is not state._shard("patient-0"))
+
+    with state.locked("patient-0"):
+        done = threading.Event()
+        threading.Thread(target=lambda: (state.create_thread(other, "x"), done.set())).start()
+        assert done.wait(timeout=2), "a locked session blocked a session in another stripe"
+
+
+def test_same_session_changes_are_serialized():
+    state = SessionState()
+    with state.locked("patient-0"):
+        done = threading.Event()
+        threading.Thread(target=lambda: (state.create_thread("patient-0", "x"), done.set())).start()
+        assert not done.wait(timeout=0.2)
+    assert done.wait(timeout=2)
+
+
+def test_eviction_keeps_size_accounting_consistent(fast_switching):
+    state = SessionState(max_sessions=64, memory_budget=200_000, stripes=4)
+
+    def churn(worker):
+        for i in range(100):
+            session_id = f"patient-{(worker * 7 + i) % 300}"
+            state.create_thread(session_id, "case")
+            state.append_chat(session_id, [], ("q", "a" * 500), thread=state.get_current_thread(session_id))
+
+    run_concurrently(churn, [(w,) for w in range(WORKERS)])
+
+    stats = state.stats()
+    assert stats["sessions"] <= 64
+    tracked = sum(shard.total_size for shard in state._shards)
+    assert tracked == sum(session.size for session in state.sessions.values())
+    assert sum(stats["evictions"].values()) > 0
+
+
+def test_handle_json_text_input_concurrently(fake_models, fast_switching, sample_visit):
+    def load(session_id):
+        history, _ = fake_models.handle_json_text_input(dict(sample_visit), [], session_id)
+        return session_id, history
+
+    results = run_concurrently(load, [(f"patient-{i % 8}",) for i in range(128)])
+
+    for session_id, history in results:
+        assert history[-1][0] == "System"
+        assert "2 anomalies" in history[-1][1]
+        thread = fake_models.session_state.get_current_thread(session_id)
+        assert "Tooth 14" in thread["cdt_matches"]
+        assert len(thread["findings"]) == 2
+
+
+@pytest.mark.parametrize("question", ["what is a crown", "summarize the findings", "full history please"])
+def test_chat_functions_concurrently(fake_models, fast_switching, sample_visit, question):
+    state = fake_models.session_state
+    for i in range(8):
+        fake_models.handle_json_text_input(dict(sample_visit), [], f"patient-{i}")
+        state.set_current_patient(f"patient-{i}", f"id-{i}", f"Patient {i}", [{"timestamp": "t", "findings": []}])
+
+    def chat(i):
+        session_id = f"patient-{i % 8}"
+        if i % 2:
+            _, history = fake_models.enhanced_chat_with_medbot(question, [], session_id)
+            return history[-1][1]
+        return "".join(fake_models.enhanced_chat_with_medbot_stream(question, [], session_id))
+
+    answers = run_concurrently(chat, [(i,) for i in range(96)])
+    assert all(answer and "Error" not in answer for answer in answers)
+    assert fake_models.llm_scheduler.stats()["in_flight"] == 0
+
+
+def test_create_and_chat_mixed_load(fake_models, fast_switching, sample_visit):
+    """Thread creation, context loads and chats interleaved on the same sessions"""
+    state = fake_models.session_state
+    errors = []
+
+    def worker(w):
+        session_id = f"patient-{w % 4}"
+        try:
+            for i in range(10):
+                state.create_thread(session_id, f"case {w}-{i}")
+                fake_models.handle_json_text_input(dict(sample_visit), [], session_id)
+                fake_models.enhanced_chat_with_medbot("summarize the findings", [], session_id)
+                list(fake_models.enhanced_chat_with_medbot_stream("what is a crown", [], session_id))
+        except Exception as e:  # collected so one failure doesn't hide the rest
+            errors.append(e)
+
+    start = time.monotonic()
+    run_concurrently(worker, [(w,) for w in range(WORKERS)])
+    assert not errors
+    assert sum(len(state.get_session(f"patient-{i}")["threads"]) for i in range(4)) == WORKERS * 10 + 4
+    assert time.monotonic() - start < 60
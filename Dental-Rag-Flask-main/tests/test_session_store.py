@@ -0,0 +1,104 @@
+"""Idle expiry, LRU cap and memory budget of the in-process session map"""
+import pytest
+
+import session_store
+from session_store import SessionState
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(session_store.time, "monotonic", clock.monotonic)
+    return clock
+
+
+def cached(state):
+    return sorted(state.sessions)
+
+
+def test_idle_sessions_expire(clock):
+    state = SessionState(ttl=60, stripes=1)
+    state.get_session("idle")
+    clock.advance(30)
+    state.get_session("active")
+    clock.advance(31)
+
+    state.get_session("active")
+    assert cached(state) == ["active"]
+    assert state.stats()["evictions"] == {"ttl": 1, "lru": 0, "memory": 0}
+
+    # The accessed session itself is never expired, however long it sat idle
+    clock.advance(3600)
+    session = state.get_session("active")
+    assert cached(state) == ["active"] and session.last_access == clock.now
+
+
+def test_expired_session_starts_over(clock):
+    state = SessionState(ttl=60, stripes=1)
+    assert state.create_thread("s1", "first") == "thread_1"
+    clock.advance(61)
+    state.get_session("other")
+
+    # With the memory backend the evicted record was the only copy
+    assert state.get_current_thread("s1")["name"] == "Default Case"
+    assert state.create_thread("s1", "again") == "thread_1"
+
+
+def test_count_cap_evicts_least_recently_used(clock):
+    state = SessionState(max_sessions=2, stripes=1)
+    for session_id in ("a", "b", "a", "c"):
+        state.get_session(session_id)
+    assert cached(state) == ["a", "c"]
+    assert state.stats()["evictions"]["lru"] == 1
+
+
+def test_count_cap_is_split_across_stripes(clock):
+    state = SessionState(max_sessions=8, stripes=4)
+    for i in range(40):
+        state.get_session(f"patient-{i}")
+    assert all(len(shard.sessions) <= 2 for shard in state._shards)
+    assert state.stats()["sessions"] + state.stats()["evictions"]["lru"] == 40
+
+
+def test_memory_budget_evicts_oldest_after_remeasure(clock):
+    state = SessionState(memory_budget=11_500, stripes=1)
+    state.get_session("small")
+    state.get_current_thread("large")["json_context"] = "x" * 10_000
+    state.get_session("newest")
+
+    # The large write is measured on the next access to the shard, which
+    # pushes the estimate over budget and drops the least recently used
+    assert cached(state) == ["large", "newest"]
+    assert state.stats()["evictions"]["memory"] == 1
+    assert state.stats()["estimated_bytes"] <= 11_500
+
+    state.get_current_thread("large")["json_context"] = "x" * 30_000
+    state.get_session("newest")
+    assert cached(state) == ["newest"]
+    assert state.stats()["evictions"]["memory"] == 2
+
+
+def test_health_reports_evictions(fake_models, monkeypatch, clock):
+    import app
+
+    state = SessionState(ttl=60, max_sessions=1, stripes=1)
+    monkeypatch.setattr(app, "session_state", state)
+    state.get_session("a")
+    state.get_session("b")
+    clock.advance(61)
+    state.get_session("c")
+
+    sessions = app.create_app(warm_up_on_start=False).test_client().get("/health").get_json()["sessions"]
+    assert sessions["evictions"] == {"ttl": 1, "lru": 1, "memory": 0}
+    assert sessions["sessions"] == 1 and sessions["max_sessions"] == 1
@@ -0,0 +1,98 @@
+import io
+import json
+import queue
+import logging
+
+import pytest
+
+import structured_log
+from structured_log import _DroppingQueueHandler, _Logging, get_logger, redact_payload
+
+
+@pytest.fixture
+def captured(monkeypatch):
+    """JSON log lines from the ``medbot`` loggers, at DEBUG with every chunk sampled"""
+    stream = io.StringIO()
+    logs = _Logging()
+    logs.setup(level="DEBUG", fmt="json", stream=stream)
+    monkeypatch.setattr(structured_log, "LOG_CHUNK_SAMPLE_RATE", 1.0)
+
+    def lines():
+        logs.flush()
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+    yield lines
+    logs.close()
+    logging.getLogger(structured_log.ROOT_LOGGER).setLevel(structured_log.LOG_LEVEL)
+
+
+def test_payload_is_redacted_and_capped():
+    payload = {"patient_name": "Jane Doe", "query": "Is tooth 14 infected?", "confidence_threshold": 0.5,
+               "json": {"teeth": [{"number": 14}]}, "patient_history": [{"visit_id": "v1"}]}
+    text = redact_payload(payload)
+    assert "Jane Doe" not in text and "infected" not in text and "teeth" not in text
+    assert json.loads(text)["confidence_threshold"] == 0.5
+    assert json.loads(text)["query"] == "[redacted] <21 chars>"
+
+    capped = redact_payload({"visit_ids": [f"v{i}" for i in range(15)]}, max_chars=40)
+    assert len(capped) < 60 and capped.endswith("chars)")
+
+
+def test_full_queue_drops_instead_of_blocking():
+    stats = {"queued": 0, "dropped": 0}
+    handler = _DroppingQueueHandler(queue.Queue(maxsize=1), stats)
+    record = logging.LogRecord("medbot.test", logging.INFO, __file__, 1, "line %d", (1,), None)
+    handler.handle(record)
+    handler.handle(record)
+    assert stats == {"queued": 1, "dropped": 1}
+    assert handler.queue.get_nowait().msg == "line 1"
+
+
+def test_lines_carry_request_id_and_extras(captured):
+    structured_log.new_request_id("req-1")
+    get_logger("test").info("loaded %d findings", 2, extra={"route": "comprehensive"})
+    (line,) = captured()
+    assert line["request_id"] == "req-1" and line["message"] == "loaded 2 findings"
+    assert line["route"] == "comprehensive" and line["logger"] == "medbot.test"
+
+
+def test_stream_logs_are_correlated_and_free_of_patient_data(fake_models, captured, sample_visit):
+    from app import create_app
+
+    client = create_app(warm_up_on_start=False).test_client()
+    logging.getLogger(structured_log.ROOT_LOGGER).setLevel("DEBUG")  # create_app applied LOG_LEVEL
+    response = client.post("/api/rag-chat-stream", headers={"X-Request-ID": "abc123"},
+                           json={"patient_name": "Jane Doe", "json": sample_visit,
+                                 "query": "Which teeth does Jane need treated?"})
+    body = response.get_data(as_text=True)
+    assert response.headers["X-Request-ID"] == "abc123" and body.endswith("[DONE]\n\n")
+
+    lines = captured()
+    text = json.dumps(lines)
+    assert "Jane" not in text and "Caries" not in text
+    assert {line["request_id"] for line in lines} == {"abc123"}
+    messages = [line["message"] for line in lines]
+    assert any(m.startswith("Streaming chunk") for m in messages)
+    assert any(m.startswith("Streaming completed") for m in messages)
+
+    fresh = client.get("/health")
+    assert len(fresh.headers["X-Request-ID"]) == 32
+    assert fresh.get_json()["logging"]["dropped"] == 0
+
+
+def test_request_path_warnings_go_through_the_queue(captured, tmp_path):
+    from answer_cache import AnswerCache
+    from audit_log import AuditLog
+
+    def broken_embed(texts):
+        raise ConnectionError("ollama down")
+
+    structured_log.new_request_id("req-2")
+    AnswerCache(embed=broken_embed, similarity=0.9).lookup("ctx", "general", "What is a crown?")
+    audit = AuditLog(directory=str(tmp_path), queue_size=1, flush_seconds=60)
+    audit.record([{"tooth": 14}] * 3)
+    audit.close()
+
+    warnings = [line for line in captured() if line["level"] == "WARNING"]
+    assert [line["logger"] for line in warnings] == ["medbot.answer_cache", "medbot.audit_log"]
+    assert {line["request_id"] for line in warnings} == {"req-2"}
+    assert "ollama down" in warnings[0]["message"] and "queue full" in warnings[1]["message"]
@@ -0,0 +1,107 @@
+import json
+
+import pytest
+
+from prompt_budget import TokenCounter
+from visit_diff import diff_visits, format_diff_table
+
+
+def finding(tooth, description, confidence=None):
+    metadata = {} if confidence is None else {"confidence": confidence}
+    return {"tooth": tooth, "description": description, "metadata": metadata}
+
+
+@pytest.fixture
+def history():
+    """Newest first, as the backend sends it"""
+    return [
+        {"timestamp": "2024-03-01", "visit_id": "v3",
+         "findings": [finding(14, "Caries", 0.91), finding(3, "Abscess", 0.7), finding(19, "Bone loss", 0.6)]},
+        {"timestamp": "2024-02-01", "visit_id": "v2",
+         "findings": [finding(14, "caries ", 0.75), finding(30, "Periapical lesion", 0.8), finding(19, "Bone loss", 0.62)]},
+        {"timestamp": "2024-01-01", "visit_id": "v1",
+         "findings": [finding(14, "Caries", 0.62), finding(30, "Periapical lesion", 0.77), finding(19, "Bone loss", 0.58)]},
+    ]
+
+
+def rows_by_key(diff):
+    return {(row["tooth"], row["condition"]): row for row in diff["findings"]}
+
+
+def test_statuses_and_confidence_deltas(history):
+    diff = diff_visits(history)
+    rows = rows_by_key(diff)
+
+    assert [visit["visit_id"] for visit in diff["visits"]] == ["v1", "v2", "v3"]
+    assert rows[("14", "caries")]["status"] == "progressed"
+    assert rows[("14", "caries")]["confidence_delta"] == pytest.approx(0.29, abs=1e-3)
+    assert rows[("3", "abscess")]["status"] == "new"
+    assert rows[("3", "abscess")]["first_seen"] == "2024-03-01"
+    assert rows[("3", "abscess")]["confidence_delta"] is None
+    assert rows[("30", "periapical lesion")]["status"] == "resolved"
+    assert rows[("30", "periapical lesion")]["last_seen"] == "2024-02-01"
+    assert rows[("19", "bone loss")]["status"] == "persisting"
+    assert [row["status"] for row in diff["findings"]] == ["new", "progressed", "persisting", "resolved"]
+
+
+def test_intervals_between_consecutive_visits(history):
+    first, second = diff_visits(history)["intervals"]
+    assert (first["from"], first["to"]) == ("2024-01-01", "2024-02-01")
+    assert first["progressed"] == ["#14 caries (+0.13)"]
+    assert not first["new"] and not first["resolved"]
+    assert second["new"] == ["#3 abscess"]
+    assert second["resolved"] == ["#30 periapical lesion"]
+
+
+def test_missing_confidence_and_timestamps():
+    visits = [{"findings": [finding(8, "Fracture")]}, {"findings": [finding(8, "Fracture", 0.9)]}]
+    row = diff_visits(visits)["findings"][0]
+    assert row["status"] == "persisting"
+    assert row["confidence_first"] == pytest.approx(0.9) and row["confidence_last"] is None
+
+
+def test_needs_two_visits(history):
+    with pytest.raises(ValueError):
+        diff_visits(history[:1])
+
+
+def test_table_is_far_smaller_than_visit_json():
+    # Mostly the same teeth each visit, a few findings coming and going
+    conditions = ["Caries", "Periapical lesion", "Bone loss", "Calculus"]
+    history = [
+        {"timestamp": f"2023-{12 - i:02d}-01", "visit_id": f"v{i}",
+         "findings": [finding(t, conditions[t % 4], 0.5 + (t % 5) / 10 - i / 100)
+                      for t in range(1, 17) if (t + i) % 7],
+         "cdt_matches": "Tooth 1: D2391"}
+        for i in range(10)
+    ]
+    counter = TokenCounter()
+    table = format_diff_table(diff_visits(history))
+    assert counter.count(table) * 3 < counter.count(json.dumps(history, indent=2))
+
+
+def test_comparison_prompt_uses_the_table(fake_models, history):
+    fake_models.session_state.set_current_patient("s1", "p-1", "Jane Doe", history)
+    plan = fake_models.prepare_stream_request("compare visits please", [], "s1")
+    assert plan["route"] == "comparison"
+    assert "| 14 | caries | progressed |" in plan["prompt"]
+    assert '"metadata"' not in plan["prompt"]
+
+
+def test_visit_diff_endpoint(fake_models, history, monkeypatch):
+    import app
+    from app import create_app
+
+    monkeypatch.setattr(app, "session_state", fake_models.session_state)
+    client = create_app(warm_up_on_start=False).test_client()
+    response = client.post("/api/visit-diff", json={"patient_history": history, "visit_ids": ["v1", "v3"]})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert len(body["diff"]["visits"]) == 2
+    assert "Visits compared: 2" in body["table"]
+
+    fake_models.session_state.set_current_patient("s1", "p-1", "Jane Doe", history)
+    response = client.post("/api/visit-diff", json={"patient_name": "s1"})
+    assert response.get_json()["diff"]["patient_name"] == "Jane Doe"
+
+    assert client.post("/api/visit-diff", json={"patient_history": history[:1]}).status_code == 400
@@ -0,0 +1,391 @@
+"""Stand-in Ollama server for load tests, with no model behind it.
+
+    python tools/fake_ollama.py --port 11500 --ttft 0.4 --tokens-per-sec 25
+    OLLAMA_HOST=http://127.0.0.1:11500 gunicorn -c gunicorn.conf.py
+
+Serves /api/chat and /api/generate (streaming and not), /api/embed,
+/api/embeddings, /api/ps and /api/tags. Answers are deterministic per prompt
+and paced by the configured time-to-first-token and tokens/sec; a share of
+requests can fail outright or break off mid-stream. With ``--upstream`` every
+request is proxied to a real Ollama and recorded (``--record``), and
+``--replay`` serves recorded answers again with their original pacing.
+"""
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+
+WORDS = ("the tooth shows signs of caries periapical lesion bone loss recommend radiograph "
+         "follow-up restoration crown root canal treatment monitor occlusal surface mesial distal "
+         "patient findings consistent with clinical examination advised").split()
+
+
+class FakeOllamaConfig:
+    """Pacing and failure settings; attributes can be changed while the server runs"""
+
+    def __init__(self, ttft=0.2, tokens_per_sec=30.0, response_tokens=80, fail_rate=0.0,
+                 stream_fail_rate=0.0, load_seconds=0.0, embed_seconds=0.0, dim=768, seed=None):
+        self.ttft = ttft
+        self.tokens_per_sec = tokens_per_sec
+        self.response_tokens = response_tokens
+        self.fail_rate = fail_rate
+        self.stream_fail_rate = stream_fail_rate
+        self.load_seconds = load_seconds
+        self.embed_seconds = embed_seconds
+        self.dim = dim
+        self.random = random.Random(seed)
+
+
+def request_key(path, body):
+    """Identifies a request for record/replay: endpoint, model and the prompt, messages or input"""
+    content = {k: body.get(k) for k in ("model", "messages", "prompt", "input") if k in body}
+    encoded = json.dumps([path.replace("/api/embeddings", "/api/embed"), content], sort_keys=True)
+    return hashlib.blake2b(encoded.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def hashed_embedding(text, dim):
+    """Feature-hashed bag of words: the same text always gets the same vector"""
+    vector = [0.0] * dim
+    for token in text.lower().split():
+        digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+        vector[int.from_bytes(digest[:4], "little") % dim] += 1.0 if digest[4] & 1 else -1.0
+    return vector
+
+
+def synthetic_tokens(prompt, count):
+    rng = random.Random(hashlib.blake2b(prompt.encode("utf-8"), digest_size=8).digest())
+    return [("" if i == 0 else " ") + rng.choice(WORDS) for i in range(count)]
+
+
+class Recorder:
+    """Appends proxied exchanges to a JSONL file and serves them back by request key"""
+
+    def __init__(self, record_path=None, replay_path=None):
+        self.record_path = record_path
+        self._lock = threading.Lock()
+        self.sessions = {}
+        if replay_path:
+            with open(replay_path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.sessions[entry["key"]] = entry
+
+    def find(self, path, body):
+        return self.sessions.get(request_key(path, body))
+
+    def record(self, path, body, status, parts, offsets):
+        if not self.record_path:
+            return
+        entry = {"key": request_key(path, body), "path": path, "request": body, "status": status,
+                 "parts": parts, "offsets": offsets, "recorded_at": datetime.now(timezone.utc).isoformat()}
+        with self._lock:
+            self.sessions[entry["key"]] = entry
+            with open(self.record_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    # --- plumbing -----------------------------------------------------------
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _send_chunk(self, data):
+        if isinstance(data, dict):
+            data = json.dumps(data) + "\n"
+        data = data.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+    # --- routes -------------------------------------------------------------
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path == "/api/ps":
+            self._send_json({"models": self.server.loaded_models()})
+        elif self.path == "/api/tags":
+            self._send_json({"models": [{"name": m["name"], "model": m["model"]} for m in self.server.loaded_models()]})
+        elif self.path == "/api/version":
+            self._send_json({"version": "0.0.0-fake"})
+        else:
+            body = b"Ollama is running"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def do_POST(self):
+        body = self._read_body()
+        self.server.count(self.path)
+        try:
+            if self.server.upstream:
+                return self._proxy(body)
+            recorded = self.server.recorder.find(self.path, body)
+            if recorded is not None:
+                return self._replay(recorded, body)
+            if self.config.random.random() < self.config.fail_rate:
+                self.server.count("failed")
+                return self._send_json({"error": "fake_ollama: injected failure"}, status=500)
+            if self.path in ("/api/chat", "/api/generate"):
+                return self._generate(body)
+            if self.path in ("/api/embed", "/api/embeddings"):
+                return self._embed(body)
+            self._send_json({"error": f"unknown endpoint {self.path}"}, status=404)
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.count("disconnected")
+            self.close_connection = True
+
+    def _generate(self, body):
+        chat = self.path == "/api/chat"
+        model = body.get("model", "")
+        prompt = json.dumps(body.get("messages")) if chat else body.get("prompt", "")
+        stream = body.get("stream", True)
+        started = time.perf_counter()
+        load_seconds = self.server.load(model, self.config.load_seconds)
+
+        # An empty generate prompt only loads the model
+        count = 0 if not chat and not prompt else self.config.response_tokens
+        tokens = synthetic_tokens(prompt, count)
+        prompt_tokens = max(1, len(prompt) // 4)
+
+        def part(content, done=False):
+            payload = {"model": model, "created_at": datetime.now(timezone.utc).isoformat(), "done": done}
+            if chat:
+                payload["message"] = {"role": "assistant", "content": content}
+            else:
+                payload["response"] = content
+            if done:
+                elapsed = time.perf_counter() - started
+                payload.update({
+                    "done_reason": "stop",
+                    "total_duration": int(elapsed * 1e9),
+                    "load_duration": int(load_seconds * 1e9),
+                    "prompt_eval_count": prompt_tokens,
+                    "eval_count": len(tokens),
+                    "eval_duration": int(max(0.0, elapsed - self.config.ttft) * 1e9),
+                })
+            return payload
+
+        gap = 1.0 / self.config.tokens_per_sec if self.config.tokens_per_sec > 0 else 0.0
+        if tokens:
+            time.sleep(self.config.ttft)
+        if not stream:
+            time.sleep(gap * max(0, len(tokens) - 1))
+            return self._send_json(part("".join(tokens), done=True))
+
+        fail_at = None
+        if tokens and self.config.random.random() < self.config.stream_fail_rate:
+            fail_at = self.config.random.randrange(len(tokens))
+        self._start_stream()
+        for i, token in enumerate(tokens):
+            if i == fail_at:
+                self.server.count("stream_failed")
+                self._send_chunk({"error": "fake_ollama: injected mid-stream failure"})
+                return self._end_stream()
+            if i:
+                time.sleep(gap)
+            self._send_chunk(part(token))
+        self._send_chunk(part("", done=True))
+        self._end_stream()
+
+    def _embed(self, body):
+        model = body.get("model", "")
+        load_seconds = self.server.load(model, self.config.load_seconds)
+        time.sleep(self.config.embed_seconds)
+        if self.path == "/api/embeddings":
+            return self._send_json({"embedding": hashed_embedding(body.get("prompt", ""), self.config.dim)})
+        texts = body.get("input", [])
+        texts = [texts] if isinstance(texts, str) else texts
+        self._send_json({"model": model, "embeddings": [hashed_embedding(t, self.config.dim) for t in texts],
+                         "load_duration": int(load_seconds * 1e9)})
+
+    # --- record / replay ----------------------------------------------------
+
+    def _proxy(self, body):
+        request = Request(self.server.upstream + self.path, data=json.dumps(body).encode("utf-8"),
+                          headers={"Content-Type": "application/json"}, method="POST")
+        started = time.perf_counter()
+        parts, offsets = [], []
+        try:
+            with urlopen(request, timeout=600) as upstream:
+                status = upstream.status
+                streaming = "ndjson" in (upstream.headers.get("Content-Type") or "")
+                if streaming:
+                    self._start_stream()
+                    for line in upstream:
+                        if line.strip():
+                            offsets.append(time.perf_counter() - started)
+                            parts.append(line.decode("utf-8"))
+                            self._send_chunk(parts[-1])
+                    self._end_stream()
+                else:
+                    parts.append(upstream.read().decode("utf-8"))
+                    offsets.append(time.perf_counter() - started)
+                    self._send_raw(status, parts[0])
+        except Exception as e:
+            status = getattr(e, "code", 502)
+            parts, offsets = [json.dumps({"error": str(e)})], [time.perf_counter() - started]
+            self._send_raw(status, parts[0])
+        self.server.recorder.record(self.path, body, status, parts, offsets)
+
+    def _send_raw(self, status, text):
+        data = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _replay(self, recorded, body):
+        """Send a recorded exchange again, keeping its original timing"""
+        self.server.count("replayed")
+        parts, offsets = recorded["parts"], recorded["offsets"]
+        streaming = self.path in ("/api/chat", "/api/generate") and body.get("stream", True)
+        if not streaming:
+            time.sleep(offsets[-1] if offsets else 0)
+            if len(parts) > 1:  # recorded streaming, asked without: join the text
+                return self._send_json(_join_parts(parts))
+            return self._send_raw(recorded["status"], parts[0])
+        self._start_stream()
+        started = time.perf_counter()
+        for part, offset in zip(parts, offsets):
+            time.sleep(max(0.0, offset - (time.perf_counter() - started)))
+            self._send_chunk(part if part.endswith("\n") else part + "\n")
+        self._end_stream()
+
+
+def _join_parts(parts):
+    chunks = [json.loads(p) for p in parts]
+    final = dict(chunks[-1])
+    text = "".join((c.get("message") or {}).get("content", "") or c.get("response", "") for c in chunks)
+    if "message" in final:
+        final["message"] = {"role": "assistant", "content": text}
+    else:
+        final["response"] = text
+    return final
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the config, loaded models and request counters"""
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 11500), config=None, upstream=None, recorder=None, verbose=False):
+        super().__init__(address, FakeOllamaHandler)
+        self.config = config or FakeOllamaConfig()
+        self.upstream = upstream.rstrip("/") if upstream else None
+        self.recorder = recorder or Recorder()
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        self._models = {}
+        self.counts = {}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def load(self, model, seconds):
+        """Seconds this request waits for ``model`` to load (only its first use)"""
+        with self._lock:
+            cold = model not in self._models
+            self._models[model] = time.time()
+        if cold and seconds > 0:
+            time.sleep(seconds)
+            return seconds
+        return 0.0
+
+    def loaded_models(self):
+        with self._lock:
+            return [{"name": m, "model": m, "expires_at": "2099-01-01T00:00:00Z"} for m in self._models]
+
+    def start(self):
+        """Serve on a background thread; returns the thread"""
+        thread = threading.Thread(target=self.serve_forever, name="fake-ollama", daemon=True)
+        thread.start()
+        return thread
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fake Ollama server for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--ttft", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=30.0)
+    parser.add_argument("--response-tokens", type=int, default=80)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of requests answered with 500")
+    parser.add_argument("--stream-fail-rate", type=float, default=0.0, help="share of streams that break off")
+    parser.add_argument("--load-seconds", type=float, default=0.0, help="delay on a model's first request")
+    parser.add_argument("--embed-seconds", type=float, default=0.0, help="delay per embedding request")
+    parser.add_argument("--dim", type=int, default=768, help="embedding dimension")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--upstream", help="real Ollama URL to proxy to (with --record)")
+    parser.add_argument("--record", help="JSONL file to append proxied exchanges to")
+    parser.add_argument("--replay", help="JSONL file of recorded exchanges to serve")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    config = FakeOllamaConfig(ttft=args.ttft, tokens_per_sec=args.tokens_per_sec,
+                              response_tokens=args.response_tokens, fail_rate=args.fail_rate,
+                              stream_fail_rate=args.stream_fail_rate, load_seconds=args.load_seconds,
+                              embed_seconds=args.embed_seconds, dim=args.dim, seed=args.seed)
+    recorder = Recorder(record_path=args.record, replay_path=args.replay)
+    server = FakeOllamaServer((args.host, args.port), config, upstream=args.upstream,
+                              recorder=recorder, verbose=args.verbose)
+    mode = f"proxying {args.upstream}" if args.upstream else f"ttft {args.ttft}s, {args.tokens_per_sec} tok/s"
+    print(f"🧪 Fake Ollama on {server.url} ({mode}, {len(recorder.sessions)} recorded sessions)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
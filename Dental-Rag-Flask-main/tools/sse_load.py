@@ -0,0 +1,213 @@
+"""Load generator for the chat API: many concurrent SSE clients, latency percentiles at the end.
+
+    python tools/sse_load.py --url http://127.0.0.1:5001 --concurrency 64 --requests 1000
+    python tools/sse_load.py --endpoint rag-chat --concurrency 16 --duration 60 --payload upload.json
+
+Each client sends its questions one after another on its own session
+(``patient_name``). For /api/rag-chat-stream it reports time to first chunk,
+gaps between chunks and full stream time; for /api/rag-chat the response
+time. Throughput, 429 rejections and errors are counted across all clients.
+"""
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+from itertools import count
+
+import httpx
+
+DEFAULT_QUESTIONS = [
+    "What are the main findings in this X-ray?",
+    "Which teeth need attention first?",
+    "Create treatment plan with CDT codes",
+    "What is a periapical lesion?",
+]
+
+
+class Result:
+    __slots__ = ("status", "ttfc", "gaps", "duration", "chunks", "error")
+
+    def __init__(self):
+        self.status = None
+        self.ttfc = None
+        self.gaps = []
+        self.duration = None
+        self.chunks = 0
+        self.error = None
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of ``values`` (None when empty)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, min(len(ordered), math.ceil(p / 100 * len(ordered))))
+    return ordered[rank - 1]
+
+
+async def stream_request(client, url, payload):
+    """POST to the SSE endpoint and time every chunk event"""
+    result = Result()
+    started = time.perf_counter()
+    last = None
+    try:
+        async with client.stream("POST", url, json=payload) as response:
+            result.status = response.status_code
+            if response.status_code != 200:
+                await response.aread()
+                result.error = f"HTTP {response.status_code}"
+                return result
+            async for line in response.aiter_lines():
+                if not line.startswith("data: {"):
+                    continue
+                event = json.loads(line[len("data: "):])
+                if "error" in event or event.get("type") == "error":
+                    result.error = str(event.get("error") or event.get("content"))
+                    continue
+                if event.get("type") not in ("chunk", "context"):
+                    continue
+                now = time.perf_counter()
+                if last is None:
+                    result.ttfc = now - started
+                else:
+                    result.gaps.append(now - last)
+                last = now
+                result.chunks += 1
+    except httpx.HTTPError as e:
+        result.error = f"{type(e).__name__}: {e}"
+    finally:
+        result.duration = time.perf_counter() - started
+    return result
+
+
+async def blocking_request(client, url, payload):
+    """POST to /api/rag-chat and time the whole response"""
+    result = Result()
+    started = time.perf_counter()
+    try:
+        response = await client.post(url, json=payload)
+        result.status = response.status_code
+        if response.status_code != 200:
+            result.error = f"HTTP {response.status_code}"
+        else:
+            result.chunks = 1
+            result.ttfc = time.perf_counter() - started
+    except httpx.HTTPError as e:
+        result.error = f"{type(e).__name__}: {e}"
+    finally:
+        result.duration = time.perf_counter() - started
+    return result
+
+
+async def run_load(base_url, concurrency=16, requests=100, duration=None, endpoint="rag-chat-stream",
+                   questions=None, payload=None, shared_session=False, timeout=120.0):
+    """Run ``concurrency`` clients until ``requests`` are sent (or ``duration`` seconds pass).
+
+    Returns (results, elapsed seconds).
+    """
+    questions = questions or DEFAULT_QUESTIONS
+    url = f"{base_url.rstrip('/')}/api/{endpoint}"
+    send = stream_request if endpoint == "rag-chat-stream" else blocking_request
+    issued = count()
+    results = []
+    deadline = time.perf_counter() + duration if duration else None
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        async def worker(client_id):
+            asked = 0
+            while True:
+                n = next(issued)
+                if (deadline is None and n >= requests) or (deadline is not None and time.perf_counter() >= deadline):
+                    return
+                body = dict(payload or {})
+                body["patient_name"] = "load-test" if shared_session else f"load-test-{client_id}"
+                body["query"] = questions[asked % len(questions)]
+                # An upload in the payload only goes with each client's first question
+                if asked:
+                    body.pop("json", None)
+                asked += 1
+                results.append(await send(client, url, body))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return results, elapsed
+
+
+def summarize(results, elapsed):
+    """Counts, rates and p50/p95/p99 latencies (milliseconds) for a load run"""
+    ok = [r for r in results if r.error is None]
+    ttfc = [r.ttfc for r in ok if r.ttfc is not None]
+    gaps = [gap for r in ok for gap in r.gaps]
+    durations = [r.duration for r in ok]
+
+    def latency(values):
+        return {f"p{p}": None if percentile(values, p) is None else round(percentile(values, p) * 1000, 1)
+                for p in (50, 95, 99)}
+
+    return {
+        "requests": len(results),
+        "ok": len(ok),
+        "rejected_429": sum(r.status == 429 for r in results),
+        "errors": len(results) - len(ok),
+        "error_rate": round((len(results) - len(ok)) / len(results), 4) if results else 0.0,
+        "elapsed_seconds": round(elapsed, 2),
+        "requests_per_second": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "chunks_per_second": round(sum(r.chunks for r in ok) / elapsed, 1) if elapsed else 0.0,
+        "time_to_first_chunk_ms": latency(ttfc),
+        "inter_chunk_gap_ms": latency(gaps),
+        "duration_ms": latency(durations),
+        "sample_errors": sorted({r.error for r in results if r.error})[:5],
+    }
+
+
+def format_report(summary):
+    lines = [
+        f"Requests: {summary['requests']}  ok: {summary['ok']}  429: {summary['rejected_429']}  "
+        f"errors: {summary['errors']} ({summary['error_rate']:.1%})",
+        f"Throughput: {summary['requests_per_second']} req/s, {summary['chunks_per_second']} chunks/s "
+        f"over {summary['elapsed_seconds']}s",
+        f"{'':24}{'p50':>10}{'p95':>10}{'p99':>10}",
+    ]
+    for key, label in (("time_to_first_chunk_ms", "time to first chunk ms"),
+                       ("inter_chunk_gap_ms", "inter-chunk gap ms"),
+                       ("duration_ms", "duration ms")):
+        values = summary[key]
+        lines.append(f"{label:24}" + "".join(f"{'-' if values[p] is None else values[p]:>10}"
+                                              for p in ("p50", "p95", "p99")))
+    for error in summary["sample_errors"]:
+        lines.append(f"⚠️ {error}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent SSE load against the RAG chat API")
+    parser.add_argument("--url", default="http://127.0.0.1:5001")
+    parser.add_argument("--endpoint", choices=["rag-chat-stream", "rag-chat"], default="rag-chat-stream")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=100, help="total requests (ignored with --duration)")
+    parser.add_argument("--duration", type=float, help="run for this many seconds instead")
+    parser.add_argument("--question", action="append", help="question to ask (repeatable)")
+    parser.add_argument("--payload", help="JSON file merged into each request body (e.g. with an upload under 'json')")
+    parser.add_argument("--shared-session", action="store_true", help="all clients use one session")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args(argv)
+
+    payload = None
+    if args.payload:
+        with open(args.payload, encoding="utf-8") as f:
+            payload = json.load(f)
+    results, elapsed = asyncio.run(run_load(
+        args.url, args.concurrency, args.requests, args.duration, args.endpoint,
+        args.question, payload, args.shared_session, args.timeout))
+    summary = summarize(results, elapsed)
+    print(json.dumps(summary, indent=2) if args.json else format_report(summary))
+    return 0 if summary["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
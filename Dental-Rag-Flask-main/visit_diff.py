@@ -0,0 +1,193 @@
+import os
+
+import numpy as np
+
+# A persisting finding whose confidence rose at least this much counts as progressed
+VISIT_DIFF_PROGRESSION_DELTA = float(os.getenv("VISIT_DIFF_PROGRESSION_DELTA", "0.10"))
+# Visit-to-visit rows listed under the diff table in prompts (most recent first)
+VISIT_DIFF_MAX_INTERVALS = int(os.getenv("VISIT_DIFF_MAX_INTERVALS", "6"))
+
+# Table order: what needs attention first
+STATUS_ORDER = ("new", "progressed", "persisting", "resolved")
+
+
+def normalize_condition(description):
+    return " ".join(str(description or "").lower().split())
+
+
+def _tooth_key(tooth):
+    text = str(tooth)
+    return (0, int(text), text) if text.isdigit() else (1, 0, text)
+
+
+def chronological(visits):
+    """Oldest first: by timestamp when every visit has one, else the reverse of the newest-first history"""
+    if visits and all(visit.get('timestamp') for visit in visits):
+        return sorted(visits, key=lambda visit: str(visit['timestamp']))
+    return list(reversed(visits))
+
+
+def _visit_date(visit):
+    return visit.get('timestamp', 'Unknown date')
+
+
+def _number(value):
+    return None if value is None or np.isnan(value) else round(float(value), 3)
+
+
+class VisitMatrix:
+    """Visits as a stack of tooth-by-condition matrices.
+
+    ``present[v, t, c]`` is True when visit ``v`` found condition ``c`` on
+    tooth ``t``; ``confidence[v, t, c]`` is its highest confidence, NaN when
+    absent or not reported.
+    """
+
+    def __init__(self, visits):
+        self.visits = visits
+        rows = []
+        for v, visit in enumerate(visits):
+            for finding in visit.get('findings') or []:
+                condition = normalize_condition(finding.get('description'))
+                if finding.get('tooth') is None or not condition:
+                    continue
+                confidence = (finding.get('metadata') or {}).get('confidence')
+                if not isinstance(confidence, (int, float)):
+                    confidence = np.nan
+                rows.append((v, str(finding['tooth']), condition, confidence))
+
+        self.teeth = sorted({row[1] for row in rows}, key=_tooth_key)
+        self.conditions = sorted({row[2] for row in rows})
+        tooth_index = {tooth: i for i, tooth in enumerate(self.teeth)}
+        condition_index = {condition: i for i, condition in enumerate(self.conditions)}
+
+        shape = (len(visits), len(self.teeth), len(self.conditions))
+        self.present = np.zeros(shape, dtype=bool)
+        self.confidence = np.full(shape, np.nan, dtype=np.float32)
+        if rows:
+            v_idx = np.fromiter((row[0] for row in rows), dtype=np.intp, count=len(rows))
+            t_idx = np.fromiter((tooth_index[row[1]] for row in rows), dtype=np.intp, count=len(rows))
+            c_idx = np.fromiter((condition_index[row[2]] for row in rows), dtype=np.intp, count=len(rows))
+            values = np.fromiter((row[3] for row in rows), dtype=np.float32, count=len(rows))
+            self.present[v_idx, t_idx, c_idx] = True
+            # Duplicate findings on one tooth keep their highest confidence (fmax skips NaN)
+            np.fmax.at(self.confidence, (v_idx, t_idx, c_idx), values)
+
+    def label(self, t, c):
+        return f"#{self.teeth[t]} {self.conditions[c]}"
+
+
+def diff_visits(visits, progression_delta=VISIT_DIFF_PROGRESSION_DELTA):
+    """Per-tooth changes across any number of visits.
+
+    Returns a dict with:
+      "visits"    - the visits compared, oldest first
+      "findings"  - one row per tooth/condition ever seen: status (new,
+                    progressed, persisting or resolved, comparing first and
+                    latest visit), first/last seen dates and confidences
+      "intervals" - new/resolved/progressed findings between consecutive visits
+    Raises ValueError for fewer than two visits.
+    """
+    if len(visits) < 2:
+        raise ValueError("Need at least 2 visits for comparison.")
+    ordered = chronological(visits)
+    matrix = VisitMatrix(ordered)
+    present, confidence = matrix.present, matrix.confidence
+    n = len(ordered)
+
+    # Every consecutive pair at once: (n-1, teeth, conditions)
+    with np.errstate(invalid="ignore"):
+        steps = confidence[1:] - confidence[:-1]
+        new = present[1:] & ~present[:-1]
+        resolved = present[:-1] & ~present[1:]
+        progressed = present[1:] & present[:-1] & (steps >= progression_delta)
+
+    # First to latest visit, per tooth/condition
+    ever = present.any(axis=0)
+    first_seen = present.argmax(axis=0)
+    last_seen = n - 1 - present[::-1].argmax(axis=0)
+    first_confidence = np.take_along_axis(confidence, first_seen[None], axis=0)[0]
+    last_confidence = np.take_along_axis(confidence, last_seen[None], axis=0)[0]
+    with np.errstate(invalid="ignore"):
+        delta = last_confidence - first_confidence
+    in_latest = present[-1]
+    status = np.where(
+        ~in_latest, 2,                                   # resolved
+        np.where(first_seen > 0, 0,                      # new since the first visit
+                 np.where(delta >= progression_delta, 1, 3)))  # progressed / persisting
+    status_names = {0: "new", 1: "progressed", 2: "resolved", 3: "persisting"}
+
+    findings = []
+    for t, c in zip(*np.nonzero(ever)):
+        findings.append({
+            "tooth": matrix.teeth[t],
+            "condition": matrix.conditions[c],
+            "status": status_names[int(status[t, c])],
+            "first_seen": _visit_date(ordered[first_seen[t, c]]),
+            "last_seen": _visit_date(ordered[last_seen[t, c]]),
+            "confidence_first": _number(first_confidence[t, c]),
+            "confidence_last": _number(last_confidence[t, c]),
+            "confidence_delta": _number(delta[t, c]) if first_seen[t, c] != last_seen[t, c] else None,
+        })
+    findings.sort(key=lambda row: (STATUS_ORDER.index(row["status"]), _tooth_key(row["tooth"]), row["condition"]))
+
+    intervals = []
+    for i in range(n - 1):
+        intervals.append({
+            "from": _visit_date(ordered[i]),
+            "to": _visit_date(ordered[i + 1]),
+            "new": [matrix.label(t, c) for t, c in zip(*np.nonzero(new[i]))],
+            "resolved": [matrix.label(t, c) for t, c in zip(*np.nonzero(resolved[i]))],
+            "progressed": [f"{matrix.label(t, c)} ({steps[i, t, c]:+.2f})" for t, c in zip(*np.nonzero(progressed[i]))],
+        })
+
+    return {
+        "visits": [
+            {
+                "date": _visit_date(visit),
+                "visit_id": visit.get('visit_id', 'unknown'),
+                "findings_count": len(visit.get('findings') or []),
+                "teeth_affected": sorted({str(f['tooth']) for f in visit.get('findings') or [] if 'tooth' in f},
+                                         key=_tooth_key),
+            }
+            for visit in ordered
+        ],
+        "findings": findings,
+        "intervals": intervals,
+    }
+
+
+def _confidence_text(row):
+    first, last = row["confidence_first"], row["confidence_last"]
+    if first is None and last is None:
+        return "-"
+    if row["first_seen"] == row["last_seen"] or first == last:
+        return f"{last if last is not None else first:.2f}"
+    return f"{'?' if first is None else f'{first:.2f}'} → {'?' if last is None else f'{last:.2f}'}"
+
+
+def format_diff_table(diff, max_intervals=VISIT_DIFF_MAX_INTERVALS):
+    """Compact markdown for prompts: one table row per tooth/condition plus recent visit-to-visit changes"""
+    visits = diff["visits"]
+    lines = [f"Visits compared: {len(visits)} ({visits[0]['date']} to {visits[-1]['date']})"]
+    if not diff["findings"]:
+        lines.append("No findings in any compared visit.")
+    else:
+        lines.append("| Tooth | Condition | Status | First seen | Last seen | Confidence | Δ |")
+        lines.append("|---|---|---|---|---|---|---|")
+        for row in diff["findings"]:
+            change = "" if row["confidence_delta"] is None else f"{row['confidence_delta']:+.2f}"
+            lines.append(f"| {row['tooth']} | {row['condition']} | {row['status']} | {row['first_seen']} | "
+                         f"{row['last_seen']} | {_confidence_text(row)} | {change} |")
+
+    changes = [interval for interval in reversed(diff["intervals"])
+               if interval["new"] or interval["resolved"] or interval["progressed"]]
+    if changes:
+        lines.append("")
+        lines.append("Changes between visits (most recent first):")
+        for interval in changes[:max_intervals]:
+            parts = [f"{kind} {', '.join(interval[kind])}" for kind in ("new", "resolved", "progressed") if interval[kind]]
+            lines.append(f"- {interval['from']} → {interval['to']}: " + "; ".join(parts))
+        if len(changes) > max_intervals:
+            lines.append(f"- ... {len(changes) - max_intervals} earlier intervals with changes")
+    return "\n".join(lines)
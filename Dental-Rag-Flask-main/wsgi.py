@@ -0,0 +1,13 @@
+"""Production entry point: gunicorn -c gunicorn.conf.py (see README)"""
+from app import create_app
+from claude_try import get_cdt
+from structured_log import setup_logging
+
+setup_logging()
+
+# Imported once in the gunicorn master (preload_app), so the CDT catalog is
+# mapped before workers fork and its pages are shared copy-on-write
+get_cdt()
+
+# Model warm-up runs per worker from the post_fork hook instead
+app = create_app(warm_up_on_start=False)